@@ -0,0 +1,310 @@
+import sys, types, math
+from typing import Optional, List
+
+import numpy as np
+
+
+## ======================================================================
+"""
+bpy Stand-in
+
+A lightweight stand-in for the bpy, bmesh and mathutils modules, so the
+crowd_tools modules import in a normal Python interpreter and their
+array adapters (read_hair_keys, write_hair_keys, mesh_arrays and the
+like) can be driven at full scale without Blender. It covers what those
+adapters touch and nothing more; anything needing a real scene still has
+to run inside Blender (see crowd_bench).
+
+	from crowd_tools import bpy_standin
+	bpy_standin.install()
+
+	from crowd_tools import hair_key_cache
+	system = bpy_standin.particle_system( 'prt.test', positions )
+	hair_key_cache.read_hair_keys( system )
+"""
+## ======================================================================
+
+class ForeachCollection:
+	"""
+	A bpy collection over numpy arrays, with foreach_get / foreach_set
+	and item access.
+
+	:param count: The number of items.
+	:param attributes: dict of attribute name -> array shaped ( count, ... ).
+	"""
+
+	def __init__( self, count:int, **attributes ):
+		self._count = count
+		self._attributes = attributes
+
+	def __len__( self ):
+		return self._count
+
+	def __getitem__( self, index:int ):
+		if index < 0:
+			index += self._count
+		if not 0 <= index < self._count:
+			raise IndexError( 'ForeachCollection: Index {} out of range.'.format(index) )
+		return _Item( self, index )
+
+	def __iter__( self ):
+		return ( _Item(self, x) for x in range(self._count) )
+
+	def foreach_get( self, attribute:str, seq ):
+		seq[:] = self._attributes[attribute].ravel()
+
+	def foreach_set( self, attribute:str, seq ):
+		values = self._attributes[attribute]
+		values.ravel()[:] = np.asarray( seq, dtype=values.dtype ).ravel()
+
+
+class _Item:
+	__slots__ = ( '_collection', 'index' )
+
+	def __init__( self, collection:ForeachCollection, index:int ):
+		object.__setattr__( self, '_collection', collection )
+		object.__setattr__( self, 'index', index )
+
+	def __getattr__( self, name:str ):
+		value = self._collection._attributes[name][self.index]
+		return Vector( value ) if isinstance( value, np.ndarray ) else value
+
+	def __setattr__( self, name:str, value ):
+		self._collection._attributes[name][self.index] = value
+
+
+## ======================================================================
+def particle_system( name:str, positions:np.ndarray ):
+	"""
+	A hair ParticleSystem stand-in holding the given hair keys.
+
+	:param positions: Hair key positions shaped ( particles, keys, 3 ).
+				Written through, like the real hair keys.
+	"""
+
+	positions = np.ascontiguousarray( positions, dtype=np.float32 )
+	particles = [ types.SimpleNamespace(hair_keys=ForeachCollection(len(x), co=x)) for x in positions ]
+
+	return types.SimpleNamespace( name=name, particles=particles, positions=positions,
+				settings=types.SimpleNamespace(count=len(particles), hair_step=positions.shape[1] - 1) )
+
+
+def mesh( positions:np.ndarray, loop_totals:Optional[List[int]]=None,
+		vertex_indices:Optional[List[int]]=None, name:str='Mesh' ):
+	"""
+	A Mesh stand-in with vertices, polygons and loops collections.
+
+	:param positions: Vertex positions shaped ( vertices, 3 ).
+	:param loop_totals: The vertex count of every face.
+	:param vertex_indices: Every face's vertex indices back to back.
+	"""
+
+	positions = np.ascontiguousarray( positions, dtype=np.float32 ).reshape( -1, 3 )
+	loop_totals = np.asarray( loop_totals if loop_totals is not None else [], dtype=np.int32 )
+	vertex_indices = np.asarray( vertex_indices if vertex_indices is not None else [], dtype=np.int32 )
+	loop_starts = np.concatenate( [[0], np.cumsum(loop_totals)[:-1]] ).astype( np.int32 ) if len( loop_totals ) else loop_totals
+
+	return types.SimpleNamespace(
+		name=name,
+		vertices=ForeachCollection( len(positions), co=positions ),
+		polygons=ForeachCollection( len(loop_totals), loop_total=loop_totals, loop_start=loop_starts ),
+		loops=ForeachCollection( len(vertex_indices), vertex_index=vertex_indices ),
+		shape_keys=None,
+		materials=[],
+	)
+
+
+## ======================================================================
+"""
+mathutils
+"""
+## ======================================================================
+
+class Vector:
+	def __init__( self, values=(0.0, 0.0, 0.0) ):
+		self._values = np.array( values, dtype=np.float64 )
+
+	x = property( lambda self: self._values[0] )
+	y = property( lambda self: self._values[1] )
+	z = property( lambda self: self._values[2] )
+
+	def __len__( self ):
+		return len( self._values )
+
+	def __getitem__( self, index ):
+		return self._values[index]
+
+	def __iter__( self ):
+		return iter( self._values.tolist() )
+
+	def __add__( self, other ):
+		return Vector( self._values + np.asarray(other) )
+
+	def __sub__( self, other ):
+		return Vector( self._values - np.asarray(other) )
+
+	def __mul__( self, scalar ):
+		return Vector( self._values * scalar )
+
+	def __array__( self, dtype=None ):
+		return self._values if dtype is None else self._values.astype( dtype )
+
+	def __repr__( self ):
+		return 'Vector(({}))'.format( ', '.join('{:.4f}'.format(x) for x in self._values) )
+
+	@property
+	def length( self ) -> float:
+		return float( np.linalg.norm(self._values) )
+
+	def normalized( self ):
+		return Vector( self._values / (self.length or 1.0) )
+
+	def to_4d( self ):
+		return Vector( list(self._values[:3]) + [1.0] )
+
+	def copy( self ):
+		return Vector( self._values )
+
+
+class Matrix:
+	def __init__( self, rows=None ):
+		self._values = np.identity( 4 ) if rows is None else np.array( rows, dtype=np.float64 )
+
+	@classmethod
+	def Identity( cls, size:int ):
+		return cls( np.identity(size) )
+
+	@classmethod
+	def Rotation( cls, angle:float, size:int, axis:str ):
+		c, s = math.cos( angle ), math.sin( angle )
+		i, j = { 'X': (1, 2), 'Y': (2, 0), 'Z': (0, 1) }[axis]
+
+		values = np.identity( size )
+		values[i, i] = values[j, j] = c
+		values[i, j], values[j, i] = -s, s
+		return cls( values )
+
+	def __getitem__( self, index ):
+		return self._values[index]
+
+	def __mul__( self, other ):
+		if isinstance( other, Matrix ):
+			return Matrix( self._values.dot(other._values) )
+
+		vector = np.asarray( other, dtype=np.float64 )
+		if len( vector ) == 3 and len( self._values ) == 4:
+			return Vector( self._values.dot(np.append(vector, 1.0))[:3] )
+		return Vector( self._values.dot(vector) )
+
+	def __array__( self, dtype=None ):
+		return self._values if dtype is None else self._values.astype( dtype )
+
+	def inverted( self ):
+		return Matrix( np.linalg.inv(self._values) )
+
+	def transposed( self ):
+		return Matrix( self._values.T )
+
+	def to_translation( self ):
+		return Vector( self._values[:3, 3] )
+
+
+## ======================================================================
+"""
+bpy
+"""
+## ======================================================================
+
+class _DataCollection( dict ):
+	"""
+	A bpy.data collection stand-in: a dict by name.
+	"""
+
+	is_updated = False
+
+	def __iter__( self ):
+		return iter( list(self.values()) )
+
+	def keys( self ):
+		return list( super().keys() )
+
+
+class _Types( types.ModuleType ):
+	"""
+	Hands out a placeholder class for any bpy.types name, enough for
+	annotations and isinstance checks.
+	"""
+
+	def __init__( self ):
+		super().__init__( 'bpy.types' )
+		self._classes = {}
+
+	def __getattr__( self, name:str ):
+		if name.startswith( '_' ):
+			raise AttributeError( name )
+		if not name in self._classes:
+			self._classes[name] = type( name, (object,), {} )
+		return self._classes[name]
+
+
+def _persistent( func ):
+	return func
+
+
+def _make_bpy() -> types.ModuleType:
+	bpy = types.ModuleType( 'bpy' )
+	bpy.__standin__ = True
+
+	bpy.types = _Types()
+	bpy.data = types.SimpleNamespace( **{ name: _DataCollection() for name in
+				('objects', 'meshes', 'curves', 'armatures', 'actions', 'groups', 'materials', 'particles') } )
+	bpy.data.filepath = ''
+	bpy.data.is_dirty = False
+
+	scene = types.SimpleNamespace( name='Scene', frame_start=1, frame_end=250, frame_current=1,
+				frame_subframe=0.0, objects=_DataCollection() )
+	scene.frame_set = lambda frame, subframe=0.0: setattr( scene, 'frame_current', frame )
+	scene.update = lambda: None
+
+	bpy.context = types.SimpleNamespace( scene=scene, active_object=None, selected_objects=[],
+				window_manager=types.SimpleNamespace(progress_begin=lambda *args: None,
+					progress_update=lambda *args: None, progress_end=lambda *args: None) )
+
+	## the 2.7x handler lists
+	bpy.app = types.SimpleNamespace( version=(2, 79, 0), version_string='2.79 (stand-in)',
+				handlers=types.SimpleNamespace(persistent=_persistent, frame_change_pre=[],
+					frame_change_post=[], load_post=[], scene_update_post=[], undo_post=[], redo_post=[]) )
+
+	bpy.path = types.SimpleNamespace( abspath=lambda path: path, relpath=lambda path: path )
+	bpy.ops = types.SimpleNamespace()
+
+	return bpy
+
+
+def install( force:bool=False ) -> types.ModuleType:
+	"""
+	Registers the stand-in bpy, bmesh and mathutils modules, unless the
+	real ones are importable.
+
+	:param force: Install the stand-ins even if the real modules exist.
+	:returns: The bpy module in use.
+	"""
+
+	if not force:
+		try:
+			import bpy
+			return bpy
+		except ImportError:
+			pass
+
+	mathutils = types.ModuleType( 'mathutils' )
+	mathutils.Vector = Vector
+	mathutils.Matrix = Matrix
+
+	bpy = _make_bpy()
+	sys.modules['bpy'] = bpy
+	sys.modules['bpy.types'] = bpy.types
+	sys.modules['bmesh'] = types.ModuleType( 'bmesh' )
+	sys.modules['mathutils'] = mathutils
+
+	return bpy
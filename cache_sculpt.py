@@ -1,7 +1,19 @@
-import math
 import bpy, bmesh, mathutils
 from mathutils import Vector, Matrix
 
+from typing import Optional, List
+
+import numpy as np
+
+from . import core, profiling
+
+
+## what finish_cache switched off, so a re-bake can switch it back on
+LIVE_PROPERTY = 'crowd_cache_live'
+
+## copied over when reset_cache rebuilds the keys it keeps
+_KEPT_KEY_SETTINGS = ( 'value', 'mute', 'vertex_group', 'interpolation' )
+
 
 ## ======================================================================
 def add_shape_key( ob:bpy.types.Object, name ):
@@ -34,77 +46,284 @@ def add_shape_key( ob:bpy.types.Object, name ):
 
 
 ## ======================================================================
-def bake_frame( ob:bpy.types.Object, frame:int, export_obj=None ):
-	scene = bpy.context.scene
-	
-	shape_name = 'cache__F{:04d}'.format(frame)
-	data_path = 'key_blocks["{}"].value'.format( shape_name )
+def cache_shape_name( frame:int ) -> str:
+	"""
+	The name of the shape key holding the cache for a frame.
+	"""
+
+	return 'cache__F{:04d}'.format( frame )
+
+
+def key_cache_frame( ob:bpy.types.Object, shape:bpy.types.ShapeKey, frame:int ) -> bool:
+	"""
+	Keys a cache shape key fully on at its frame and off on the frames either
+	side. Keys that are already right are left alone, so re-baking into
+	existing cache keys does not touch the animation at all.
 
-	## clean out the old keys
-	if ob.data.shape_keys.animation_data and ob.data.shape_keys.animation_data.action:
-		action = ob.data.shape_keys.animation_data.action
-		for curve in action.fcurves:
-			if curve.data_path == data_path:
-				action.fcurves.remove(curve)
-				break
+	:returns: True if the keys had to be (re)inserted.
+	"""
+
+	data_path = 'key_blocks["{}"].value'.format( shape.name )
 
-	scene.frame_set( frame )
+	anim = ob.data.shape_keys.animation_data
+	fcurve = anim.action.fcurves.find( data_path ) if anim and anim.action else None
+	if fcurve is not None:
+		keys = fcurve.keyframe_points
+		co = np.empty( len(keys) * 2, dtype=np.float32 )
+		profiling.foreach_get( keys, 'co', co )
 
-	mesh = ob.to_mesh( scene, apply_modifiers=True, settings="RENDER" )
-	shape = add_shape_key( ob, shape_name )
+		if np.array_equal( co, (frame-1, 0.0, frame, 1.0, frame+1, 0.0) ):
+			return False
 
-	for index in range( len(ob.data.vertices) ):
-		shape.data[index].co = mesh.vertices[index].co
+		## clean out the old keys
+		anim.action.fcurves.remove( fcurve )
 
 	## this keys them on for the duration of the animation
 	shape.value = 0.0
-	ob.data.shape_keys.keyframe_insert( data_path, frame=frame-1 )
+	profiling.keyframe_insert( ob.data.shape_keys, data_path, frame=frame-1 )
 	shape.value = 1.0
-	ob.data.shape_keys.keyframe_insert( data_path, frame=frame )
+	profiling.keyframe_insert( ob.data.shape_keys, data_path, frame=frame )
 	shape.value = 0.0
-	ob.data.shape_keys.keyframe_insert( data_path, frame=frame+1 )
+	profiling.keyframe_insert( ob.data.shape_keys, data_path, frame=frame+1 )
 
-	if export_obj:
-		## the blender OBJ importer adjusts for Y up in other packages
-		## so rotate the mesh here before export
-		rotate_mat = mathutils.Matrix.Rotation(-math.pi/2, 4, 'X')
-		mesh.transform( rotate_mat )
+	profiling.count( 'keyframes_inserted', 3 )
+	return True
 
-		## man the OBJ format is simple. No wonder people love it.
-		print( '+ Exporting frame {} to "{}"'.format(frame, export_obj) )
-		with open( export_obj, 'w' ) as fp:
-			for v in mesh.vertices:
-				fp.write( 'v {:6f} {:6f} {:6f}\n'.format(v.co[0], v.co[1], v.co[2]) )
 
-			## smoothing
-			# fp.write( 's 1\n' )
+## ======================================================================
+def disable_modifiers( ob:bpy.types.Object, types ) -> dict:
+	"""
+	Turns off every modifier of the given types.
+
+	:param ob: The Object whose modifiers to disable.
+	:param types: A set of modifier types, such as {'SUBSURF'}.
+	:returns: The previous visibility of each disabled modifier, for restore_modifiers.
+	"""
+
+	disabled = {}
+	for mod in ob.modifiers:
+		if mod.type in types:
+			disabled[mod.name] = {
+				'show_render': mod.show_render,
+				'show_viewport': mod.show_viewport,
+			}
+
+			mod.show_render = mod.show_viewport = False
+
+	return disabled
+
 
-			for f in mesh.polygons:
-				msg = "f"
-				for v in f.vertices:
-					msg += ' {:d}'.format(v+1)
-				msg += '\n'
-				fp.write( msg )
+def restore_modifiers( ob:bpy.types.Object, disabled:dict ):
+	"""
+	Puts back the modifier visibility returned by disable_modifiers.
+	"""
 
-			## one extra line at the end
-			fp.write( '\n' )
+	for mod_name, values in disabled.items():
+		for key, value in values.items():
+			setattr( ob.modifiers[mod_name], key, value )
+
+
+## ======================================================================
+def evaluate_frame( ob:bpy.types.Object, frame:int ) -> np.ndarray:
+	"""
+	Evaluates the final vertex positions of an object on a frame.
+
+	:param ob: The mesh Object to evaluate. Modifiers that change the vertex
+				count (subsurf) should already be disabled.
+	:param frame: The frame to evaluate.
+	:returns: float32 array shaped ( vertices, 3 ).
+	"""
+
+	scene = bpy.context.scene
+	with profiling.stage( 'frame_set' ):
+		scene.frame_set( frame )
+
+	with profiling.stage( 'mesh_eval' ):
+		mesh = ob.to_mesh( scene, apply_modifiers=True, settings="RENDER" )
+
+	with profiling.stage( 'copy' ):
+		result = np.empty( len(mesh.vertices) * 3, dtype=np.float32 )
+		profiling.foreach_get( mesh.vertices, 'co', result )
+		bpy.data.meshes.remove( mesh )
+
+	return result.reshape( -1, 3 )
+
+
+def mesh_arrays( mesh:bpy.types.Mesh, faces:bool=True ):
+	"""
+	Reads a mesh out in bulk for the core kernels.
+
+	:param faces: Also read the faces. If False, only positions are read and
+				loop_totals and vertex_indices are None.
+	:returns: ( positions, loop_totals, vertex_indices ), see core.write_obj.
+	"""
+
+	positions = np.empty( len(mesh.vertices) * 3, dtype=np.float32 )
+	profiling.foreach_get( mesh.vertices, 'co', positions )
+
+	if not faces:
+		return positions.reshape( -1, 3 ), None, None
+
+	loop_totals = np.empty( len(mesh.polygons), dtype=np.int32 )
+	profiling.foreach_get( mesh.polygons, 'loop_total', loop_totals )
+
+	vertex_indices = np.empty( len(mesh.loops), dtype=np.int32 )
+	profiling.foreach_get( mesh.loops, 'vertex_index', vertex_indices )
+
+	return positions.reshape( -1, 3 ), loop_totals, vertex_indices
+
+
+## ======================================================================
+def bake_frame( ob:bpy.types.Object, frame:int, export_obj=None ):
+	scene = bpy.context.scene
+	
+	shape_name = cache_shape_name( frame )
+
+	## re-baking: the old cache key is overwritten in place, but must not
+	## add itself on top of the deformation while the frame is evaluated
+	shape = ob.data.shape_keys.key_blocks.get( shape_name )
+	if shape is not None:
+		shape.mute = True
+
+	with profiling.stage( 'frame_set' ):
+		scene.frame_set( frame )
+
+	with profiling.stage( 'mesh_eval' ):
+		mesh = ob.to_mesh( scene, apply_modifiers=True, settings="RENDER" )
+
+	if shape is None:
+		shape = add_shape_key( ob, shape_name )
+	shape.mute = False
+
+	with profiling.stage( 'copy' ):
+		positions, loop_totals, vertex_indices = mesh_arrays( mesh, faces=bool(export_obj) )
+		profiling.foreach_set( shape.data, 'co', positions.ravel() )
+
+	with profiling.stage( 'keyframing' ):
+		key_cache_frame( ob, shape, frame )
+
+	if export_obj:
+		## the blender OBJ importer adjusts for Y up in other packages
+		## so rotate the mesh here before export
+		profiling.log( '+ Exporting frame {} to "{}"'.format(frame, export_obj) )
+		with profiling.stage( 'export_write' ):
+			core.write_obj( export_obj, core.rotate_y_up(positions), loop_totals, vertex_indices )
 
 	bpy.data.meshes.remove( mesh )
 
 
 ## ======================================================================
 def clear_shape_keys( ob:bpy.types.Object ):
+	"""
+	Removes every shape key of the object, fix keys included, in one go.
+	See reset_cache to drop only the cache keys.
+	"""
+
 	if not ob.data.shape_keys:
 		return
 
-	keys = ob.data.shape_keys.key_blocks
-	for key in keys:
-		ob.shape_key_remove( key )
-	
+	ob.shape_key_clear()
+
+
+def _save_key( key:bpy.types.ShapeKey ) -> dict:
+	co = np.empty( len(key.data) * 3, dtype=np.float32 )
+	profiling.foreach_get( key.data, 'co', co )
+
+	saved = { x: getattr(key, x) for x in _KEPT_KEY_SETTINGS }
+	saved.update( name=key.name, co=co, relative_key=key.relative_key.name,
+				slider_min=key.slider_min, slider_max=key.slider_max )
+	return saved
+
+
+def _rebuild_keys( ob:bpy.types.Object, kept:List[dict] ):
+	for saved in kept:
+		key = ob.shape_key_add( name=saved['name'], from_mix=False )
+		profiling.foreach_set( key.data, 'co', saved['co'] )
+
+	## relative keys may point further down the list, so they go in last;
+	## a key relative to a cache key that was cleared falls back on the Basis
+	key_blocks = ob.data.shape_keys.key_blocks
+	for saved in kept:
+		key = key_blocks[saved['name']]
+		key.relative_key = key_blocks.get( saved['relative_key'], key_blocks[0] )
+
+		## each end of the slider range is clamped against the other
+		key.slider_max = saved['slider_max']
+		key.slider_min = saved['slider_min']
+		key.slider_max = saved['slider_max']
+
+		for name in _KEPT_KEY_SETTINGS:
+			setattr( key, name, saved[name] )
+
+
+def reset_cache( ob:bpy.types.Object ) -> int:
+	"""
+	Drops every cache key and its F-curve, keeping the Basis and fix keys,
+	and switches the object back to its live deformation (see resume_live).
+
+	The cache F-curves go in one pass, or with their whole action if it
+	holds nothing else. The keys that stay are read out in bulk, every key
+	is cleared at once and the kept keys are rebuilt with their settings
+	and animation, rather than removing the cache keys one at a time.
+	Drivers can't be carried over a clear, so a Key with drivers has its
+	cache keys removed one by one instead.
+
+	:param ob: The Object holding the cache keys.
+	:returns: The number of cache keys removed.
+	"""
+
+	shape_keys = ob.data.shape_keys
+	if shape_keys is None:
+		return 0
+
+	key_blocks = shape_keys.key_blocks
+	cache_names = [ x.name for x in key_blocks if x.name.startswith('cache__') ]
+	if not cache_names:
+		return 0
+
+	resume_live( ob )
+
+	anim = shape_keys.animation_data
+	action = anim.action if anim else None
+	if action:
+		cache_curves = [ x for x in action.fcurves if x.data_path.startswith('key_blocks["cache__') ]
+
+		if len( cache_curves ) == len( action.fcurves ):
+			anim.action = None
+			if action.users == 0:
+				bpy.data.actions.remove( action )
+			action = None
+		else:
+			for fcurve in cache_curves:
+				action.fcurves.remove( fcurve )
+
+	if anim and len( anim.drivers ):
+		ob.active_shape_key_index = 0
+		for name in reversed( cache_names ):
+			ob.shape_key_remove( key_blocks[name] )
+	else:
+		with profiling.stage( 'key_save' ):
+			kept = [ _save_key(x) for x in key_blocks if not x.name.startswith('cache__') ]
+			use_relative = shape_keys.use_relative
+
+		ob.shape_key_clear()
+
+		## nothing but the Basis left: no keys at all, as clear_shape_keys leaves it
+		if len( kept ) > 1:
+			with profiling.stage( 'key_rebuild' ):
+				_rebuild_keys( ob, kept )
+
+			ob.data.shape_keys.use_relative = use_relative
+			if action:
+				ob.data.shape_keys.animation_data_create().action = action
+
+	profiling.log( 'Removed {} cache keys from "{}".'.format(len(cache_names), ob.name) )
+	return len( cache_names )
+
 
 ## ======================================================================
 def bake_to_shape_keys( ob:bpy.types.Object, start_frame=None, end_frame=None,
-		export_path=None ):
+		export_path=None, finalize=True ):
 	"""
 	Steps through the timeline from start_frame to end_frame and 
 	bakes the final mesh to shape keys.
@@ -114,6 +333,9 @@ def bake_to_shape_keys( ob:bpy.types.Object, start_frame=None, end_frame=None,
 	:param start_frame: The first frame to bake, inclusive.
 	:param end_frame: The last frame to bake, inclusive.
 	:param export_path: The path to export files, minus the frame and extension
+	:param finalize: Switch the object over to cache playback when done (see
+				finish_cache). Pass False when baking a long range in chunks,
+				so later chunks still see the live deformation.
 	:returns: The number of frames baked, or 0 on error.
 	"""
 
@@ -131,16 +353,10 @@ def bake_to_shape_keys( ob:bpy.types.Object, start_frame=None, end_frame=None,
 	if start_frame > end_frame:
 		return 0
 
-	## disable subsurf
-	disabled = {}
-	for mod in ob.modifiers:
-		if mod.type == 'SUBSURF':
-			disabled[mod.name] = {
-				'show_render': mod.show_render,
-				'show_viewport': mod.show_viewport,
-			}
+	## re-baking a finished object: the cache has to see the live deformation again
+	resume_live( ob )
 
-			mod.show_render = mod.show_viewport = False
+	disabled = disable_modifiers( ob, {'SUBSURF'} )
 
 	wm.progress_begin( start_frame, end_frame+1 )
 	for frame in range( start_frame, end_frame+1 ):
@@ -152,22 +368,128 @@ def bake_to_shape_keys( ob:bpy.types.Object, start_frame=None, end_frame=None,
 
 	wm.progress_end()
 
-	for mod in ob.modifiers:
-		mod.show_render = mod.show_viewport = False
-	
-	for key in ob.data.shape_keys.key_blocks:
-		if not key.name.startswith('cache__') and not key.name.startswith('fix__'):
-			key.mute = True
+	if finalize:
+		finish_cache( ob, disabled )
 
 	## re-enable any subsurf modifiers
-	for mod_name, values in disabled.items():
-		for key, value in values.items():
-			setattr( ob.modifiers[mod_name], key, value )
+	restore_modifiers( ob, disabled )
 
-	print("Baked {} frames.".format(end_frame - start_frame + 1))
+	profiling.count( 'objects_touched' )
+	profiling.log( "Baked {} frames.".format(end_frame - start_frame + 1) )
 	return end_frame - start_frame + 1
 
 
+## ======================================================================
+def finish_cache( ob:bpy.types.Object, disabled:Optional[dict]=None ):
+	"""
+	Switches an object over to playing back its cache keys: modifiers
+	are turned off and every key that is not a cache or fix key is muted.
+	What was switched off is stored on the object for resume_live.
+
+	:param disabled: Modifiers the caller already turned off for the bake,
+				as returned by disable_modifiers; their visibility from before
+				that is what gets stored.
+	"""
+
+	live = ob.get( LIVE_PROPERTY )
+	modifiers = live['modifiers'].to_dict() if live else {}
+	muted = list( live['keys'] ) if live else []
+
+	## an earlier finish_cache or the caller saw the modifiers before they were turned off
+	previous = disable_modifiers( ob, { x.type for x in ob.modifiers } )
+	previous.update( disabled or {} )
+	previous.update( modifiers )
+
+	for key in ob.data.shape_keys.key_blocks:
+		if not key.name.startswith('cache__') and not key.name.startswith('fix__') and not key.mute:
+			key.mute = True
+			muted.append( key.name )
+
+	ob[LIVE_PROPERTY] = {
+		'modifiers': previous,
+		'keys': muted,
+	}
+
+
+def resume_live( ob:bpy.types.Object ) -> bool:
+	"""
+	Undoes finish_cache, putting back the modifiers and keys it switched
+	off, so the object deforms live again for a re-bake.
+
+	Objects finished before this was recorded have every modifier but
+	their subsurf turned off, which baking turned back on; if that is
+	what's found, the other modifiers are turned back on.
+
+	:returns: True if anything was switched back on.
+	"""
+
+	live = ob.get( LIVE_PROPERTY )
+	if live is None:
+		others = [ x for x in ob.modifiers if not x.type == 'SUBSURF' ]
+		if others and ob.data.shape_keys and \
+				not any( x.show_viewport or x.show_render for x in others ):
+			for mod in others:
+				mod.show_render = mod.show_viewport = True
+			return True
+		return False
+
+	restore_modifiers( ob, { name: values.to_dict() for name, values in live['modifiers'].items()
+							if name in ob.modifiers } )
+
+	key_blocks = ob.data.shape_keys.key_blocks if ob.data.shape_keys else {}
+	for name in live['keys']:
+		if name in key_blocks:
+			key_blocks[name].mute = False
+
+	del ob[LIVE_PROPERTY]
+	return True
+
+
+## ======================================================================
+def read_cache_frames( ob:bpy.types.Object, start_frame:int, end_frame:int ) -> np.ndarray:
+	"""
+	Reads the baked cache keys for a frame range back out in bulk.
+
+	:param ob: The Object holding the cache keys.
+	:param start_frame: The first frame to read, inclusive.
+	:param end_frame: The last frame to read, inclusive.
+	:returns: float32 array shaped ( frames, vertices, 3 ).
+	:raises: KeyError if a frame in the range has not been baked.
+	"""
+
+	key_blocks = ob.data.shape_keys.key_blocks
+	vertex_count = len( ob.data.vertices )
+
+	result = np.empty( (end_frame - start_frame + 1, vertex_count * 3), dtype=np.float32 )
+	for row, frame in zip( result, range(start_frame, end_frame+1) ):
+		profiling.foreach_get( key_blocks[cache_shape_name(frame)].data, 'co', row )
+
+	return result.reshape( -1, vertex_count, 3 )
+
+
+def apply_cache_frames( ob:bpy.types.Object, start_frame:int, positions:np.ndarray ) -> int:
+	"""
+	Builds cache keys from already evaluated vertex positions, as if
+	bake_to_shape_keys had baked them, without stepping the timeline.
+
+	:param ob: The target Object on which to add the cache keys.
+	:param start_frame: The frame of the first row of positions.
+	:param positions: Vertex positions shaped ( frames, vertices, 3 ).
+	:returns: The number of frames applied.
+	"""
+
+	add_shape_key( ob, 'Basis' )
+	positions = np.ascontiguousarray( positions, dtype=np.float32 )
+
+	for frame, frame_positions in enumerate( positions, start_frame ):
+		shape = add_shape_key( ob, cache_shape_name(frame) )
+		profiling.foreach_set( shape.data, 'co', frame_positions.ravel() )
+		key_cache_frame( ob, shape, frame )
+
+	finish_cache( ob )
+	return len( positions )
+
+
 """
 ## ======================================================================
 def bake_to_shape_keys( ob:bpy.types.Object, start_frame=None, end_frame=None,
@@ -0,0 +1,259 @@
+import re, struct
+from typing import Optional, List, Dict, Iterable, Sequence
+
+import numpy as np
+
+
+## ======================================================================
+"""
+Core Kernels
+
+The data crunching behind the Blender tools, working on plain arrays so
+it can be profiled, optimized and run at full scale in a normal Python
+interpreter. The bpy modules only gather arrays from Blender and hand
+them here; guide_reduction holds the guide clustering and resampling
+kernels in the same way.
+
+Vertex and hair key positions are float32 arrays shaped ( vertices, 3 )
+or ( particles, keys, 3 ); a cache stacks one of those per frame.
+"""
+## ======================================================================
+
+_PC2_HEADER = struct.Struct( '<12siiffi' )
+
+## geo_<token>, geo.<token> and MTL__geo_<token>.001 all give <token>
+LOOK_TOKEN_PATTERN = re.compile( r"""(MTL__)?geo(\.|_)([A-Za-z0-9_]+)(\.[0-9]{3})?""" )
+
+
+## ======================================================================
+"""
+OBJ Export
+"""
+## ======================================================================
+
+def rotate_y_up( positions:np.ndarray ) -> np.ndarray:
+	"""
+	Rotates Z up positions to Y up, -90 degrees around X, which the
+	Blender OBJ importer undoes again on the way back in.
+	"""
+
+	positions = np.asarray( positions )
+	return np.stack( [positions[:, 0], positions[:, 2], -positions[:, 1]], axis=1 )
+
+
+def write_obj( filepath:str, positions:np.ndarray, loop_totals:np.ndarray, vertex_indices:np.ndarray ):
+	"""
+	Writes vertex positions and faces as a minimal OBJ file.
+
+	:param filepath: The .obj file to write.
+	:param positions: Vertex positions shaped ( vertices, 3 ).
+	:param loop_totals: The vertex count of every face, as in Mesh.polygons.
+	:param vertex_indices: Every face's vertex indices back to back, as in Mesh.loops.
+	"""
+
+	loop_totals = np.asarray( loop_totals, dtype=np.int64 )
+	vertex_indices = np.asarray( vertex_indices, dtype=np.int64 ) + 1
+
+	with open( filepath, 'w' ) as fp:
+		np.savetxt( fp, np.asarray(positions).reshape(-1, 3), fmt='v %6f %6f %6f' )
+
+		if not len( loop_totals ):
+			## no faces, only the vertices
+			pass
+		elif ( loop_totals == loop_totals[0] ).all():
+			## all quads or all triangles: one formatted block
+			size = int( loop_totals[0] )
+			np.savetxt( fp, vertex_indices.reshape(-1, size), fmt='f' + ' %d' * size )
+		else:
+			for face in np.split( vertex_indices, np.cumsum(loop_totals)[:-1] ):
+				fp.write( 'f {}\n'.format(' '.join(map(str, face))) )
+
+		## one extra line at the end
+		fp.write( '\n' )
+
+
+## ======================================================================
+"""
+PC2 Point Caches
+"""
+## ======================================================================
+
+def write_pc2( filepath:str, positions:np.ndarray, start_frame:float=0.0, sample_rate:float=1.0 ):
+	"""
+	Writes vertex positions to a PC2 point cache.
+
+	:param filepath: The .pc2 file to write.
+	:param positions: Vertex positions shaped ( frames, vertices, 3 ).
+	:param start_frame: The frame of the first sample.
+	:param sample_rate: Frames between samples.
+	"""
+
+	positions = np.ascontiguousarray( positions, dtype='<f4' )
+	frame_count, vertex_count = positions.shape[:2]
+
+	with open( filepath, 'wb' ) as fp:
+		fp.write( _PC2_HEADER.pack(b'POINTCACHE2\0', 1, vertex_count, start_frame, sample_rate, frame_count) )
+		fp.write( positions.tobytes() )
+
+
+def read_pc2_header( filepath:str ) -> dict:
+	"""
+	:returns: dict with the vertex_count, start_frame, sample_rate and
+			frame_count of a PC2 point cache.
+	:raises: ValueError if the file is not a PC2 cache.
+	"""
+
+	with open( filepath, 'rb' ) as fp:
+		data = fp.read( _PC2_HEADER.size )
+
+	if len( data ) < _PC2_HEADER.size:
+		raise ValueError( 'read_pc2_header: "{}" is too short for a PC2 cache.'.format(filepath) )
+
+	magic, version, vertex_count, start_frame, sample_rate, frame_count = _PC2_HEADER.unpack( data )
+	if not magic == b'POINTCACHE2\0':
+		raise ValueError( 'read_pc2_header: "{}" is not a PC2 cache.'.format(filepath) )
+
+	return {
+		'vertex_count': vertex_count,
+		'start_frame': start_frame,
+		'sample_rate': sample_rate,
+		'frame_count': frame_count,
+	}
+
+
+def read_pc2( filepath:str ) -> np.ndarray:
+	"""
+	Reads every sample of a PC2 point cache.
+
+	:returns: float32 array shaped ( frames, vertices, 3 ).
+	:raises: ValueError if the file is not a PC2 cache.
+	"""
+
+	header = read_pc2_header( filepath )
+	shape = ( header['frame_count'], header['vertex_count'], 3 )
+
+	with open( filepath, 'rb' ) as fp:
+		fp.seek( _PC2_HEADER.size )
+		data = fp.read( int(np.prod(shape)) * 4 )
+
+	return np.frombuffer( data, dtype='<f4' ).reshape( shape ).astype( np.float32 )
+
+
+## ======================================================================
+"""
+Look Tokens
+"""
+## ======================================================================
+
+def look_token( name:str ) -> Optional[str]:
+	"""
+	:returns: The look token of an object name, or None if it has none.
+	"""
+
+	match = LOOK_TOKEN_PATTERN.match( name )
+	if match:
+		return match.group( 3 )
+	return None
+
+
+def index_tokens( names:Iterable[str] ) -> Dict[str,str]:
+	"""
+	Maps each look token to the first name carrying it, so matching a
+	whole selection is one dict lookup per object rather than a scan.
+
+	:returns: dict of token -> name.
+	"""
+
+	result = {}
+	for name in names:
+		token = look_token( name )
+		if token is not None and not token in result:
+			result[token] = name
+
+	return result
+
+
+## ======================================================================
+"""
+Guide Chains
+"""
+## ======================================================================
+
+def chain_tips( positions:np.ndarray, key_indices:Sequence[Sequence[int]] ) -> np.ndarray:
+	"""
+	Extrapolates a tip past the last rigged key of every guide, continuing
+	its last rigged segment, for the tail of the last bone in the chain.
+
+	:param positions: Hair key positions shaped ( particles, keys, 3 ).
+	:param key_indices: Per guide, the rigged keys; at least two each.
+	:returns: array shaped ( particles, 3 ).
+	"""
+
+	rows = np.arange( len(positions) )
+	last = positions[ rows, [ x[-1] for x in key_indices ] ]
+	return last + ( last - positions[ rows, [ x[-2] for x in key_indices ] ] )
+
+
+def chain_points( positions:np.ndarray, key_indices:Sequence[Sequence[int]] ) -> List[np.ndarray]:
+	"""
+	:returns: Per guide, its bone joints: the rigged keys followed by the
+			extrapolated tip, shaped ( len(keys) + 1, 3 ).
+	"""
+
+	tips = chain_tips( positions, key_indices )
+	return [ np.concatenate([points[list(keys)], tip[np.newaxis]])
+				for points, keys, tip in zip(positions, key_indices, tips) ]
+
+
+## ======================================================================
+"""
+Frame Sampling
+"""
+## ======================================================================
+
+def sample_frames( positions:np.ndarray, start_frame:float, frame:float ) -> np.ndarray:
+	"""
+	Looks up the positions for a frame in a per-frame stack, clamped to
+	the cached range and linearly blended on subframes.
+
+	:param positions: Per-frame positions shaped ( frames, ... ).
+	:param start_frame: The frame of the first row.
+	:param frame: The frame to look up.
+	:returns: The positions of one frame, shaped like positions[0].
+	"""
+
+	last = len( positions ) - 1
+	offset = min( max(frame - start_frame, 0.0), float(last) )
+
+	low  = int( offset )
+	high = min( low + 1, last )
+	blend = offset - low
+
+	if blend == 0.0 or low == high:
+		return positions[low]
+
+	return positions[low] + (positions[high] - positions[low]) * blend
+
+
+def cycle_frame( frame:float, offset:float, speed:float, length:int, loop:bool ) -> float:
+	"""
+	Maps a scene frame to a cycle sample.
+
+	A cycle cache holds one sample past the cycle, a copy of its first
+	(bake_cycle writes it), so a looping sample between length-1 and
+	length blends from the last pose back into the first.
+
+	:param frame: The scene frame.
+	:param offset: The scene frame on which the agent starts the cycle.
+	:param speed: Cycle frames played per scene frame.
+	:param length: The number of samples in the cycle, not counting the copy.
+	:param loop: Wrap around at the end of the cycle instead of holding the last sample.
+	:returns: The sample to evaluate, in 0 .. length when looping, else 0 .. length-1.
+	"""
+
+	sample = ( frame - offset ) * speed
+
+	if loop and length > 0:
+		return sample % length
+
+	return min( max(sample, 0.0), float(length - 1) )
@@ -0,0 +1,383 @@
+"""
+Headless batch runner for crowd bakes.
+
+Run from a normal Python interpreter to work through a job spec:
+
+	python crowd_batch.py jobs.toml --workers 4
+
+Each job is run in its own background Blender process:
+
+	blender -b <file.blend> --python crowd_batch.py -- --run-job <queue>/<job>.json
+
+Job spec (JSON or TOML):
+
+	[settings]
+	blender = "blender"            # Blender executable
+	workers = 4                    # concurrent Blender processes
+	queue = "/tmp/crowd_queue"     # queue state, checkpoints and logs
+	checkpoint_every = 10          # frames between checkpoints
+
+	[[jobs]]
+	id = "vincent_body"
+	operation = "body_bake"        # body_bake | hair_bake | look_assign
+	blend = "/shots/sh010.blend"
+	output = "/shots/sh010.baked.blend"   # defaults to <blend>.baked.blend
+	object = "GEO-vincent_body"
+	frames = [1, 120]              # defaults to the scene range
+	export_path = "/data/body"     # body_bake: optional OBJ export
+
+	# hair_bake:   object, system, cache (.npz path), remove_drivers (bool)
+	# look_assign: library (.blend path), objects (names to assign; default all selected)
+
+Every job writes a checkpoint after each chunk of frames and saves its
+output .blend, so a crashed or killed batch resumes from the last
+completed frame. Completed jobs are skipped when the batch is run again.
+"""
+
+import os, sys, json, argparse, subprocess, time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+if __package__:
+	from .script_support import import_tools, script_argv
+else:
+	sys.path.insert( 0, os.path.dirname(os.path.abspath(__file__)) )
+	from script_support import import_tools, script_argv
+
+
+OPERATIONS = ( 'body_bake', 'hair_bake', 'look_assign' )
+
+DEFAULT_SETTINGS = {
+	'blender': 'blender',
+	'workers': 1,
+	'queue': os.path.join( os.getcwd(), 'crowd_queue' ),
+	'checkpoint_every': 10,
+}
+
+
+## ======================================================================
+def load_spec( filepath:str ) -> dict:
+	"""
+	Reads a job spec from a .json or .toml file.
+
+	:returns: dict with 'settings' and 'jobs'.
+	:raises: ValueError on an invalid spec.
+	"""
+
+	if filepath.endswith( '.toml' ):
+		try:
+			import tomllib
+			with open( filepath, 'rb' ) as fp:
+				spec = tomllib.load( fp )
+		except ImportError:
+			import toml
+			with open( filepath ) as fp:
+				spec = toml.load( fp )
+	else:
+		with open( filepath ) as fp:
+			spec = json.load( fp )
+
+	settings = dict( DEFAULT_SETTINGS )
+	settings.update( spec.get('settings', {}) )
+
+	jobs = spec.get( 'jobs', [] )
+	seen = set()
+	for index, job in enumerate( jobs ):
+		job.setdefault( 'id', 'job{:04d}'.format(index) )
+
+		if job['id'] in seen:
+			raise ValueError( 'load_spec: Duplicate job id "{}".'.format(job['id']) )
+		seen.add( job['id'] )
+
+		if not job.get( 'operation' ) in OPERATIONS:
+			raise ValueError( 'load_spec: Job "{}" has unknown operation "{}".'.format(job['id'], job.get('operation')) )
+
+		if not job.get( 'blend' ):
+			raise ValueError( 'load_spec: Job "{}" has no blend file.'.format(job['id']) )
+
+		job.setdefault( 'output', os.path.splitext(job['blend'])[0] + '.baked.blend' )
+		job.setdefault( 'checkpoint_every', settings['checkpoint_every'] )
+
+	return { 'settings': settings, 'jobs': jobs }
+
+
+## ======================================================================
+def _write_json( filepath:str, data:dict ):
+	"""
+	Writes JSON aside and renames it into place, so a kill never leaves
+	a torn state file.
+	"""
+
+	temp_path = filepath + '.tmp'
+	with open( temp_path, 'w' ) as fp:
+		json.dump( data, fp, indent=2 )
+	os.replace( temp_path, filepath )
+
+
+def _read_json( filepath:str ) -> dict:
+	if not os.path.exists( filepath ):
+		return {}
+
+	with open( filepath ) as fp:
+		return json.load( fp )
+
+
+def job_paths( queue:str, job_id:str ) -> dict:
+	return {
+		'job': os.path.join( queue, job_id + '.json' ),
+		'checkpoint': os.path.join( queue, job_id + '.checkpoint.json' ),
+		'log': os.path.join( queue, job_id + '.log' ),
+	}
+
+
+## ======================================================================
+def _run_one( job:dict, settings:dict, script:str ) -> dict:
+	"""
+	Runs a single job in a background Blender process, resuming from its
+	checkpoint if it has one.
+	"""
+
+	paths = job_paths( settings['queue'], job['id'] )
+	state = _read_json( paths['job'] )
+	checkpoint = _read_json( paths['checkpoint'] )
+
+	## resume from the partially baked output if there is one
+	blend = job['blend']
+	if checkpoint and os.path.exists( job['output'] ):
+		blend = job['output']
+
+	state.update( status='running', attempts=state.get('attempts', 0) + 1, started=time.time() )
+	_write_json( paths['job'], state )
+
+	command = [ settings['blender'], '-b', blend, '--python', script, '--', '--run-job', paths['job'] ]
+	with open( paths['log'], 'a' ) as log:
+		log.write( '\n## {}\n'.format(' '.join(command)) )
+		log.flush()
+		returncode = subprocess.call( command, stdout=log, stderr=subprocess.STDOUT )
+
+	checkpoint = _read_json( paths['checkpoint'] )
+	done = returncode == 0 and checkpoint.get( 'done', False )
+
+	state.update( status='done' if done else 'failed', returncode=returncode, finished=time.time() )
+	_write_json( paths['job'], state )
+
+	print( '{} "{}" ({}s)'.format('Finished' if done else 'FAILED', job['id'], int(state['finished'] - state['started'])) )
+	return state
+
+
+def run_queue( spec:dict, script:str, retry_failed:bool=True ) -> bool:
+	"""
+	Queues every job of a spec and runs them with up to settings['workers']
+	Blender processes at a time. Jobs already done are skipped; jobs left
+	running by a killed batch are resumed.
+
+	:returns: True if every job is done.
+	"""
+
+	settings = spec['settings']
+	os.makedirs( settings['queue'], exist_ok=True )
+
+	pending = []
+	for job in spec['jobs']:
+		paths = job_paths( settings['queue'], job['id'] )
+		state = _read_json( paths['job'] )
+
+		if state.get( 'status' ) == 'done':
+			continue
+
+		if state.get( 'status' ) == 'failed' and not retry_failed:
+			continue
+
+		state['spec'] = job
+		state.setdefault( 'status', 'pending' )
+		_write_json( paths['job'], state )
+		pending.append( job )
+
+	print( 'Running {} of {} jobs on {} workers.'.format(len(pending), len(spec['jobs']), settings['workers']) )
+
+	with ThreadPoolExecutor( max_workers=int(settings['workers']) ) as pool:
+		results = list( pool.map(lambda job: _run_one(job, settings, script), pending) )
+
+	return all( x['status'] == 'done' for x in results )
+
+
+## ======================================================================
+"""
+In-Blender job execution
+"""
+## ======================================================================
+
+def _save_checkpoint( job:dict, checkpoint_path:str, **values ):
+	"""
+	Saves the output .blend, then records the checkpoint.
+	"""
+
+	bpy.ops.wm.save_as_mainfile( filepath=job['output'] )
+
+	checkpoint = _read_json( checkpoint_path )
+	checkpoint.update( values )
+	_write_json( checkpoint_path, checkpoint )
+
+
+def _frame_chunks( job:dict, checkpoint:dict ):
+	scene = bpy.context.scene
+	start_frame, end_frame = job.get( 'frames', (scene.frame_start, scene.frame_end) )
+
+	first = max( start_frame, checkpoint.get('last_frame', start_frame - 1) + 1 )
+	step = max( 1, int(job['checkpoint_every']) )
+
+	for chunk_start in range( first, end_frame + 1, step ):
+		yield chunk_start, min( chunk_start + step - 1, end_frame ), end_frame
+
+
+def _run_body_bake( job:dict, checkpoint:dict, checkpoint_path:str ):
+	cache_sculpt = import_tools( 'cache_sculpt' )
+	ob = bpy.data.objects[ job['object'] ]
+
+	for chunk_start, chunk_end, end_frame in _frame_chunks( job, checkpoint ):
+		cache_sculpt.bake_to_shape_keys( ob, chunk_start, chunk_end,
+			export_path=job.get('export_path'), finalize=chunk_end == end_frame )
+		_save_checkpoint( job, checkpoint_path, last_frame=chunk_end )
+
+
+def _reload_hair_rigs():
+	"""
+	Blender opened the .blend before this script imported anything, so
+	no load_post handler saw it: the hair caches and the driver-free guide
+	rigs (bone chains, followers, resampling) are picked up by hand.
+	"""
+
+	import_tools( 'hair_key_cache' )._reload_hair_caches()
+	import_tools( 'hair_rig_convert' )._reload_chains()
+
+
+def _run_hair_bake( job:dict, checkpoint:dict, checkpoint_path:str ):
+	import numpy as np
+	hair_key_cache = import_tools( 'hair_key_cache' )
+	_reload_hair_rigs()
+
+	ob = bpy.data.objects[ job['object'] ]
+	system = ob.particle_systems[ job['system'] ]
+	cache_path = job['cache']
+	partial_path = cache_path + '.partial.npz'
+
+	cache = None
+	if checkpoint.get( 'last_frame' ) is not None and os.path.exists( partial_path ):
+		cache = hair_key_cache.load_hair_cache( partial_path )
+
+	for chunk_start, chunk_end, end_frame in _frame_chunks( job, checkpoint ):
+		chunk = hair_key_cache.bake_hair_cache( ob, system, chunk_start, chunk_end )
+		if cache is not None:
+			chunk = chunk._replace( start_frame=cache.start_frame,
+							positions=np.concatenate([cache.positions, chunk.positions]) )
+		cache = chunk
+
+		## the partial cache is the checkpoint here; the .blend is only saved at the end
+		hair_key_cache.save_hair_cache( cache, partial_path )
+		checkpoint['last_frame'] = chunk_end
+		_write_json( checkpoint_path, checkpoint )
+
+	if cache is None:
+		return
+
+	if job.get( 'remove_drivers' ):
+		hair_key_cache.remove_hair_drivers( ob, system )
+
+	hair_key_cache.register_hair_cache( cache, cache_path )
+	_save_checkpoint( job, checkpoint_path )
+
+	if os.path.exists( partial_path ):
+		os.remove( partial_path )
+
+
+def _run_look_assign( job:dict, checkpoint:dict, checkpoint_path:str ):
+	look_assigner = import_tools( 'look_assigner' )
+
+	if checkpoint.get( 'assigned' ):
+		return
+
+	names = job.get( 'objects' )
+	if names:
+		for ob in bpy.context.scene.objects:
+			ob.select = ob.name in names
+
+	look_assigner.do_assign( job['library'] )
+	_save_checkpoint( job, checkpoint_path, assigned=True )
+
+
+_RUNNERS = {
+	'body_bake': _run_body_bake,
+	'hair_bake': _run_hair_bake,
+	'look_assign': _run_look_assign,
+}
+
+
+def run_job( job_path:str ):
+	"""
+	Runs a queued job inside Blender, picking up from its checkpoint.
+	"""
+
+	state = _read_json( job_path )
+	job = state['spec']
+	checkpoint_path = job_path[:-len('.json')] + '.checkpoint.json'
+	checkpoint = _read_json( checkpoint_path )
+
+	if checkpoint.get( 'done' ):
+		return
+
+	_RUNNERS[ job['operation'] ]( job, checkpoint, checkpoint_path )
+
+	checkpoint = _read_json( checkpoint_path )
+	checkpoint['done'] = True
+	_write_json( checkpoint_path, checkpoint )
+
+
+## ======================================================================
+def main( argv=None ):
+	if argv is None:
+		argv = script_argv()
+
+	parser = argparse.ArgumentParser( description='Run crowd_tools jobs in background Blender processes.' )
+	parser.add_argument( 'spec', nargs='?', help='Job spec, .json or .toml.' )
+	parser.add_argument( '--workers', type=int, help='Concurrent Blender processes.' )
+	parser.add_argument( '--blender', help='Blender executable.' )
+	parser.add_argument( '--queue', help='Queue directory.' )
+	parser.add_argument( '--no-retry', action='store_true', help='Skip jobs that failed on a previous run.' )
+	parser.add_argument( '--profile', metavar='REPORT', help='Append stage timings of every job to this .jsonl file.' )
+	parser.add_argument( '--run-job', help=argparse.SUPPRESS )
+	args = parser.parse_args( argv )
+
+	if args.run_job:
+		if bpy is None:
+			parser.error( '--run-job has to run inside Blender.' )
+
+		try:
+			run_job( args.run_job )
+		except Exception:
+			import traceback
+			traceback.print_exc()
+			sys.exit( 1 )
+		return
+
+	if not args.spec:
+		parser.error( 'a job spec is required.' )
+
+	## picked up by profiling in every Blender process started from here
+	if args.profile:
+		os.environ['CROWD_TOOLS_PROFILE'] = os.path.abspath( args.profile )
+
+	spec = load_spec( args.spec )
+	for name in 'workers', 'blender', 'queue':
+		if getattr( args, name ):
+			spec['settings'][name] = getattr( args, name )
+
+	ok = run_queue( spec, os.path.abspath(__file__), retry_failed=not args.no_retry )
+	sys.exit( 0 if ok else 1 )
+
+
+if __name__ == '__main__':
+	main()
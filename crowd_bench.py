@@ -0,0 +1,446 @@
+"""
+Synthetic benchmarks for every crowd_tools entry point.
+
+Builds test scenes procedurally at several scales and times each entry
+point on them, so it runs on a plain Linux box with no production files:
+
+	blender -b --factory-startup --python crowd_bench.py -- --scales small,medium
+
+Cases:
+	body_bake            cache_sculpt.bake_to_shape_keys on an armature-deformed grid
+	hair_bake            hair_key_cache.bake_hair_cache on a hair system rigged with driver-free chains
+	look_assign          look_assigner.do_assign against a library of geo_* objects
+	parts_to_curvs       the parts_to_curvs script on a hair system
+	curve_conversion     hair_rig_convert.do_curve_conversion
+	armature_conversion  hair_rig_convert.do_armature_conversion
+
+Results are written as JSON. --save-baseline stores them as the baseline;
+--baseline compares against a stored one and exits with 1 if any case got
+slower than its threshold allows. Only the entry point itself is timed,
+never the scene setup; each case keeps the best of --repeat runs, along
+with the profiling stage breakdown of that run.
+"""
+
+import os, sys, json, time, math, argparse, tempfile
+from typing import Optional
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+if __package__:
+	from .script_support import import_tools, script_argv
+else:
+	sys.path.insert( 0, os.path.dirname(os.path.abspath(__file__)) )
+	from script_support import import_tools, script_argv
+
+
+SCALES = {
+	'small':  { 'vertices': 1000,   'guides': 100,   'keys': 5,  'tokens': 20,  'frames': 10 },
+	'medium': { 'vertices': 20000,  'guides': 1000,  'keys': 10, 'tokens': 100, 'frames': 10 },
+	'large':  { 'vertices': 200000, 'guides': 10000, 'keys': 20, 'tokens': 500, 'frames': 10 },
+}
+
+## allowed slowdown over the baseline before a case counts as a regression
+DEFAULT_THRESHOLD = 0.2
+
+BASELINE_VERSION = 1
+
+## hair system names have to look like prt.<name> for the converters
+SYSTEM_NAME = 'prt.bench'
+
+
+## ======================================================================
+## ======================================================================
+"""
+Scene Generation
+"""
+## ======================================================================
+
+def new_scene( frames:int=1 ):
+	"""
+	Empties the session and sets the frame range.
+	"""
+
+	bpy.ops.wm.read_homefile( use_empty=True )
+
+	scene = bpy.context.scene
+	scene.frame_start = 1
+	scene.frame_end = frames
+	scene.frame_set( 1 )
+
+	return scene
+
+
+def make_deformed_grid( vertex_count:int, frames:int ):
+	"""
+	Adds a grid of about vertex_count vertices, skinned to a two bone
+	armature that bends over the frame range.
+
+	:returns: The grid Object.
+	"""
+
+	scene = bpy.context.scene
+	side = max( 2, int(math.ceil(math.sqrt(vertex_count))) )
+
+	bpy.ops.mesh.primitive_grid_add( x_subdivisions=side, y_subdivisions=side, radius=1.0 )
+	ob = bpy.context.active_object
+	ob.name = 'GEO-bench_body'
+
+	arm = bpy.data.armatures.new( 'arm.bench' )
+	rig = bpy.data.objects.new( 'rig.bench', arm )
+	scene.objects.link( rig )
+	scene.objects.active = rig
+
+	bpy.ops.object.mode_set( mode='EDIT' )
+	for index, (head, tail) in enumerate( [((-1,0,0), (0,0,0)), ((0,0,0), (1,0,0))] ):
+		bone = arm.edit_bones.new( 'b{}'.format(index) )
+		bone.head = head
+		bone.tail = tail
+		if index:
+			bone.parent = arm.edit_bones['b0']
+	bpy.ops.object.mode_set( mode='OBJECT' )
+
+	## split the grid down the middle between the bones
+	left  = [ v.index for v in ob.data.vertices if v.co.x <= 0.0 ]
+	right = [ v.index for v in ob.data.vertices if v.co.x > 0.0 ]
+	ob.vertex_groups.new( 'b0' ).add( left, 1.0, 'REPLACE' )
+	ob.vertex_groups.new( 'b1' ).add( right, 1.0, 'REPLACE' )
+
+	mod = ob.modifiers.new( 'Armature', 'ARMATURE' )
+	mod.object = rig
+
+	pose_bone = rig.pose.bones['b1']
+	pose_bone.rotation_mode = 'XYZ'
+	for frame, angle in (1, 0.0), (max(frames, 2), math.pi / 3):
+		pose_bone.rotation_euler = ( 0.0, angle, 0.0 )
+		pose_bone.keyframe_insert( 'rotation_euler', frame=frame )
+
+	scene.objects.active = ob
+	return ob
+
+
+def make_hair( guide_count:int, key_count:int ):
+	"""
+	Adds a plane growing guide_count hairs of key_count keys each.
+
+	:returns: The emitter Object; its system is named SYSTEM_NAME.
+	"""
+
+	scene = bpy.context.scene
+
+	bpy.ops.mesh.primitive_grid_add( x_subdivisions=32, y_subdivisions=32, radius=1.0 )
+	ob = bpy.context.active_object
+	ob.name = 'GEO-bench_scalp'
+	scene.objects.active = ob
+
+	bpy.ops.object.particle_system_add()
+	ps = ob.particle_systems[-1]
+	ps.name = SYSTEM_NAME
+
+	settings = ps.settings
+	settings.type = 'HAIR'
+	settings.count = guide_count
+	settings.hair_length = 0.5
+	settings.hair_step = key_count - 1
+	settings.emit_from = 'FACE'
+
+	## hair keys only exist once the system has been through particle edit
+	bpy.ops.object.mode_set( mode='PARTICLE_EDIT' )
+	bpy.ops.object.mode_set( mode='OBJECT' )
+	scene.update()
+
+	return ob
+
+
+def make_look_library( filepath:str, token_count:int ):
+	"""
+	Writes a look library: one small geo_<token> mesh per token, each
+	with its own material.
+	"""
+
+	new_scene()
+	datablocks = set()
+
+	for index in range( token_count ):
+		name = 'geo_tok{:04d}'.format( index )
+		bpy.ops.mesh.primitive_cube_add()
+		ob = bpy.context.active_object
+		ob.name = ob.data.name = name
+
+		material = bpy.data.materials.new( 'mtl_' + name )
+		ob.data.materials.append( material )
+		datablocks.add( ob )
+
+	bpy.data.libraries.write( filepath, datablocks )
+
+
+def make_look_targets( token_count:int ):
+	"""
+	Adds and selects a scene object per library token, for do_assign.
+	"""
+
+	for index in range( token_count ):
+		bpy.ops.mesh.primitive_cube_add()
+		ob = bpy.context.active_object
+		ob.name = 'geo_tok{:04d}'.format( index )
+
+	for ob in bpy.context.scene.objects:
+		ob.select = True
+
+
+## ======================================================================
+"""
+Cases
+
+Each case sets up a fresh scene from a scale dict and returns the
+callable to time.
+"""
+## ======================================================================
+
+def case_body_bake( scale:dict, workdir:str ):
+	cache_sculpt = import_tools( 'cache_sculpt' )
+
+	new_scene( scale['frames'] )
+	ob = make_deformed_grid( scale['vertices'], scale['frames'] )
+
+	return lambda: cache_sculpt.bake_to_shape_keys( ob, 1, scale['frames'] )
+
+
+def case_hair_bake( scale:dict, workdir:str ):
+	new_scene( scale['frames'] )
+	ob = make_hair( scale['guides'], scale['keys'] )
+	ps = ob.particle_systems[SYSTEM_NAME]
+
+	hair_key_cache = import_tools( 'hair_key_cache' )
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+	hair_rig_convert.invalidate_particle_registry()
+
+	## rig the guides with the chain evaluator and swing the rig, so every
+	## frame of the bake evaluates the chains and writes the hair keys
+	chains = hair_rig_convert.do_armature_conversion( ob, SYSTEM_NAME, use_drivers=False )
+	bpy.ops.object.mode_set( mode='OBJECT' )
+
+	rig = chains[0][0].id_data
+	for frame, angle in (1, 0.0), (max(scale['frames'], 2), math.pi / 6):
+		rig.rotation_euler = ( angle, 0.0, 0.0 )
+		rig.keyframe_insert( 'rotation_euler', frame=frame )
+
+	return lambda: hair_key_cache.bake_hair_cache( ob, ps, 1, scale['frames'] )
+
+
+def case_look_assign( scale:dict, workdir:str ):
+	look_assigner = import_tools( 'look_assigner' )
+
+	library = os.path.join( workdir, 'look_library_{}.blend'.format(scale['tokens']) )
+	if not os.path.exists( library ):
+		make_look_library( library, scale['tokens'] )
+
+	new_scene()
+	make_look_targets( scale['tokens'] )
+
+	return lambda: look_assigner.do_assign( library )
+
+
+def case_parts_to_curvs( scale:dict, workdir:str ):
+	new_scene()
+	ob = make_hair( scale['guides'], scale['keys'] )
+	bpy.context.scene.objects.active = ob
+
+	## the script does all its work at import time
+	return lambda: import_tools( 'parts_to_curvs', reload=True )
+
+
+def case_curve_conversion( scale:dict, workdir:str ):
+	## read_homefile frees the old Scene; hold nothing from before it
+	new_scene()
+	make_hair( scale['guides'], scale['keys'] )
+
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+	hair_rig_convert.invalidate_particle_registry()
+
+	return lambda: hair_rig_convert.do_curve_conversion( SYSTEM_NAME )
+
+
+def case_armature_conversion( scale:dict, workdir:str ):
+	## read_homefile frees the old Scene; hold nothing from before it
+	new_scene()
+	ob = make_hair( scale['guides'], scale['keys'] )
+
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+	hair_rig_convert.invalidate_particle_registry()
+
+	return lambda: hair_rig_convert.do_armature_conversion( ob, SYSTEM_NAME )
+
+
+CASES = {
+	'body_bake': case_body_bake,
+	'hair_bake': case_hair_bake,
+	'look_assign': case_look_assign,
+	'parts_to_curvs': case_parts_to_curvs,
+	'curve_conversion': case_curve_conversion,
+	'armature_conversion': case_armature_conversion,
+}
+
+
+## ======================================================================
+def run_case( name:str, scale_name:str, repeat:int, workdir:str ) -> dict:
+	"""
+	Times one case at one scale, keeping the fastest of repeat runs.
+
+	:returns: dict with the best and every run's seconds, the scale and
+			the stage breakdown of the best run.
+	"""
+
+	profiling = import_tools( 'profiling' )
+	scale = SCALES[scale_name]
+
+	runs = []
+	best_stages = None
+	for attempt in range( repeat ):
+		func = CASES[name]( scale, workdir )
+
+		profiling.reset()
+		start = time.perf_counter()
+		func()
+		seconds = time.perf_counter() - start
+
+		if not runs or seconds < min( runs ):
+			best_stages = profiling.report()['stages']
+		runs.append( seconds )
+
+	return {
+		'seconds': min( runs ),
+		'runs': runs,
+		'scale': scale,
+		'stages': best_stages,
+	}
+
+
+def compare( results:dict, baseline:dict ) -> list:
+	"""
+	:returns: list of ( case, seconds, baseline seconds, allowed seconds )
+			for every case slower than its baseline allows.
+	"""
+
+	default_threshold = baseline.get( 'threshold', DEFAULT_THRESHOLD )
+
+	regressions = []
+	for key, result in sorted( results['cases'].items() ):
+		reference = baseline['cases'].get( key )
+		if reference is None:
+			continue
+
+		allowed = reference['seconds'] * ( 1.0 + reference.get('threshold', default_threshold) )
+		if result['seconds'] > allowed:
+			regressions.append( (key, result['seconds'], reference['seconds'], allowed) )
+
+	return regressions
+
+
+def run_benchmarks( cases:list, scales:list, repeat:int=1, threshold:float=DEFAULT_THRESHOLD,
+		profile_path:Optional[str]=None ) -> dict:
+	"""
+	Runs every case at every scale.
+
+	:param profile_path: If given, a profiling report of each case's last run
+				is appended to this .jsonl file.
+	:returns: The results dict, in the baseline format.
+	"""
+
+	profiling = import_tools( 'profiling' )
+	profiling.set_quiet( True )
+
+	## the stage timings are always kept for the results; no report at exit
+	if not profiling.is_enabled():
+		profiling.enable( os.devnull )
+
+	results = {
+		'version': BASELINE_VERSION,
+		'blender': bpy.app.version_string,
+		'created': time.time(),
+		'threshold': threshold,
+		'cases': {},
+	}
+
+	with tempfile.TemporaryDirectory( prefix='crowd_bench_' ) as workdir:
+		for scale_name in scales:
+			for name in cases:
+				key = '{}/{}'.format( name, scale_name )
+				print( 'Running {}...'.format(key) )
+				sys.stdout.flush()
+
+				result = run_case( name, scale_name, repeat, workdir )
+				result['threshold'] = threshold
+				results['cases'][key] = result
+
+				if profile_path:
+					profiling.write_report( profile_path, case=key, seconds=result['seconds'] )
+
+				print( '\t{:.3f}s'.format(result['seconds']) )
+
+	profiling.set_quiet( False )
+	return results
+
+
+## ======================================================================
+def main( argv=None ):
+	if argv is None:
+		argv = script_argv()
+
+	parser = argparse.ArgumentParser( description='Benchmark crowd_tools on synthetic scenes.' )
+	parser.add_argument( '--scales', default='small', help='Comma separated, from: {}.'.format(', '.join(SCALES)) )
+	parser.add_argument( '--cases', default=','.join(CASES), help='Comma separated, from: {}.'.format(', '.join(CASES)) )
+	parser.add_argument( '--repeat', type=int, default=3 )
+	parser.add_argument( '--output', default='crowd_bench_results.json' )
+	parser.add_argument( '--baseline', help='Baseline JSON to compare against, or to write with --save-baseline.' )
+	parser.add_argument( '--save-baseline', action='store_true' )
+	parser.add_argument( '--threshold', type=float, default=DEFAULT_THRESHOLD,
+		help='Allowed slowdown stored with a new baseline, as a fraction.' )
+	parser.add_argument( '--profile', metavar='REPORT', help='Append a stage timing report per case to this .jsonl file.' )
+	args = parser.parse_args( argv )
+
+	if bpy is None:
+		parser.error( 'the benchmarks have to run inside Blender: blender -b --python crowd_bench.py -- ...' )
+
+	scales = [ x for x in args.scales.split(',') if x ]
+	cases  = [ x for x in args.cases.split(',') if x ]
+	for name in scales:
+		if not name in SCALES:
+			parser.error( 'unknown scale "{}".'.format(name) )
+	for name in cases:
+		if not name in CASES:
+			parser.error( 'unknown case "{}".'.format(name) )
+
+	results = run_benchmarks( cases, scales, args.repeat, args.threshold,
+				os.path.abspath(args.profile) if args.profile else None )
+
+	with open( args.output, 'w' ) as fp:
+		json.dump( results, fp, indent=2 )
+
+	if args.save_baseline:
+		if not args.baseline:
+			parser.error( '--save-baseline needs --baseline.' )
+
+		with open( args.baseline, 'w' ) as fp:
+			json.dump( results, fp, indent=2 )
+		print( 'Saved baseline "{}".'.format(args.baseline) )
+		return
+
+	if args.baseline:
+		with open( args.baseline ) as fp:
+			baseline = json.load( fp )
+
+		regressions = compare( results, baseline )
+		for key, seconds, reference, allowed in regressions:
+			print( 'REGRESSION {}: {:.3f}s, baseline {:.3f}s (allowed {:.3f}s)'.format(key, seconds, reference, allowed) )
+
+		if regressions:
+			sys.exit( 1 )
+
+		print( 'No regressions against "{}".'.format(args.baseline) )
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,434 @@
+import os, hashlib
+from typing import Optional, List, Dict, Tuple
+
+import bpy
+import numpy as np
+
+from . import cache_sculpt, profiling
+
+
+## ======================================================================
+"""
+Crowd Cache Store
+
+Crowd agents mostly share a body mesh and an animation clip, so most of
+their caches are identical. Each agent's bake inputs (mesh data with its
+look and shape keys, the actions and NLA tracks moving it, the frame
+range and its modifier settings) are hashed; every unique hash is baked once into a mesh of its
+own, and every agent with that hash is given that baked mesh datablock.
+
+Baked frames are also kept on disk as .npz files named by hash, in a
+size-bounded store evicting the least recently used first, so later
+sessions and shots reuse them instead of baking again.
+"""
+## ======================================================================
+
+## bump when the hashed inputs or the cache layout change
+CACHE_VERSION = 3
+
+DEFAULT_CACHE_DIR = os.path.join( os.path.expanduser('~'), '.cache', 'crowd_tools' )
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+KEY_PROPERTY = 'crowd_cache_key'
+
+_HASHED_PROPERTY_TYPES = { 'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM' }
+
+_HASHED_STRIP_SETTINGS = ( 'frame_start', 'frame_end', 'action_frame_start', 'action_frame_end',
+	'scale', 'repeat', 'blend_type', 'extrapolation', 'influence', 'use_animated_influence',
+	'use_animated_time', 'blend_in', 'blend_out', 'use_reverse', 'mute' )
+
+
+class CrowdCacheStore:
+	"""
+	On-disk cache of baked vertex positions keyed by input hash,
+	bounded to max_bytes with least recently used eviction.
+
+	:param root:      The cache directory. Defaults to $CROWD_TOOLS_CACHE_DIR,
+					or ~/.cache/crowd_tools.
+	:param max_bytes: The most the store may hold on disk.
+	"""
+
+	def __init__( self, root:Optional[str]=None, max_bytes:int=DEFAULT_MAX_BYTES ):
+		self.root = root or os.environ.get( 'CROWD_TOOLS_CACHE_DIR', DEFAULT_CACHE_DIR )
+		self.max_bytes = max_bytes
+
+		os.makedirs( self.root, exist_ok=True )
+
+	def path( self, key:str ) -> str:
+		return os.path.join( self.root, key + '.npz' )
+
+	def load( self, key:str ) -> Optional[Tuple[int, np.ndarray]]:
+		"""
+		:returns: ( start_frame, positions ) for the key, or None on a miss.
+		"""
+
+		path = self.path( key )
+		if not os.path.exists( path ):
+			return None
+
+		## reading counts as a use for the eviction order
+		os.utime( path, None )
+
+		with np.load( path ) as data:
+			return int( data['start_frame'] ), data['positions']
+
+	def save( self, key:str, start_frame:int, positions:np.ndarray ):
+		"""
+		Stores the baked positions for a key, then evicts down to max_bytes.
+		"""
+
+		path = self.path( key )
+		temp_path = path + '.tmp.npz'
+
+		## write aside and rename, so a killed bake never leaves a torn cache
+		np.savez( temp_path, start_frame=start_frame, positions=np.asarray(positions, dtype=np.float32) )
+		os.replace( temp_path, path )
+
+		self.evict( keep=key )
+
+	def evict( self, keep:Optional[str]=None ) -> int:
+		"""
+		Removes the least recently used caches until the store fits in max_bytes.
+
+		:param keep: A key never to evict, usually the one just saved.
+		:returns: The number of caches removed.
+		"""
+
+		entries = []
+		for name in os.listdir( self.root ):
+			if not name.endswith( '.npz' ) or name.endswith( '.tmp.npz' ):
+				continue
+
+			stat = os.stat( os.path.join(self.root, name) )
+			entries.append( (stat.st_mtime, stat.st_size, name) )
+
+		total = sum( x[1] for x in entries )
+		removed = 0
+
+		for mtime, size, name in sorted( entries ):
+			if total <= self.max_bytes:
+				break
+
+			if keep and name == keep + '.npz':
+				continue
+
+			os.remove( os.path.join(self.root, name) )
+			total -= size
+			removed += 1
+
+		return removed
+
+
+## ======================================================================
+def _hash_array( digest, values:np.ndarray ):
+	digest.update( np.ascontiguousarray(values).tobytes() )
+
+
+def _hash_collection( digest, collection, attribute:str, dtype, width:int=1 ):
+	values = np.empty( len(collection) * width, dtype=dtype )
+	profiling.foreach_get( collection, attribute, values )
+	_hash_array( digest, values )
+
+
+def _hash_settings( digest, struct ):
+	"""
+	Hashes every plain editable RNA property of a struct, such as a modifier,
+	except the show_* toggles. Object pointers are hashed by their motion
+	(see _hash_motion).
+	"""
+
+	for prop in struct.bl_rna.properties:
+		## visibility toggles are flipped by the bake itself
+		if prop.is_readonly or prop.identifier == 'rna_type' or prop.identifier.startswith('show_'):
+			continue
+
+		value = getattr( struct, prop.identifier )
+
+		if prop.type in _HASHED_PROPERTY_TYPES:
+			if isinstance( value, set ):
+				value = tuple( sorted(value) )
+			elif getattr( prop, 'is_array', False ):
+				value = tuple( value )
+			digest.update( '{}={!r};'.format(prop.identifier, value).encode() )
+
+		elif prop.type == 'POINTER' and isinstance( value, bpy.types.Object ):
+			digest.update( '{}->'.format(prop.identifier).encode() )
+			_hash_motion( digest, value, struct.id_data )
+
+
+def _hash_action( digest, action:Optional[bpy.types.Action] ):
+	if action is None:
+		digest.update( b'action:None;' )
+		return
+
+	_hash_fcurves( digest, action.fcurves )
+
+
+def _hash_fcurves( digest, fcurves ):
+	for fcurve in fcurves:
+		digest.update( '{}[{}]{};'.format(fcurve.data_path, fcurve.array_index, fcurve.mute).encode() )
+		_hash_collection( digest, fcurve.keyframe_points, 'co', np.float32, 2 )
+		_hash_collection( digest, fcurve.keyframe_points, 'handle_left', np.float32, 2 )
+		_hash_collection( digest, fcurve.keyframe_points, 'handle_right', np.float32, 2 )
+		digest.update( ''.join( x.interpolation for x in fcurve.keyframe_points ).encode() )
+
+
+def _hash_strips( digest, strips ):
+	for strip in strips:
+		values = tuple( getattr(strip, x) for x in _HASHED_STRIP_SETTINGS )
+		digest.update( 'strip:{}:{!r};'.format(strip.type, values).encode() )
+		_hash_action( digest, strip.action )
+
+		## animated influence and time
+		for fcurve in strip.fcurves:
+			digest.update( '{};'.format(fcurve.data_path).encode() )
+			_hash_collection( digest, fcurve.keyframe_points, 'co', np.float32, 2 )
+
+		## meta strips
+		_hash_strips( digest, strip.strips )
+
+
+def _hash_animation( digest, ob:bpy.types.Object ):
+	"""
+	Hashes everything animating an object: its active action, how that
+	blends, and its NLA tracks. Drivers can read anything in the file, so
+	an object with drivers is hashed under its own name and never shares
+	a cache with another one.
+	"""
+
+	anim = ob.animation_data
+	if anim is None:
+		digest.update( b'animation:None;' )
+		return
+
+	_hash_action( digest, anim.action )
+	digest.update( 'action:{}:{}:{!r};'.format(anim.action_blend_type,
+		anim.action_extrapolation, anim.action_influence).encode() )
+
+	for track in anim.nla_tracks:
+		digest.update( 'track:{}:{}:{};'.format(track.name, track.mute, track.is_solo).encode() )
+		_hash_strips( digest, track.strips )
+
+	if len( anim.drivers ):
+		digest.update( 'drivers:{};'.format(ob.name).encode() )
+
+
+def _hash_motion( digest, ob:bpy.types.Object, relative_to:bpy.types.Object ):
+	"""
+	Hashes what makes an object move a deformed mesh: its animation (see
+	_hash_animation) and its placement relative to the mesh object.
+	"""
+
+	_hash_animation( digest, ob )
+
+	relative = relative_to.matrix_world.inverted() * ob.matrix_world
+	_hash_array( digest, np.array(relative, dtype=np.float32) )
+
+
+def _hash_shape_keys( digest, mesh:bpy.types.Mesh ):
+	"""
+	Hashes a mesh's own shape keys and their animation, leaving out what
+	baking adds: the cache keys and their F-curves, the Basis (a copy of
+	the vertices) and the mute flags finish_cache sets.
+	"""
+
+	shape_keys = mesh.shape_keys
+	if shape_keys is None:
+		return
+
+	for key in list( shape_keys.key_blocks )[1:]:
+		if key.name.startswith( 'cache__' ):
+			continue
+
+		digest.update( 'shape:{}:{}:{!r}:{}:{!r}:{!r}:{};'.format(key.name, key.relative_key.name, key.value,
+			key.vertex_group, key.slider_min, key.slider_max, key.interpolation).encode() )
+		_hash_collection( digest, key.data, 'co', np.float32, 3 )
+
+	digest.update( 'use_relative:{};'.format(shape_keys.use_relative).encode() )
+
+	anim = shape_keys.animation_data
+	if anim is None:
+		return
+
+	if anim.action:
+		_hash_fcurves( digest, [ x for x in anim.action.fcurves
+								if not x.data_path.startswith('key_blocks["cache__') ] )
+
+	if len( anim.drivers ):
+		digest.update( 'drivers:{};'.format(mesh.name).encode() )
+
+
+def _hash_mesh( digest, mesh:bpy.types.Mesh ):
+	_hash_collection( digest, mesh.vertices, 'co', np.float32, 3 )
+	_hash_collection( digest, mesh.loops, 'vertex_index', np.int32 )
+	_hash_collection( digest, mesh.polygons, 'loop_total', np.int32 )
+
+	## deform weights have no bulk accessor
+	weights = [ (v.index, g.group, round(g.weight, 6)) for v in mesh.vertices for g in v.groups ]
+	digest.update( repr(weights).encode() )
+
+	## agents given the same baked mesh also share its look
+	digest.update( repr([ x.name if x else None for x in mesh.materials ]).encode() )
+	_hash_collection( digest, mesh.polygons, 'material_index', np.int32 )
+
+	for layer in mesh.uv_layers:
+		digest.update( 'uv:{};'.format(layer.name).encode() )
+		_hash_collection( digest, layer.data, 'uv', np.float32, 2 )
+
+	_hash_shape_keys( digest, mesh )
+
+
+def agent_cache_key( ob:bpy.types.Object, start_frame:int, end_frame:int,
+		mesh_digests:Optional[Dict[int,bytes]]=None ) -> str:
+	"""
+	Hashes everything that goes into baking an agent.
+
+	:param ob: The agent mesh Object.
+	:param start_frame: The first frame of the bake, inclusive.
+	:param end_frame: The last frame of the bake, inclusive.
+	:param mesh_digests: Optional memo of mesh pointer -> mesh digest, so agents
+						sharing a mesh datablock only hash it once.
+	:returns: A hex digest.
+	"""
+
+	if mesh_digests is None:
+		mesh_digests = {}
+
+	pointer = ob.data.as_pointer()
+	if not pointer in mesh_digests:
+		mesh_digest = hashlib.sha1()
+		_hash_mesh( mesh_digest, ob.data )
+		mesh_digests[pointer] = mesh_digest.digest()
+
+	digest = hashlib.sha1()
+	digest.update( 'crowd_cache:{}:{}:{}:'.format(CACHE_VERSION, start_frame, end_frame).encode() )
+	digest.update( mesh_digests[pointer] )
+	digest.update( repr([ x.name for x in ob.vertex_groups ]).encode() )
+
+	_hash_motion( digest, ob, ob )
+
+	for mod in ob.modifiers:
+		digest.update( 'modifier:{}:{};'.format(mod.type, mod.name).encode() )
+		_hash_settings( digest, mod )
+
+	return digest.hexdigest()
+
+
+## ======================================================================
+def _assign_mesh( ob:bpy.types.Object, mesh:bpy.types.Mesh ):
+	"""
+	Gives an agent a baked mesh, keeping its own look: its materials move
+	to object-linked slots. The agent's old mesh is left to the user; only
+	a baked mesh this module made is removed once nothing uses it.
+	"""
+
+	old_mesh = ob.data
+	materials = [ x.material for x in ob.material_slots ]
+
+	ob.data = mesh
+
+	for slot, material in zip( ob.material_slots, materials ):
+		slot.link = 'OBJECT'
+		slot.material = material
+
+	if old_mesh.users == 0 and not old_mesh == mesh and KEY_PROPERTY in old_mesh:
+		bpy.data.meshes.remove( old_mesh )
+
+
+def _share_cache( ob:bpy.types.Object, source:bpy.types.Object ):
+	"""
+	Points an agent at a baked agent's mesh and matches its modifier state.
+	"""
+
+	_assign_mesh( ob, source.data )
+
+	for mod in ob.modifiers:
+		if mod.name in source.modifiers:
+			source_mod = source.modifiers[mod.name]
+			mod.show_render = source_mod.show_render
+			mod.show_viewport = source_mod.show_viewport
+		else:
+			mod.show_render = mod.show_viewport = False
+
+
+def bake_crowd( objects:List[bpy.types.Object], start_frame:Optional[int]=None,
+		end_frame:Optional[int]=None, store:Optional[CrowdCacheStore]=None ) -> Dict[str,bpy.types.Mesh]:
+	"""
+	Bakes a crowd, once per unique set of agent inputs. Agents with
+	matching inputs share one baked mesh datablock; bakes are reused from
+	the store on disk when possible and written to it otherwise.
+
+	:param objects: The agent mesh Objects.
+	:param start_frame: The first frame to bake, inclusive.
+	:param end_frame: The last frame to bake, inclusive.
+	:param store: The CrowdCacheStore to use. Pass False to bake in memory only;
+				defaults to a store in the default location.
+	:returns: dict of cache key -> baked Mesh.
+	"""
+
+	scene = bpy.context.scene
+
+	if start_frame is None:
+		start_frame = scene.frame_start
+
+	if end_frame is None:
+		end_frame = scene.frame_end
+
+	if store is None:
+		store = CrowdCacheStore()
+
+	mesh_digests = {}
+	groups = {}
+	for ob in objects:
+		key = agent_cache_key( ob, start_frame, end_frame, mesh_digests )
+		groups.setdefault( key, [] ).append( ob )
+
+	## meshes baked in an earlier call this session
+	baked = { x[KEY_PROPERTY]: x for x in bpy.data.meshes if KEY_PROPERTY in x }
+
+	result = {}
+	for key, agents in groups.items():
+		leader = agents[0]
+
+		if key in baked:
+			source_mesh = baked[key]
+			profiling.log( 'Reusing baked mesh "{}" for {} agents.'.format(source_mesh.name, len(agents)) )
+			followers = agents
+
+			## any agent already on the baked mesh carries the right modifier state
+			users = [ x for x in bpy.data.objects if x.data == source_mesh ]
+			if users:
+				leader = users[0]
+			else:
+				leader = agents[0]
+				_assign_mesh( leader, source_mesh )
+				cache_sculpt.finish_cache( leader )
+				followers = agents[1:]
+		else:
+			## agents usually share one body mesh; bake into a mesh of this group's own,
+			## or every group would overwrite the same cache keys
+			if leader.data.users > 1:
+				leader.data = leader.data.copy()
+				if KEY_PROPERTY in leader.data:
+					del leader.data[KEY_PROPERTY]
+
+			cached = store.load( key ) if store else None
+			if cached is not None:
+				profiling.log( 'Loading cache {} for {} agents.'.format(key, len(agents)) )
+				cache_sculpt.apply_cache_frames( leader, cached[0], cached[1] )
+			else:
+				profiling.log( 'Baking cache {} for {} agents.'.format(key, len(agents)) )
+				cache_sculpt.bake_to_shape_keys( leader, start_frame, end_frame )
+				if store:
+					store.save( key, start_frame, cache_sculpt.read_cache_frames(leader, start_frame, end_frame) )
+
+			leader.data[KEY_PROPERTY] = key
+			followers = agents[1:]
+
+		for ob in followers:
+			if not ob == leader:
+				_share_cache( ob, leader )
+
+		result[key] = leader.data
+
+	return result
@@ -0,0 +1,186 @@
+from typing import Optional
+
+import bpy
+import numpy as np
+
+from . import cache_sculpt, hair_key_cache, profiling
+from .core import write_pc2, read_pc2_header, cycle_frame
+
+
+## ======================================================================
+"""
+Shared Cycle Playback
+
+Cache shape keys are keyed on absolute frames, so every agent playing the
+same walk or idle with a different start needs a bake of its own. Here a
+cycle is baked once to a PC2 point cache and each agent plays it through
+a Mesh Cache modifier, carrying only an offset, a speed and a loop flag.
+A frame change handler maps scene time to a cycle frame per agent.
+"""
+## ======================================================================
+
+MODIFIER_NAME = 'crowd_cycle'
+
+OFFSET_PROPERTY = 'crowd_cycle_offset'
+SPEED_PROPERTY  = 'crowd_cycle_speed'
+LOOP_PROPERTY   = 'crowd_cycle_loop'
+LENGTH_PROPERTY = 'crowd_cycle_length'
+
+_cycle_agents = set()
+
+
+## ======================================================================
+def bake_cycle( ob:bpy.types.Object, filepath:str, start_frame:Optional[int]=None,
+		end_frame:Optional[int]=None ) -> int:
+	"""
+	Steps through one cycle of the object's animation and writes the
+	deformed mesh to a PC2 point cache, followed by a copy of the first
+	frame for looping playback to blend back into (see core.cycle_frame).
+
+	:param ob: The mesh Object playing the cycle.
+	:param filepath: The .pc2 file to write.
+	:param start_frame: The first frame of the cycle, inclusive.
+	:param end_frame: The last frame of the cycle, inclusive.
+	:returns: The number of frames baked.
+	"""
+
+	scene = bpy.context.scene
+	wm    = bpy.context.window_manager
+
+	if start_frame is None:
+		start_frame = scene.frame_start
+
+	if end_frame is None:
+		end_frame = scene.frame_end
+
+	if start_frame > end_frame:
+		return 0
+
+	## the cache has to match the base mesh vertex for vertex
+	disabled = cache_sculpt.disable_modifiers( ob, {'SUBSURF', 'MESH_CACHE'} )
+
+	frames = []
+	wm.progress_begin( start_frame, end_frame+1 )
+	for frame in range( start_frame, end_frame+1 ):
+		wm.progress_update( frame )
+		frames.append( cache_sculpt.evaluate_frame(ob, frame) )
+	wm.progress_end()
+
+	cache_sculpt.restore_modifiers( ob, disabled )
+
+	write_pc2( filepath, np.stack(frames + frames[:1]), start_frame=start_frame )
+
+	profiling.log( 'Baked {} cycle frames of "{}" to "{}".'.format(len(frames), ob.name, filepath) )
+	return len( frames )
+
+
+## ======================================================================
+def attach_cycle( ob:bpy.types.Object, filepath:str, offset:float=0.0, speed:float=1.0,
+		loop:bool=True ) -> bpy.types.Modifier:
+	"""
+	Makes an agent play a shared cycle cache. The agent's armature
+	deformation is turned off, since the cache already holds it.
+
+	:param ob: The agent mesh Object.
+	:param filepath: The .pc2 cycle written by bake_cycle, ending on a copy of its first frame.
+	:param offset: The scene frame on which the agent starts the cycle.
+	:param speed: Cycle frames played per scene frame.
+	:param loop: Wrap around at the end of the cycle instead of holding the last frame.
+	:returns: The Mesh Cache modifier.
+	:raises: ValueError if the cache does not match the mesh, RuntimeError if
+			the Mesh Cache modifier can't be moved to the top of the stack.
+	"""
+
+	header = read_pc2_header( bpy.path.abspath(filepath) )
+	if not header['vertex_count'] == len( ob.data.vertices ):
+		raise ValueError( 'attach_cycle: "{}" has {} vertices, "{}" has {}.'.format(
+			filepath, header['vertex_count'], ob.name, len(ob.data.vertices)) )
+
+	if header['frame_count'] < 2:
+		raise ValueError( 'attach_cycle: "{}" has no copy of its first frame to loop back to.'.format(filepath) )
+
+	## the last sample only closes the loop
+	length = header['frame_count'] - 1
+
+	mod = ob.modifiers.get( MODIFIER_NAME )
+	if mod is None:
+		mod = ob.modifiers.new( MODIFIER_NAME, 'MESH_CACHE' )
+
+	mod.cache_format = 'PC2'
+	mod.filepath = filepath
+	mod.play_mode = 'CUSTOM'
+	mod.time_mode = 'FRAME'
+	mod.interpolation = 'LINEAR'
+	mod.deform_mode = 'OVERWRITE'
+
+	## the cache replaces the base vertices, so it has to come before
+	## anything that changes the vertex count
+	override = { 'object': ob, 'active_object': ob }
+	moves = [ x.name for x in ob.modifiers ].index( mod.name )
+	for _ in range( moves ):
+		if not bpy.ops.object.modifier_move_up( override, modifier=mod.name ) == {'FINISHED'}:
+			raise RuntimeError( 'attach_cycle: Could not move "{}" to the top of the stack on "{}".'.format(
+				mod.name, ob.name) )
+
+	for other in ob.modifiers:
+		if other.type == 'ARMATURE':
+			other.show_render = other.show_viewport = False
+
+	ob[OFFSET_PROPERTY] = float( offset )
+	ob[SPEED_PROPERTY]  = float( speed )
+	ob[LOOP_PROPERTY]   = bool( loop )
+	ob[LENGTH_PROPERTY] = length
+
+	_cycle_agents.add( ob.name )
+
+	scene = bpy.context.scene
+	mod.eval_frame = cycle_frame( scene.frame_current, offset, speed, length, loop )
+
+	return mod
+
+
+def detach_cycle( ob:bpy.types.Object ):
+	"""
+	Removes an agent's shared cycle playback.
+	"""
+
+	_cycle_agents.discard( ob.name )
+
+	mod = ob.modifiers.get( MODIFIER_NAME )
+	if mod is not None:
+		ob.modifiers.remove( mod )
+
+	for name in OFFSET_PROPERTY, SPEED_PROPERTY, LOOP_PROPERTY, LENGTH_PROPERTY:
+		if name in ob:
+			del ob[name]
+
+
+def _cycle_frame_change( scene ):
+	if not _cycle_agents:
+		return
+
+	frame = scene.frame_current + scene.frame_subframe
+
+	for name in list( _cycle_agents ):
+		ob = bpy.data.objects.get( name )
+		mod = ob.modifiers.get( MODIFIER_NAME ) if ob else None
+		if mod is None:
+			_cycle_agents.discard( name )
+			continue
+
+		mod.eval_frame = cycle_frame( frame, ob[OFFSET_PROPERTY], ob[SPEED_PROPERTY],
+							ob[LENGTH_PROPERTY], bool(ob[LOOP_PROPERTY]) )
+
+
+def _reload_cycle_agents( *args ):
+	"""
+	Finds the agents playing shared cycles in a freshly loaded file.
+	"""
+
+	_cycle_agents.clear()
+	_cycle_agents.update( x.name for x in bpy.data.objects
+							if LENGTH_PROPERTY in x and MODIFIER_NAME in x.modifiers )
+
+
+hair_key_cache.install_handler( bpy.app.handlers.frame_change_pre, _cycle_frame_change )
+hair_key_cache.install_handler( bpy.app.handlers.load_post, _reload_cycle_agents )
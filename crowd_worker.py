@@ -0,0 +1,429 @@
+"""
+Warm Blender worker for small crowd jobs.
+
+A short per-agent bake spends more time starting Blender, registering
+add-ons, importing crowd_tools and loading the .blend than baking. A
+worker pays that once: it stays up in the background, keeps crowd_tools
+imported and the last .blend loaded, and serves requests over a local
+socket.
+
+Start a worker by hand:
+
+	blender -b --python crowd_worker.py -- --port 7300
+
+or let a WorkerPool start and feed several from a normal Python interpreter:
+
+	with WorkerPool( size=4 ) as pool:
+		futures = [ pool.submit('bake', blend=path, object=name, save=out)
+					for name, out in agents ]
+
+Requests and responses are single lines of JSON. Every request has a
+'command'; most also name a 'blend' to run in, and may give 'save' to
+write the result to a new .blend. Responses carry 'ok', the command's
+'result' (or 'error') and 'timings' in seconds.
+
+The .blend is only reloaded when the requested file differs from the
+loaded one, has changed on disk, or has unsaved changes from an earlier
+request. Pass keep_state=True to run on top of those changes instead.
+"""
+
+import os, sys, json, time, socket, argparse, subprocess, threading, queue
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, List
+
+try:
+	import bpy
+except ImportError:
+	bpy = None
+
+if __package__:
+	from .script_support import import_tools, script_argv
+else:
+	sys.path.insert( 0, os.path.dirname(os.path.abspath(__file__)) )
+	from script_support import import_tools, script_argv
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7300
+
+## printed by the worker once it is listening, so a pool can find its port
+READY_MARKER = 'CROWD_WORKER_PORT'
+
+
+## ======================================================================
+"""
+Worker (runs inside Blender)
+"""
+## ======================================================================
+
+_loaded_blend = {}
+
+
+def _open_blend( filepath:Optional[str], keep_state:bool=False ) -> bool:
+	"""
+	Makes filepath the open .blend, unless it already is and is unchanged.
+
+	:returns: True if the file had to be (re)loaded.
+	"""
+
+	if not filepath:
+		return False
+
+	filepath = os.path.abspath( filepath )
+	mtime = os.path.getmtime( filepath )
+
+	if ( _loaded_blend.get('filepath') == filepath and _loaded_blend.get('mtime') == mtime
+			and (keep_state or not bpy.data.is_dirty) ):
+		return False
+
+	bpy.ops.wm.open_mainfile( filepath=filepath )
+	_loaded_blend.update( filepath=filepath, mtime=mtime )
+
+	## every Scene and Object of the previous file is gone now; nothing may
+	## hold on to them between requests (the load_post handlers also do this)
+	import_tools( 'hair_rig_convert' ).invalidate_particle_registry()
+	return True
+
+
+def _frames( request:dict ):
+	scene = bpy.context.scene
+	return request.get( 'frames', (scene.frame_start, scene.frame_end) )
+
+
+def _select( names:Optional[List[str]] ):
+	if not names:
+		return
+
+	for ob in bpy.context.scene.objects:
+		ob.select = ob.name in names
+
+
+def _command_bake( request:dict ):
+	cache_sculpt = import_tools( 'cache_sculpt' )
+	ob = bpy.data.objects[ request['object'] ]
+
+	## fix keys survive; re-baking without clearing overwrites the cache keys in place
+	if request.get( 'clear' ):
+		cache_sculpt.reset_cache( ob )
+
+	start_frame, end_frame = _frames( request )
+	return cache_sculpt.bake_to_shape_keys( ob, start_frame, end_frame,
+				export_path=request.get('export_path'), finalize=request.get('finalize', True) )
+
+
+def _command_hair_bake( request:dict ):
+	hair_key_cache = import_tools( 'hair_key_cache' )
+	ob = bpy.data.objects[ request['object'] ]
+	system = ob.particle_systems[ request['system'] ]
+
+	start_frame, end_frame = _frames( request )
+	cache = hair_key_cache.bake_hair_cache( ob, system, start_frame, end_frame )
+
+	if request.get( 'remove_drivers' ):
+		hair_key_cache.remove_hair_drivers( ob, system )
+
+	hair_key_cache.register_hair_cache( cache, request.get('cache') )
+	return len( cache.positions )
+
+
+def _command_assign( request:dict ):
+	look_assigner = import_tools( 'look_assigner' )
+
+	_select( request.get('objects') )
+	look_assigner.do_assign( request['library'] )
+	return [ x.name for x in bpy.context.selected_objects ]
+
+
+def _command_curve_conversion( request:dict ):
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+
+	curves = hair_rig_convert.do_curve_conversion( request['system'],
+				target_count=request.get('target_count'), tolerance=request.get('tolerance') )
+	return [ x.name for x in curves ]
+
+
+def _command_armature_conversion( request:dict ):
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+
+	base_ob = bpy.data.objects[ request['object'] ]
+	chains = hair_rig_convert.do_armature_conversion( base_ob, request['system'],
+				use_drivers=request.get('use_drivers', True),
+				target_count=request.get('target_count'), tolerance=request.get('tolerance') )
+
+	return {
+		'rig': chains[0][0].id_data.name if chains else 'rig.{}.000'.format( base_ob.name ),
+		'chains': len( chains ),
+		'bones': sum( len(x) for x in chains ),
+	}
+
+
+def _command_bake_conversion( request:dict ):
+	hair_rig_convert = import_tools( 'hair_rig_convert' )
+
+	start_frame, end_frame = _frames( request )
+	cache = hair_rig_convert.do_bake_conversion( request['system'], start_frame, end_frame,
+				filepath=request.get('cache') )
+	return len( cache.positions )
+
+
+_COMMANDS = {
+	'bake': _command_bake,
+	'hair_bake': _command_hair_bake,
+	'assign': _command_assign,
+	'curve_conversion': _command_curve_conversion,
+	'armature_conversion': _command_armature_conversion,
+	'bake_conversion': _command_bake_conversion,
+}
+
+
+def handle_request( request:dict ) -> dict:
+	"""
+	Runs one request and times its stages.
+
+	:returns: The response dict.
+	"""
+
+	command = request.get( 'command' )
+	timings = {}
+	start = time.perf_counter()
+
+	try:
+		if command == 'ping':
+			result = { 'pid': os.getpid(), 'blend': bpy.data.filepath }
+
+		elif command in _COMMANDS:
+			reloaded = _open_blend( request.get('blend'), request.get('keep_state', False) )
+			timings['load'] = time.perf_counter() - start
+			timings['reloaded'] = reloaded
+
+			run_start = time.perf_counter()
+			result = _COMMANDS[command]( request )
+			timings['run'] = time.perf_counter() - run_start
+
+			if request.get( 'save' ):
+				save_start = time.perf_counter()
+				## copy keeps the loaded file dirty, so the next request reloads it
+				bpy.ops.wm.save_as_mainfile( filepath=request['save'], copy=True )
+				timings['save'] = time.perf_counter() - save_start
+
+		else:
+			raise ValueError( 'Unknown command "{}".'.format(command) )
+
+	except Exception as e:
+		import traceback
+		traceback.print_exc()
+		timings['total'] = time.perf_counter() - start
+		return { 'ok': False, 'error': '{}: {}'.format(type(e).__name__, e), 'timings': timings }
+
+	timings['total'] = time.perf_counter() - start
+
+	## one report line per request, rather than one for the whole worker
+	profiling = import_tools( 'profiling' )
+	if profiling.is_enabled():
+		profiling.write_report( command=command, blend=request.get('blend'), timings=timings )
+		profiling.reset()
+
+	return { 'ok': True, 'result': result, 'timings': timings }
+
+
+def serve( host:str=DEFAULT_HOST, port:int=DEFAULT_PORT ):
+	"""
+	Serves requests until a 'shutdown' command. Blender is single
+	threaded, so connections are served one at a time.
+	"""
+
+	## pay the import cost up front; the modules only look up bpy.context
+	## when called, so they survive the files being swapped underneath them
+	for name in 'cache_sculpt', 'hair_key_cache', 'hair_rig_convert', 'look_assigner':
+		import_tools( name )
+
+	server = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+	server.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+	server.bind( (host, port) )
+	server.listen( 1 )
+
+	print( '{} {}'.format(READY_MARKER, server.getsockname()[1]) )
+	sys.stdout.flush()
+
+	running = True
+	while running:
+		connection, address = server.accept()
+		with connection, connection.makefile( 'rwb' ) as stream:
+			for line in stream:
+				if not line.strip():
+					continue
+
+				try:
+					request = json.loads( line.decode() )
+				except ValueError as e:
+					response = { 'ok': False, 'error': 'Bad request: {}'.format(e) }
+				else:
+					if request.get( 'command' ) == 'shutdown':
+						running = False
+						response = { 'ok': True, 'result': None }
+					else:
+						response = handle_request( request )
+
+				stream.write( (json.dumps(response) + '\n').encode() )
+				stream.flush()
+				sys.stdout.flush()
+
+				if not running:
+					break
+
+	server.close()
+
+
+## ======================================================================
+"""
+Client
+"""
+## ======================================================================
+
+class WorkerClient:
+	"""
+	A connection to one running worker.
+	"""
+
+	def __init__( self, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, timeout:Optional[float]=None ):
+		self.connection = socket.create_connection( (host, port), timeout=timeout )
+		self.stream = self.connection.makefile( 'rwb' )
+
+	def request( self, command:str, **params ) -> dict:
+		"""
+		Sends a request and waits for its response.
+
+		:returns: The response dict, with 'result' and 'timings'.
+		:raises: RuntimeError if the worker reports an error or hangs up.
+		"""
+
+		params['command'] = command
+		self.stream.write( (json.dumps(params) + '\n').encode() )
+		self.stream.flush()
+
+		line = self.stream.readline()
+		if not line:
+			raise RuntimeError( 'WorkerClient: Worker closed the connection during "{}".'.format(command) )
+
+		response = json.loads( line.decode() )
+		if not response['ok']:
+			raise RuntimeError( 'WorkerClient: "{}" failed: {}'.format(command, response['error']) )
+
+		return response
+
+	def close( self ):
+		self.stream.close()
+		self.connection.close()
+
+
+class WorkerPool:
+	"""
+	Starts a number of background Blender workers and hands requests to
+	whichever is idle.
+
+	:param size:    The number of workers.
+	:param blender: The Blender executable.
+	:param log_dir: If given, each worker's output goes to worker<N>.log there.
+	"""
+
+	def __init__( self, size:int=1, blender:str='blender', host:str=DEFAULT_HOST,
+			log_dir:Optional[str]=None ):
+		self.processes = []
+		self.clients = queue.Queue()
+		self.executor = ThreadPoolExecutor( max_workers=size )
+
+		script = os.path.abspath( __file__ )
+		for index in range( size ):
+			command = [ blender, '-b', '--python', script, '--', '--host', host, '--port', '0' ]
+			process = subprocess.Popen( command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT )
+			self.processes.append( process )
+
+			log_path = os.path.join( log_dir, 'worker{}.log'.format(index) ) if log_dir else os.devnull
+			port = self._wait_ready( process, open(log_path, 'ab') )
+			self.clients.put( WorkerClient(host, port) )
+
+	def _wait_ready( self, process, log ) -> int:
+		"""
+		Reads a new worker's output up to its port, then keeps draining it
+		to the log so the pipe never fills up.
+		"""
+
+		for line in process.stdout:
+			log.write( line )
+			if line.startswith( READY_MARKER.encode() ):
+				port = int( line.split()[1] )
+				break
+		else:
+			raise RuntimeError( 'WorkerPool: Worker exited with {} before it was ready.'.format(process.wait()) )
+
+		def drain():
+			with log:
+				for line in process.stdout:
+					log.write( line )
+
+		threading.Thread( target=drain, daemon=True ).start()
+		return port
+
+	def _run( self, command:str, params:dict ) -> dict:
+		client = self.clients.get()
+		try:
+			return client.request( command, **params )
+		finally:
+			self.clients.put( client )
+
+	def submit( self, command:str, **params ) -> Future:
+		"""
+		Queues a request for the next idle worker.
+
+		:returns: A Future of the response dict.
+		"""
+
+		return self.executor.submit( self._run, command, params )
+
+	def close( self ):
+		"""
+		Waits for queued requests, then shuts every worker down.
+		"""
+
+		self.executor.shutdown( wait=True )
+
+		while not self.clients.empty():
+			client = self.clients.get()
+			try:
+				client.request( 'shutdown' )
+			except (RuntimeError, OSError):
+				pass
+			client.close()
+
+		for process in self.processes:
+			process.wait()
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		self.close()
+
+
+## ======================================================================
+def main( argv=None ):
+	if argv is None:
+		argv = script_argv()
+
+	parser = argparse.ArgumentParser( description='Serve crowd_tools requests from a warm Blender.' )
+	parser.add_argument( '--host', default=DEFAULT_HOST )
+	parser.add_argument( '--port', type=int, default=DEFAULT_PORT, help='0 picks a free port.' )
+	parser.add_argument( '--profile', metavar='REPORT', help='Append stage timings of every request to this .jsonl file.' )
+	args = parser.parse_args( argv )
+
+	if bpy is None:
+		parser.error( 'the worker has to run inside Blender: blender -b --python crowd_worker.py -- ...' )
+
+	if args.profile:
+		import_tools( 'profiling' ).enable( args.profile )
+
+	serve( args.host, args.port )
+
+
+if __name__ == '__main__':
+	main()
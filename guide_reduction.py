@@ -0,0 +1,335 @@
+import math
+from collections import namedtuple
+from typing import Optional, List, Tuple
+
+import numpy as np
+
+
+## ======================================================================
+"""
+Guide Reduction
+
+Rig cost scales with the number of guide hairs and hair keys: every
+guide gets a curve or bone chain and three drivers per hair key. These
+kernels cluster a system's guides so only a representative per cluster
+needs to be rigged, and trim each rigged guide down to the keys it
+actually needs.
+
+Everything here works on plain arrays of hair key positions shaped
+( particles, keys, 3 ) and does not touch bpy.
+"""
+## ======================================================================
+
+GuideClusters = namedtuple( 'GuideClusters', ['representatives', 'labels', 'rest'] )
+
+
+def guide_features( positions:np.ndarray, shape_weight:float=1.0 ) -> np.ndarray:
+	"""
+	Builds a clustering feature vector per guide: its root position
+	followed by the root-relative key positions.
+
+	:param positions:    Hair key positions shaped ( particles, keys, 3 ).
+	:param shape_weight: How much the shape counts against the root position.
+						The shape part is scaled by 1/sqrt(keys) so the weight
+						does not depend on the key count.
+	:returns: float64 array shaped ( particles, 3 + keys * 3 ).
+	"""
+
+	positions = np.asarray( positions, dtype=np.float64 )
+	particle_count, key_count = positions.shape[:2]
+
+	roots = positions[:, 0]
+	shape = ( positions - roots[:, np.newaxis] ).reshape( particle_count, -1 )
+	shape *= shape_weight / math.sqrt( key_count )
+
+	return np.concatenate( [roots, shape], axis=1 )
+
+
+def kmeans( features:np.ndarray, count:int, iterations:int=20,
+		seed:int=0 ) -> Tuple[np.ndarray, np.ndarray]:
+	"""
+	Lloyd's k-means with k-means++ seeding, vectorized over all points.
+
+	:param features:   Points shaped ( n, dimensions ).
+	:param count:      The number of clusters.
+	:param iterations: The maximum number of assignment/update rounds.
+	:param seed:       Seed for the k-means++ picks, so results are repeatable.
+	:returns: ( centroids shaped ( count, dimensions ), labels shaped ( n, ) ).
+	"""
+
+	features = np.asarray( features, dtype=np.float64 )
+	point_count, dimensions = features.shape
+	rng = np.random.RandomState( seed )
+
+	## k-means++: each new seed is picked with probability
+	## proportional to its squared distance to the closest seed so far
+	centroids = np.empty( (count, dimensions) )
+	centroids[0] = features[ rng.randint(point_count) ]
+	closest = ( (features - centroids[0]) ** 2 ).sum( axis=1 )
+
+	for index in range( 1, count ):
+		total = closest.sum()
+		if total > 0.0:
+			pick = np.searchsorted( np.cumsum(closest), rng.random_sample() * total )
+			pick = min( pick, point_count - 1 )
+		else:
+			pick = rng.randint( point_count )
+
+		centroids[index] = features[pick]
+		closest = np.minimum( closest, ((features - centroids[index]) ** 2).sum(axis=1) )
+
+	squared = ( features ** 2 ).sum( axis=1 )[:, np.newaxis]
+	labels = None
+
+	for _ in range( iterations ):
+		distances = squared - 2.0 * features.dot( centroids.T ) + ( centroids ** 2 ).sum( axis=1 )
+		new_labels = distances.argmin( axis=1 )
+
+		if labels is not None and np.array_equal( new_labels, labels ):
+			break
+		labels = new_labels
+
+		counts = np.bincount( labels, minlength=count )
+		filled = counts > 0
+		for dimension in range( dimensions ):
+			sums = np.bincount( labels, weights=features[:, dimension], minlength=count )
+			centroids[filled, dimension] = sums[filled] / counts[filled]
+
+	return centroids, labels
+
+
+def cluster_guides( positions:np.ndarray, target_count:int, shape_weight:float=1.0,
+		iterations:int=20, seed:int=0 ) -> GuideClusters:
+	"""
+	Clusters guide hairs by root position and shape down to at most
+	target_count representatives. The representative of a cluster is
+	the member guide closest to the cluster centroid.
+
+	:param positions:    Rest hair key positions shaped ( particles, keys, 3 ).
+	:param target_count: The number of guides to keep.
+	:param shape_weight: See guide_features.
+	:param iterations:   See kmeans.
+	:param seed:         See kmeans.
+	:returns: GuideClusters( representatives, labels, rest ), where representatives
+			holds the sorted particle indices to rig, labels maps each particle
+			to its representative's position in that array and rest is a float32
+			copy of positions.
+	:raises: ValueError
+	"""
+
+	positions = np.asarray( positions, dtype=np.float32 )
+	particle_count = len( positions )
+
+	if target_count < 1:
+		raise ValueError( 'cluster_guides: target count must be at least 1, not {}.'.format(target_count) )
+
+	if target_count >= particle_count:
+		indices = np.arange( particle_count )
+		return GuideClusters( indices, indices.copy(), positions.copy() )
+
+	features = guide_features( positions, shape_weight )
+	centroids, labels = kmeans( features, target_count, iterations, seed )
+
+	## the member nearest its own centroid represents the cluster
+	distances = ( (features - centroids[labels]) ** 2 ).sum( axis=1 )
+	order = np.lexsort( (distances, labels) )
+	sorted_labels = labels[order]
+	first = np.concatenate( [[True], sorted_labels[1:] != sorted_labels[:-1]] )
+
+	representatives = order[first]
+	cluster_ids = sorted_labels[first]
+
+	## rig the representatives in particle order; empty clusters drop out
+	permutation = np.argsort( representatives )
+	lookup = np.full( target_count, -1, dtype=np.int64 )
+	lookup[ cluster_ids[permutation] ] = np.arange( len(permutation) )
+
+	return GuideClusters( representatives[permutation], lookup[labels], positions.copy() )
+
+
+def follow_representatives( positions:np.ndarray, clusters:GuideClusters,
+		indices:Optional[np.ndarray]=None ) -> np.ndarray:
+	"""
+	Moves guides along with their representative: each guide gets its
+	rest pose plus its representative's displacement from rest.
+
+	:param positions: Current positions of the representatives, shaped
+					( len(clusters.representatives), keys, 3 ).
+	:param clusters:  The GuideClusters from cluster_guides.
+	:param indices:   The particles to compute. Defaults to every particle.
+	:returns: float32 array shaped ( len(indices), keys, 3 ).
+	"""
+
+	labels = clusters.labels if indices is None else clusters.labels[indices]
+	rest   = clusters.rest   if indices is None else clusters.rest[indices]
+
+	displacement = np.asarray( positions, dtype=np.float32 ) - clusters.rest[clusters.representatives]
+	return rest + displacement[labels]
+
+
+def follower_indices( clusters:GuideClusters ) -> np.ndarray:
+	"""
+	The particle indices that are not representatives.
+	"""
+
+	mask = np.ones( len(clusters.labels), dtype=bool )
+	mask[clusters.representatives] = False
+	return np.flatnonzero( mask )
+
+
+## ======================================================================
+"""
+Key Resampling
+
+Every hair key costs a bone or curve point plus three drivers, but most
+guides are close to straight over long runs. Resampling keeps, per guide,
+the fewest keys that reproduce every dropped key within a tolerance when
+interpolated by arc length; sharp bends can be kept outright. The dropped
+keys are filled back in from the kept ones after the rig is evaluated.
+"""
+## ======================================================================
+
+ResampledGuides = namedtuple( 'ResampledGuides', ['keep', 'lower', 'upper', 'weights'] )
+
+
+def arc_lengths( positions:np.ndarray ) -> np.ndarray:
+	"""
+	Cumulative arc length at every key, starting at 0.0 on the root.
+
+	:param positions: Hair key positions shaped ( particles, keys, 3 ).
+	:returns: float64 array shaped ( particles, keys ).
+	"""
+
+	positions = np.asarray( positions, dtype=np.float64 )
+	segments = np.linalg.norm( np.diff(positions, axis=1), axis=2 )
+
+	result = np.zeros( positions.shape[:2] )
+	np.cumsum( segments, axis=1, out=result[:, 1:] )
+	return result
+
+
+def turning_angles( positions:np.ndarray ) -> np.ndarray:
+	"""
+	The angle in radians between the incoming and outgoing segment at
+	every key; 0.0 at the root and tip.
+
+	:param positions: Hair key positions shaped ( particles, keys, 3 ).
+	:returns: float64 array shaped ( particles, keys ).
+	"""
+
+	positions = np.asarray( positions, dtype=np.float64 )
+	segments = np.diff( positions, axis=1 )
+	lengths = np.linalg.norm( segments, axis=2 )
+
+	incoming, outgoing = segments[:, :-1], segments[:, 1:]
+	scale = lengths[:, :-1] * lengths[:, 1:]
+	cosine = np.where( scale > 0.0,
+		(incoming * outgoing).sum( axis=2 ) / np.where(scale > 0.0, scale, 1.0), 1.0 )
+
+	result = np.zeros( positions.shape[:2] )
+	result[:, 1:-1] = np.arccos( np.clip(cosine, -1.0, 1.0) )
+	return result
+
+
+def _bracket_keys( keep:np.ndarray, lengths:np.ndarray ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+	"""
+	For every key, the nearest kept key at or before it, at or after it,
+	and its arc length blend between the two.
+	"""
+
+	key_count = keep.shape[1]
+	key_index = np.broadcast_to( np.arange(key_count), keep.shape )
+
+	lower = np.maximum.accumulate( np.where(keep, key_index, 0), axis=1 )
+	upper = np.minimum.accumulate( np.where(keep, key_index, key_count - 1)[:, ::-1], axis=1 )[:, ::-1]
+
+	rows = np.arange( len(keep) )[:, np.newaxis]
+	span = lengths[rows, upper] - lengths[rows, lower]
+	weights = np.where( span > 0.0,
+		(lengths - lengths[rows, lower]) / np.where(span > 0.0, span, 1.0), 0.0 )
+
+	return lower, upper, weights
+
+
+def resample_guides( positions:np.ndarray, tolerance:float,
+		angle_tolerance:Optional[float]=None ) -> ResampledGuides:
+	"""
+	Picks, for every guide at once, the fewest hair keys that reproduce
+	the others within tolerance. Starting from root and tip, the worst
+	reproduced key of every guide still out of tolerance is kept, until
+	none are.
+
+	:param positions:       Rest hair key positions shaped ( particles, keys, 3 ).
+	:param tolerance:       The largest allowed distance between a dropped key
+							and its interpolated position.
+	:param angle_tolerance: If given, keys that bend by more than this many
+							radians are always kept.
+	:returns: ResampledGuides( keep, lower, upper, weights ), all shaped
+			( particles, keys ): the kept key mask and, for every key, the
+			kept keys it is interpolated between and the blend factor.
+	"""
+
+	positions = np.asarray( positions, dtype=np.float64 )
+	particle_count, key_count = positions.shape[:2]
+	rows = np.arange( particle_count )
+
+	lengths = arc_lengths( positions )
+
+	keep = np.zeros( (particle_count, key_count), dtype=bool )
+	keep[:, 0] = keep[:, -1] = True
+
+	if angle_tolerance is not None:
+		keep |= turning_angles( positions ) > angle_tolerance
+
+	## every round keeps at least one more key per guide, so this ends
+	for _ in range( key_count ):
+		lower, upper, weights = _bracket_keys( keep, lengths )
+
+		low, high = positions[rows[:, np.newaxis], lower], positions[rows[:, np.newaxis], upper]
+		interpolated = low + ( high - low ) * weights[..., np.newaxis]
+
+		error = np.linalg.norm( interpolated - positions, axis=2 )
+		error[keep] = 0.0
+
+		worst = error.argmax( axis=1 )
+		over = error[rows, worst] > tolerance
+		if not over.any():
+			break
+
+		keep[rows[over], worst[over]] = True
+
+	lower, upper, weights = _bracket_keys( keep, lengths )
+	return ResampledGuides( keep, lower, upper, weights.astype(np.float32) )
+
+
+def interpolate_keys( positions:np.ndarray, resampled:ResampledGuides,
+		indices:Optional[np.ndarray]=None ) -> np.ndarray:
+	"""
+	Fills the dropped keys of each guide in from its kept keys.
+
+	:param positions: Hair key positions shaped ( len(indices), keys, 3 ); only the
+					kept keys are read.
+	:param resampled: The ResampledGuides from resample_guides.
+	:param indices:   The particle each row of positions belongs to. Defaults to
+					every particle.
+	:returns: float32 array shaped like positions.
+	"""
+
+	if indices is None:
+		lower, upper, weights = resampled.lower, resampled.upper, resampled.weights
+	else:
+		lower, upper, weights = resampled.lower[indices], resampled.upper[indices], resampled.weights[indices]
+
+	positions = np.asarray( positions, dtype=np.float32 )
+	rows = np.arange( len(positions) )[:, np.newaxis]
+
+	low, high = positions[rows, lower], positions[rows, upper]
+	return low + ( high - low ) * weights[..., np.newaxis]
+
+
+def kept_keys( resampled:ResampledGuides, index:int ) -> List[int]:
+	"""
+	The hair key indices kept for one guide.
+	"""
+
+	return np.flatnonzero( resampled.keep[index] ).tolist()
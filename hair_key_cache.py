@@ -0,0 +1,262 @@
+import os
+from collections import namedtuple
+from typing import Optional, List, Union
+
+import bpy
+import numpy as np
+
+from . import core, profiling
+
+
+## ======================================================================
+"""
+Hair Key Cache
+
+Guide rigs drive every hair key through a driver per axis, which
+Blender has to evaluate on every frame. Baking the driven hair keys
+into a per-frame array lets playback become a single write of the
+cached positions per guide instead.
+
+Hair key positions are kept as float32 arrays shaped
+( particles, keys, 3 ); a cache stacks one of those per frame.
+"""
+## ======================================================================
+
+HairKeyCache = namedtuple( 'HairKeyCache', ['object_name', 'system_name', 'start_frame', 'positions'] )
+
+PROPERTY_PREFIX = 'hair_cache__'
+
+_hair_caches = {}
+
+
+def install_handler( handlers, func ):
+	"""
+	Appends func to a bpy.app.handlers list, replacing any previous
+	copy left behind by a reload of the owning module.
+	"""
+
+	for item in [ x for x in handlers if getattr(x, '__name__', None) == func.__name__ ]:
+		handlers.remove( item )
+
+	handlers.append( bpy.app.handlers.persistent(func) )
+
+
+## ======================================================================
+def read_hair_keys( system:bpy.types.ParticleSystem,
+		indices:Optional[List[int]]=None ) -> np.ndarray:
+	"""
+	Reads hair key positions of a particle system in bulk.
+
+	:param system:  The hair ParticleSystem to read.
+	:param indices: The particles to read. Defaults to every particle.
+	:returns: float32 array shaped ( len(indices), keys, 3 ).
+	"""
+
+	particles = system.particles
+
+	if indices is None:
+		indices = range( len(particles) )
+
+	if len( indices ) == 0 or len( particles ) == 0:
+		return np.zeros( (0, 0, 3), dtype=np.float32 )
+
+	key_count = len( particles[0].hair_keys )
+	result = np.empty( (len(indices), key_count * 3), dtype=np.float32 )
+
+	for row, index in zip( result, indices ):
+		profiling.foreach_get( particles[index].hair_keys, 'co', row )
+
+	return result.reshape( len(indices), key_count, 3 )
+
+
+def write_hair_keys( system:bpy.types.ParticleSystem, positions:np.ndarray,
+		indices:Optional[List[int]]=None ):
+	"""
+	Writes hair key positions in bulk. The owning object still has to
+	be tagged for update afterwards.
+
+	:param system:    The hair ParticleSystem to write to.
+	:param positions: Array shaped ( len(indices), keys, 3 ).
+	:param indices:   The particle index of each row. Defaults to every particle.
+	"""
+
+	particles = system.particles
+	positions = np.ascontiguousarray( positions, dtype=np.float32 )
+
+	if indices is None:
+		indices = range( len(positions) )
+
+	for row, index in zip( positions, indices ):
+		profiling.foreach_set( particles[index].hair_keys, 'co', row.ravel() )
+
+
+## ======================================================================
+def bake_hair_cache( ob:bpy.types.Object, system:bpy.types.ParticleSystem,
+		start_frame:Optional[int]=None, end_frame:Optional[int]=None ) -> HairKeyCache:
+	"""
+	Steps through the timeline and records the evaluated hair key
+	positions of the system on every frame. Whatever drives the hair
+	keys (drivers, bone chains) is evaluated by the frame change.
+
+	:param ob:          The Object that owns the particle system.
+	:param system:      The hair ParticleSystem to bake.
+	:param start_frame: The first frame to bake, inclusive.
+	:param end_frame:   The last frame to bake, inclusive.
+	:returns: A HairKeyCache.
+	:raises: ValueError
+	"""
+
+	scene = bpy.context.scene
+	wm    = bpy.context.window_manager
+
+	if start_frame is None:
+		start_frame = scene.frame_start
+
+	if end_frame is None:
+		end_frame = scene.frame_end
+
+	if start_frame > end_frame:
+		raise ValueError( 'bake_hair_cache: start frame {} is after end frame {}.'.format(start_frame, end_frame) )
+
+	## a registered cache would overwrite the very keys being baked
+	unregister_hair_cache( ob.name, system.name )
+
+	frames = []
+	wm.progress_begin( start_frame, end_frame+1 )
+	for frame in range( start_frame, end_frame+1 ):
+		wm.progress_update( frame )
+		with profiling.stage( 'frame_set' ):
+			scene.frame_set( frame )
+		with profiling.stage( 'hair_key_read' ):
+			frames.append( read_hair_keys(system) )
+	wm.progress_end()
+
+	profiling.log( 'Baked {} frames of "{}" hair keys.'.format(len(frames), system.name) )
+	return HairKeyCache( ob.name, system.name, start_frame, np.stack(frames) )
+
+
+def sample_hair_cache( cache:HairKeyCache, frame:float ) -> np.ndarray:
+	"""
+	Looks up the hair key positions for a frame, clamped to the cached
+	range and linearly blended on subframes.
+
+	:returns: float32 array shaped ( particles, keys, 3 ).
+	"""
+
+	return core.sample_frames( cache.positions, cache.start_frame, frame )
+
+
+## ======================================================================
+def save_hair_cache( cache:HairKeyCache, filepath:str ):
+	"""
+	Writes a HairKeyCache to an uncompressed .npz file.
+	"""
+
+	np.savez( filepath,
+		object_name=cache.object_name,
+		system_name=cache.system_name,
+		start_frame=cache.start_frame,
+		positions=cache.positions )
+
+
+def load_hair_cache( filepath:str ) -> HairKeyCache:
+	"""
+	Reads a HairKeyCache written by save_hair_cache.
+	"""
+
+	with np.load( filepath ) as data:
+		return HairKeyCache(
+			str( data['object_name'] ),
+			str( data['system_name'] ),
+			int( data['start_frame'] ),
+			data['positions'] )
+
+
+## ======================================================================
+def register_hair_cache( cache:HairKeyCache, filepath:Optional[str]=None ):
+	"""
+	Plays the cache back on every frame change.
+
+	:param cache:    The HairKeyCache to play back.
+	:param filepath: If given, the cache is saved there and the path is stored
+					on the object, so the cache is registered again when the
+					.blend file is reopened.
+	"""
+
+	if filepath:
+		if not filepath.endswith( '.npz' ):
+			filepath += '.npz'
+
+		save_hair_cache( cache, filepath )
+		ob = bpy.data.objects.get( cache.object_name )
+		if ob is not None:
+			ob[PROPERTY_PREFIX + cache.system_name] = bpy.path.relpath( filepath )
+
+	_hair_caches[(cache.object_name, cache.system_name)] = cache
+
+
+def unregister_hair_cache( object_name:str, system_name:str ) -> Optional[HairKeyCache]:
+	"""
+	Stops playing back the cache of a particle system.
+
+	:returns: The removed HairKeyCache, or None if none was registered.
+	"""
+
+	return _hair_caches.pop( (object_name, system_name), None )
+
+
+def remove_hair_drivers( ob:bpy.types.Object, system:bpy.types.ParticleSystem ) -> int:
+	"""
+	Removes every driver on the object that targets the system's particles.
+
+	:returns: The number of drivers removed.
+	"""
+
+	if ob.animation_data is None:
+		return 0
+
+	prefix = 'particle_systems["{}"].'.format( system.name )
+	paths = [ (x.data_path, x.array_index) for x in ob.animation_data.drivers
+				if x.data_path.startswith(prefix) ]
+
+	for data_path, array_index in paths:
+		ob.driver_remove( data_path, array_index )
+
+	return len( paths )
+
+
+def _hair_cache_frame_change( scene ):
+	if not _hair_caches:
+		return
+
+	frame = scene.frame_current + scene.frame_subframe
+
+	for (object_name, system_name), cache in _hair_caches.items():
+		ob = bpy.data.objects.get( object_name )
+		if ob is None or not system_name in ob.particle_systems:
+			continue
+
+		write_hair_keys( ob.particle_systems[system_name], sample_hair_cache(cache, frame) )
+		ob.update_tag( refresh={'DATA'} )
+
+
+def _reload_hair_caches( *args ):
+	"""
+	Registers the caches stored on objects of a freshly loaded file.
+	"""
+
+	_hair_caches.clear()
+
+	for ob in bpy.data.objects:
+		for key in [ x for x in ob.keys() if x.startswith(PROPERTY_PREFIX) ]:
+			filepath = bpy.path.abspath( ob[key] )
+			if not os.path.exists( filepath ):
+				profiling.log( 'Hair cache "{}" for "{}" is missing.'.format(filepath, ob.name) )
+				continue
+
+			cache = load_hair_cache( filepath )
+			_hair_caches[(ob.name, key[len(PROPERTY_PREFIX):])] = cache
+
+
+install_handler( bpy.app.handlers.frame_change_pre, _hair_cache_frame_change )
+install_handler( bpy.app.handlers.load_post, _reload_hair_caches )
@@ -1,19 +1,152 @@
-import os, sys
-from typing import Optional, List, Union
+import os, sys, time
+from collections import namedtuple
+from typing import Optional, List, Dict, Tuple, Union
 
 import bpy
-context = bpy.context
-scene = context.scene
 
 import mathutils
 from mathutils import Vector, Matrix
 
+import numpy as np
+
+from . import core, guide_reduction, hair_key_cache, profiling
+
+
+## ======================================================================
+"""
+Particle System Registry
+
+Particle systems aren't in bpy.data, so finding one by name means
+scanning every object in the scene. The registry does that scan once
+and caches, per system, the owning object, the system's index on that
+object and the users of its settings. Systems are looked up by identity
+when the system itself is at hand, since duplicated crowd agents carry
+systems of the same name; only bare names fall back on the first match.
+It is thrown away whenever objects or particle settings change in the
+depsgraph.
+"""
+## ======================================================================
+
+ParticleRecord = namedtuple( 'ParticleRecord', ['object', 'index', 'users'] )
+
+_particle_registry = None
+
+
+def build_particle_registry() -> Tuple[Dict[str,ParticleRecord], Dict[int,ParticleRecord]]:
+	"""
+	Scans the scene once and builds the particle system registry.
+
+	If more than one object carries a system by the same name, the
+	first one found wins the name, matching the old linear search.
+
+	:returns: ( by_name, by_pointer ): dicts of system name and of
+			ParticleSystem.as_pointer() -> ParticleRecord( object, index, users ),
+			where users is a frozenset of every object using the system's settings.
+	"""
+
+	settings_users = {}
+	for ob in bpy.data.objects:
+		for system in ob.particle_systems:
+			settings_users.setdefault( system.settings.as_pointer(), set() ).add( ob )
+
+	by_name = {}
+	by_pointer = {}
+	for ob in bpy.data.objects:
+		for index, system in enumerate( ob.particle_systems ):
+			users = frozenset( settings_users[system.settings.as_pointer()] )
+			by_pointer[system.as_pointer()] = ParticleRecord( ob, index, users )
+
+	for ob in bpy.context.scene.objects:
+		for system in ob.particle_systems:
+			if not system.name in by_name:
+				by_name[system.name] = by_pointer[system.as_pointer()]
+
+	return by_name, by_pointer
+
+
+def particle_registry() -> Dict[str,ParticleRecord]:
+	"""
+	Returns the cached particle system registry, building it if
+	it has been invalidated since the last call.
+	"""
+
+	return _registry()[0]
+
+
+def _registry() -> Tuple[Dict[str,ParticleRecord], Dict[int,ParticleRecord]]:
+	global _particle_registry
+
+	if _particle_registry is None:
+		_particle_registry = build_particle_registry()
+
+	return _particle_registry
+
+
+def invalidate_particle_registry( *args ):
+	"""
+	Drops the cached registry; the next lookup rebuilds it.
+	Safe to use directly as a bpy.app.handlers callback.
+	"""
+
+	global _particle_registry
+	_particle_registry = None
+
+
+def _registry_depsgraph_update( *args ):
+	"""
+	Invalidates the registry when objects or particle settings were updated.
+
+	Blender 2.8+ passes ( scene, depsgraph ) to depsgraph_update_post;
+	older versions only pass the scene to scene_update_post, so fall back
+	on the is_updated flags there.
+	"""
+
+	if _particle_registry is None:
+		return
+
+	depsgraph = args[1] if len(args) > 1 else None
+	if depsgraph is not None:
+		changed = depsgraph.id_type_updated( 'OBJECT' ) or depsgraph.id_type_updated( 'PARTICLE' )
+	else:
+		changed = bpy.data.objects.is_updated or bpy.data.particles.is_updated
+
+	if changed:
+		invalidate_particle_registry()
+
+
+if hasattr( bpy.app.handlers, 'depsgraph_update_post' ):
+	hair_key_cache.install_handler( bpy.app.handlers.depsgraph_update_post, _registry_depsgraph_update )
+else:
+	hair_key_cache.install_handler( bpy.app.handlers.scene_update_post, _registry_depsgraph_update )
+
+## load, undo and redo all swap the Objects the records point at
+for handlers in bpy.app.handlers.load_post, bpy.app.handlers.undo_post, bpy.app.handlers.redo_post:
+	hair_key_cache.install_handler( handlers, invalidate_particle_registry )
+
+
+def particle_record( system:Union[str,bpy.types.ParticleSystem] ) -> ParticleRecord:
+	"""
+	Looks up the registry entry for a particle system.
+
+	:param system: The system, or the name of the system, to look up. A system
+				is found by identity, so its true owner is returned even when
+				other objects carry systems of the same name.
+	:returns: The ParticleRecord, or None if no such system is in the scene.
+	"""
+
+	by_name, by_pointer = _registry()
+
+	if isinstance( system, bpy.types.ParticleSystem ):
+		return by_pointer.get( system.as_pointer() )
+
+	return by_name.get( system )
+
 
 ## ======================================================================
 def find_particle_system( name:Union[str,bpy.types.ParticleSystem] ) -> bpy.types.ParticleSystem:
 	"""
 	Particle systems aren't in bpy.data; you have to search through
-	objects for them.
+	objects for them. The search is served from the particle registry.
 
 	:param name: Name of the system to search for. If a ParticleSystem object
 				is passed in, it will be directly returned.
@@ -23,36 +156,274 @@ def find_particle_system( name:Union[str,bpy.types.ParticleSystem] ) -> bpy.type
 	if isinstance(name, bpy.types.ParticleSystem):
 		return name
 
-	particle_objects = [ x for x in scene.objects if len(x.particle_systems) ]
-	for item in particle_objects:
-		for system in item.particle_systems:
-			if system.name == name:
-				return system
+	record = particle_record( name )
+	if record is None:
+		return None
 
-	return None
+	return record.object.particle_systems[record.index]
 
 
 ## ======================================================================
 def find_particle_object( name:Union[str,bpy.types.ParticleSystem] ) -> bpy.types.Object:
 	"""
-	Search through bpy.data.objects for the first object to which
-	the specified ParticleSystem belongs.
+	Finds the object to which the specified ParticleSystem belongs.
 
-	:param name: Name of the system to search for. If a ParticleSystem object
-				is passed in, it will be directly returned.
-	:returns: The system, or None on error.
+	:param name: The ParticleSystem itself, or the name of the system to search
+				for, in which case the first object in the scene carrying a
+				system by that name is returned.
+	:returns: The owning Object, or None on error.
 	"""
 
-	if isinstance(name, bpy.types.ParticleSystem):
-		return name
+	record = particle_record( name )
+	if record is None:
+		return None
+
+	return record.object
+
+
+## ======================================================================
+"""
+Bulk Driver Construction
+
+Every guide hair key is driven per axis by a single-variable SUM driver.
+Building them one RNA call at a time through driver_remove / driver_add
+/ update dominates conversion time on large grooms, so all the driver
+F-curves for a system are described up front and built in one pass.
+"""
+## ======================================================================
+
+class DriverBuildReport( namedtuple('DriverBuildReport', ['drivers', 'guides', 'seconds']) ):
+	"""
+	Timing summary returned by the bulk driver builders.
+	"""
+
+	__slots__ = ()
+
+	@property
+	def rate( self ) -> float:
+		"""Drivers built per second."""
+		return self.drivers / self.seconds if self.seconds > 0.0 else float(self.drivers)
+
+	def __str__( self ):
+		return 'Built {} drivers for {} guides in {:.2f}s ({:.0f} drivers/s).'.format(
+			self.drivers, self.guides, self.seconds, self.rate )
+
+
+## keyframes ( 0, 0 ) and ( 1, 1 ) with linear extrapolation: an identity mapping
+_IDENTITY_KEYS = ( 0.0, 0.0, 1.0, 1.0 )
+
+_PARTICLES_PATH = 'particle_systems["{}"].particles[{}].hair_keys[{}].co'
+
+
+def _driver_owner( system:bpy.types.ParticleSystem, record:Optional[ParticleRecord],
+		caller:str ) -> bpy.types.Object:
+	"""
+	Finds the object that owns the system's drivers, making sure it has
+	animation data and an action.
+
+	:returns: The Object on which the drivers are to be created.
+	:raises: ValueError
+	"""
+
+	base_name = system.name.split('.')[1]
+
+	## the drivers have to be on the object, I think
+	## so find the object first-- should only be one
+	if record is None:
+		record = particle_record( system )
+
+	users = record.users if record else ()
+	if not len(users) == 1:
+		raise ValueError( '{}: User count for "{}" is not exactly one.'.format(caller, system.name) )
+
+	ob = record.object
+
+	if ob.animation_data is None:
+		ob.animation_data_create()
+
+	##!FIXME: Should I be doing this here, or outside?
+	if ob.animation_data.action is None:
+		action_name = 'DO_NOT_TOUCH__act.{}.000'.format( base_name )
+		action = bpy.data.actions.new( action_name )
+		ob.animation_data.action = action
+
+	return ob
+
+
+def build_driver_fcurves( ob:bpy.types.Object, specs ) -> int:
+	"""
+	Creates a single-variable SUM driver for every spec in one pass.
+
+	Existing drivers are only removed when one is already present on the
+	same path and index, so fresh objects skip the clear entirely.
+
+	:param ob:    The Object that owns the driven properties.
+	:param specs: Iterable of ( data_path, array_index, variable_type, target_settings ),
+				where target_settings is a sequence of ( attribute, value ) pairs
+				set on the variable's first target.
+	:returns: The number of drivers created.
+	"""
+
+	drivers = ob.animation_data.drivers
+	existing = { (x.data_path, x.array_index) for x in drivers }
+
+	count = 0
+	for data_path, array_index, variable_type, target_settings in specs:
+		if (data_path, array_index) in existing:
+			ob.driver_remove( data_path, array_index )
+
+		fcurve = profiling.driver_add( ob, data_path, array_index )
+		## 'SUM' shouldn't use Python, so it should be faster since
+		## we're only looking at single variable direct connections
+		driver = fcurve.driver
+		driver.type = 'SUM'
 
-	particle_objects = [ x for x in scene.objects if len(x.particle_systems) ]
-	for item in particle_objects:
-		for system in item.particle_systems:
-			if system.name == name:
-				return system
+		modifiers = fcurve.modifiers
+		while len( modifiers ):
+			modifiers.remove( modifiers[0] )
 
-	return None
+		var = driver.variables.new()
+		var.name = 'p'
+		var.type = variable_type
+
+		target = var.targets[0]
+		for attribute, value in target_settings:
+			setattr( target, attribute, value )
+
+		driver.show_debug_info = True
+		driver.expression = 'p'
+
+		## have to have keys properly spaced out
+		kp = fcurve.keyframe_points
+		kp.add( 2 )
+		profiling.foreach_set( kp, 'co', _IDENTITY_KEYS )
+		for point in kp:
+			point.interpolation = 'LINEAR'
+
+		## without this, the driving will be limited
+		## to ( 0 ~ 1 )
+		fcurve.extrapolation = 'LINEAR'
+		fcurve.update()
+
+		count += 1
+
+	profiling.count( 'drivers_created', count )
+	return count
+
+
+def attach_drivers_guides( system:bpy.types.ParticleSystem, curves:List[bpy.types.Object],
+		indices:Optional[List[int]]=None, record:Optional[ParticleRecord]=None,
+		key_indices:Optional[List[List[int]]]=None ) -> DriverBuildReport:
+	"""
+	Drives the specified guide hairs from their curves, building every
+	driver for the system in one pass.
+
+	:param system:  The Blender ParticleSystem to drive.
+	:param curves:  The curve objects to add as drivers, one per guide.
+	:param indices: The guide hair index driven by each curve. Defaults to 0..len(curves)-1.
+	:param record:  The system's ParticleRecord. Looked up in the registry if None.
+	:param key_indices: Per curve, the hair key driven by each spline point.
+				Defaults to every hair key (see resample_guide_keys).
+	:returns: A DriverBuildReport.
+	:raises: ValueError
+	"""
+
+	start = time.perf_counter()
+
+	if indices is None:
+		indices = range( len(curves) )
+
+	for curve in curves:
+		if not curve.data or not isinstance(curve.data, bpy.types.Curve):
+			raise ValueError( 'attach_drivers_guides: "{}" is not a Curve object.'.format(curve.name) )
+
+	ob = _driver_owner( system, record, 'attach_drivers_guides' )
+
+	## hair keys aren't accessible outside of particle mode
+	bpy.context.scene.objects.active = ob
+
+	## for each object, you need to do a driver per point, 
+	## per axis from curve -> guide curve
+	base_point_path = 'data.splines[0].points[{}].co[{}]'
+	particles = system.particles
+
+	if key_indices is None:
+		key_indices = [ range(len(particles[x].hair_keys)) for x in indices ]
+
+	def specs():
+		for curve, index, keys in zip( curves, indices, key_indices ):
+			for point_index, key_index in enumerate( keys ):
+				data_path = _PARTICLES_PATH.format( system.name, index, key_index )
+				for array_index in range(3):
+					yield ( data_path, array_index, 'SINGLE_PROP', (
+						('id', curve),
+						('data_path', base_point_path.format(point_index, array_index)),
+					) )
+
+	count = build_driver_fcurves( ob, specs() )
+	return DriverBuildReport( count, len(curves), time.perf_counter() - start )
+
+
+def attach_drivers_chains( system:bpy.types.ParticleSystem, chains:List[List[bpy.types.PoseBone]],
+		indices:Optional[List[int]]=None, record:Optional[ParticleRecord]=None,
+		key_indices:Optional[List[List[int]]]=None ) -> DriverBuildReport:
+	"""
+	Drives the specified guide hairs from their bone chains, building every
+	driver for the system in one pass.
+
+	:param system:  The Blender ParticleSystem to drive.
+	:param chains:  The PoseBone chains to add as drivers, one per guide.
+	:param indices: The guide hair index driven by each chain. Defaults to 0..len(chains)-1.
+	:param record:  The system's ParticleRecord. Looked up in the registry if None.
+	:param key_indices: Per chain, the hair key driven by each bone.
+				Defaults to every hair key (see resample_guide_keys).
+	:returns: A DriverBuildReport.
+	:raises: ValueError
+	"""
+
+	start = time.perf_counter()
+
+	if indices is None:
+		indices = range( len(chains) )
+
+	particles = system.particles
+	if key_indices is None:
+		key_indices = [ range(len(particles[x].hair_keys)) for x in indices ]
+
+	for chain, keys in zip( chains, key_indices ):
+		if not isinstance(chain, (list, tuple)):
+			raise ValueError( '"chain" parameter must be a list of PoseBones.' )
+
+		if not sum( [ 1 for x in chain if isinstance(x, bpy.types.PoseBone)] ) == len(chain):
+			raise ValueError( '"chain" contains items that are not PoseBones.' )
+
+		if not len(chain) == len(keys):
+			raise ValueError( 'chain length ({}) does not match guide hair length ({}).'.format(len(chain), len(keys)) )
+
+	ob = _driver_owner( system, record, 'attach_drivers_chains' )
+	bpy.context.scene.objects.active = ob
+
+	## for each object, you need to do a driver per 
+	## point, per axis from bone -> guide curve cv
+	base_bone_path = 'pose.bones["{}"].matrix.translation[{}]'
+	transform_types = ( 'LOC_X', 'LOC_Y', 'LOC_Z' )
+
+	def specs():
+		for chain, index, keys in zip( chains, indices, key_indices ):
+			armature = chain[0].id_data
+			for key_index, bone in zip( keys, chain ):
+				data_path = _PARTICLES_PATH.format( system.name, index, key_index )
+				for array_index in range(3):
+					yield ( data_path, array_index, 'TRANSFORMS', (
+						('id', armature),
+						('bone_target', bone.name),
+						('transform_space', 'WORLD_SPACE'),
+						('transform_type', transform_types[array_index]),
+						('data_path', base_bone_path.format(bone.name, array_index)),
+					) )
+
+	count = build_driver_fcurves( ob, specs() )
+	return DriverBuildReport( count, len(chains), time.perf_counter() - start )
 
 
 ## ======================================================================
@@ -78,6 +449,7 @@ def convert_guide_single(
 	:throws: ValueError
 	"""
 
+	scene = bpy.context.scene
 	p = ps.particles
 	particle_count = len( p )
 
@@ -97,7 +469,7 @@ def convert_guide_single(
 			real_index += 1
 			name = 'crvguide.{}.{:03d}'.format( base_name, real_index )
 	
-	print( 'Attempting to create guide "{}".'.format(name) )
+	profiling.log( 'Attempting to create guide "{}".'.format(name) )
 
 	curve_data = bpy.data.curves.new( name, type='CURVE' )
 	curve_data.dimensions = '3D'
@@ -120,121 +492,124 @@ def convert_guide_single(
 	return ob
 
 
-def attach_driver_guide( system:bpy.types.ParticleSystem, curve:bpy.types.Object, index ):
+def convert_guides_bulk(
+		ps:bpy.types.ParticleSystem,
+		indices:Optional[List[int]]=None,
+		key_indices:Optional[List[List[int]]]=None,
+		) -> List[bpy.types.Object]:
+	"""
+	Converts the indexed guide hairs from the specified particle system
+	into Blender curves in one pass: hair keys are read in bulk, spline
+	points are set with a single foreach_set per curve and names come
+	from a precomputed set of used object names. Selection and the
+	active object are left untouched.
+
+	:param ps:      The Blender ParticleSystem to convert.
+	:param indices: The indices of the guide hairs to convert. Defaults to all of them.
+	:param key_indices: Per guide, the hair keys to make spline points from.
+				Defaults to every hair key (see resample_guide_keys).
+	:returns: A list of curve Objects, one per index.
+	:throws: ValueError
 	"""
-	Creates the driver setup on the particle system.
 
-	This looks for an Action block, and if one is not found 
-	one is created to hold the drivers.
-	:param system:  The Blender ParticleSystem to drive.
-	:param curve: The curve object to add as a driver.
-	:param index: The index of the guide hair in the ParticleSystem to drive.
+	scene = bpy.context.scene
+	p = ps.particles
+	particle_count = len( p )
 
-	No return value.
-	:raises: ValueError
-	"""
+	if particle_count == 0:
+		raise ValueError( 'convert_guides_bulk: Zero guide hairs on particle system "{}"'.format(ps.name) )
 
-	if not curve.data or not isinstance(curve.data, bpy.types.Curve):
-		raise ValueError( 'attach_driver_guide: "curve" parameter must be a Curve object.' )
-	
-	base_name = system.name.split('.')[1]
+	if indices is None:
+		indices = range( particle_count )
+	indices = list( indices )
 
-	## the drivers have to be on the object, I think
-	## so find the object first-- should only be one
-	users = bpy.data.user_map()[system.settings]
-	if not len(users) == 1:
-		raise ValueError( 'attach_driver_guide: User count for "{}" is not exactly one.'.format(ps.name) )
-	
-	## it's a set-- have to convert to index
-	ob = list(users)[0]
+	for index in indices:
+		if not sorted([0, index, particle_count-1])[1] == index:
+			raise ValueError( 'convert_guides_bulk: Index {} is out of bounds ({} total guide hairs)'.format(index, particle_count) )
 
-	if ob.animation_data is None:
-		ob.animation_data_create()
+	positions = hair_key_cache.read_hair_keys( ps, indices )
 
-	##!FIXME: Should I be doing this here, or outside?
-	if ob.animation_data.action is None:
-		action_name = 'DO_NOT_TOUCH__act.{}.000'.format( base_name )
-		action = bpy.data.actions.new( action_name )
-		ob.animation_data.action = action
-	
-	action = ob.animation_data.action
+	if key_indices is None:
+		key_indices = [ range(positions.shape[1]) ] * len( indices )
 
-	system_index = [ x for x,y in enumerate(ob.particle_systems) if y.name == system.name ][0]
+	## spline points are 4d; w stays at 1.0
+	all_points = np.ones( positions.shape[:2] + (4,), dtype=np.float32 )
+	all_points[..., :3] = positions
 
-	print( 'Curve "{}" {}\t>>\t"{}": "{}" ({})'.format(curve.name, index, ob.name, system.name, system_index) )
+	base_name = ps.name.split('.')[1]
+	name_format = 'crvguide.' + base_name + '.{:03d}'
+	used_names = set( bpy.data.objects.keys() )
 
-	## hair keys aren't accessible outside of particle mode
-	scene.objects.active = ob
+	result = []
+	real_index = -1
+	for index, points, keys in zip( indices, all_points, key_indices ):
+		points = points[ list(keys) ]
+
+		## every name between index and the last one handed out is taken,
+		## so pick up the search from there
+		real_index = max( index, real_index + 1 )
+		name = name_format.format( real_index )
+		while name in used_names:
+			real_index += 1
+			name = name_format.format( real_index )
+		used_names.add( name )
 
-	# mode = bpy.context.mode
-	# if not mode == 'PARTICLE':
-	# 	bpy.ops.particle.particle_edit_toggle()
+		curve_data = bpy.data.curves.new( name, type='CURVE' )
+		curve_data.dimensions = '3D'
+		curve_data.use_path = True
+		spline = curve_data.splines.new( type='POLY' )
 
-	## connect away
-	## for each object, you need to do a driver per point, 
-	## per axis from curve -> guide curve
-	base_particles_path = 'particle_systems["{}"].particles[{}]'.format(system.name, index) + '.hair_keys[{}].co'
-	base_bone_path    = 'data.splines[0].points[{}].co[{}]'
+		## -1 here because the default spline comes in with a point?
+		spline.points.add( len(points) - 1 )
+		profiling.foreach_set( spline.points, 'co', points.ravel() )
 
-	particle = system.particles[index]
-	spline   = curve.data.splines[0]
+		ob = bpy.data.objects.new( name, curve_data )
+		scene.objects.link( ob )
+		result.append( ob )
 
-	for index in range( len(particle.hair_keys) ):
-		for array_index in range(3):
-			data_path = base_particles_path.format(index, array_index)
+	profiling.count( 'objects_touched', len(result) )
+	profiling.log( 'Created {} guide curves for "{}".'.format(len(result), ps.name) )
+	return result
 
-			## clear first
-			try:
-				ob.driver_remove( data_path, array_index )
-			except TypeError:
-				pass
-
-			fcurve = ob.driver_add( data_path, array_index )
-			# fcurve.driver.type = 'SCRIPTED'
-			## 'SUM' shouldn't use Python, so it should be faster since
-			## we're only looking at single variable direct connections
-			fcurve.driver.type = 'SUM'
-
-			for mod in fcurve.modifiers:
-				fcurve.modifiers.remove( mod )
-	
-			var = fcurve.driver.variables.new()
-			var.name = 'p'
-			var.type = 'SINGLE_PROP'
-			var.targets[0].id = curve
 
-			target_path = base_bone_path.format( index, array_index )
-			var.targets[0].data_path = target_path
+def attach_driver_guide( system:bpy.types.ParticleSystem, curve:bpy.types.Object, index,
+		record:Optional[ParticleRecord]=None ):
+	"""
+	Creates the driver setup on the particle system.
 
-			fcurve.driver.show_debug_info = True
-			fcurve.driver.expression = 'p'
+	This looks for an Action block, and if one is not found 
+	one is created to hold the drivers.
+	:param system:  The Blender ParticleSystem to drive.
+	:param curve: The curve object to add as a driver.
+	:param index: The index of the guide hair in the ParticleSystem to drive.
+	:param record: The system's ParticleRecord. Looked up in the registry if None;
+				pass it in when attaching many guides of the same system.
 
-			## have to have keys properly spaced out
-			kp = fcurve.keyframe_points
-			for key_index in range(2):
-				kp.add()
-				kp[key_index].co = [1*key_index] * 2
-				kp[key_index].interpolation = 'LINEAR'
+	No return value.
+	:raises: ValueError
+	"""
 
-			fcurve.update()
+	if not curve.data or not isinstance(curve.data, bpy.types.Curve):
+		raise ValueError( 'attach_driver_guide: "curve" parameter must be a Curve object.' )
 
-			## without this, the driving will be limited
-			## to ( 0 ~ 1 )
-			fcurve.extrapolation = 'LINEAR'
-			fcurve.update()
+	profiling.log( 'Curve "{}" {}\t>>\t"{}"'.format(curve.name, index, system.name) )
+	attach_drivers_guides( system, [curve], [index], record=record )
 
 
-def do_curve_conversion( system:Union[str,bpy.types.ParticleSystem] ) -> List[bpy.types.Curve]:
+def do_curve_conversion( system:Union[str,bpy.types.ParticleSystem],
+		target_count:Optional[int]=None, tolerance:Optional[float]=None ) -> List[bpy.types.Curve]:
 	"""
 	Converts the specified particle system combed hair guides
 	into bezier guide curves with 'vector' handles (linear curves).
 
 	:param system: The Blender ParticleSystem to convert.
+	:param target_count: If given, the guides are clustered down to this many
+				representatives and only those get curves (see reduce_guides).
+	:param tolerance: If given, curves only get the hair keys needed to keep
+				the rest within this distance (see resample_guide_keys).
 	:returns: a list of Curves, one for each of the converted groom hairs.
 	"""
 
-	result = []
-
 	if isinstance( system, str ):
 		ps = find_particle_system( system )
 	else:
@@ -247,13 +622,18 @@ def do_curve_conversion( system:Union[str,bpy.types.ParticleSystem] ) -> List[bp
 	ps.settings.effector_weights.all   = 0.0
 	ps.settings.effector_weights.group = None
 
-	curve_count = len( ps.particles )
+	record = particle_record( ps )
+	with profiling.stage( 'guide_reduction' ):
+		indices = reduce_guides( ps, target_count, record=record )
+		key_indices = resample_guide_keys( ps, tolerance, indices, record=record )
+
+	with profiling.stage( 'curve_creation' ):
+		result = convert_guides_bulk( ps, indices, key_indices )
+
+	with profiling.stage( 'driver_creation' ):
+		report = attach_drivers_guides( ps, result, indices, record=record, key_indices=key_indices )
+	profiling.log( report )
 
-	for index in range( curve_count ):
-		curve = convert_guide_single(ps, index)
-		attach_driver_guide( ps, curve, index )
-		result.append( curve )
-	
 	return result
 
 
@@ -267,7 +647,8 @@ from Python to use to drive the guide hairs.
 """
 ## ======================================================================
 
-def attach_driver_chain( system:bpy.types.ParticleSystem, chain:List[bpy.types.PoseBone], index ):
+def attach_driver_chain( system:bpy.types.ParticleSystem, chain:List[bpy.types.PoseBone], index,
+		record:Optional[ParticleRecord]=None ):
 	"""
 	Creates the driver setup on the particle system, attaching the specified chain
 	of bones to the guide hair specified by index.
@@ -278,104 +659,13 @@ def attach_driver_chain( system:bpy.types.ParticleSystem, chain:List[bpy.types.P
 	:param system: The Blender ParticleSystem to drive.
 	:param chain:  The chain of PoseBones that should be used to drive the guide hair.
 	:param index:  The index of the guide hair in the ParticleSystem to drive.
+	:param record: The system's ParticleRecord. Looked up in the registry if None.
 
 	No return value.
 	:raises: ValueError
 	"""
 
-	if not isinstance(chain, (list, tuple)):
-		raise ValueError( '"chain" parameter must be a list of PoseBones.' )
-	
-	chain_length = len( chain )
-
-	if not sum( [ 1 for x in chain if isinstance(x, bpy.types.PoseBone)] ) == chain_length:
-		raise ValueError( '"chain" contains items that are not PoseBones.' )
-	
-	target_hair = system.particles[index]
-	target_hair_length = len(target_hair.hair_keys)
-	if not chain_length == target_hair_length:
-		raise ValueError( 'chain length ({}) does not match guide hair length ({}).'.format(chain_length, target_hair_length-1) )
-
-	base_name = system.name.split('.')[1]
-
-	## the drivers have to be on the object, I think
-	## so find the object first-- should only be one
-	users = bpy.data.user_map()[system.settings]
-	if not len(users) == 1:
-		raise ValueError( 'attach_driver_guide: User count for "{}" is not exactly one.'.format(system.name) )
-	
-	## it's a set-- have to convert to index
-	ob = list(users)[0]
-
-	if ob.animation_data is None:
-		ob.animation_data_create()
-
-	##!FIXME: Should I be doing this here, or outside?
-	if ob.animation_data.action is None:
-		action_name = 'DO_NOT_TOUCH__act.{}.000'.format( base_name )
-		action = bpy.data.actions.new( action_name )
-		ob.animation_data.action = action
-
-	action = ob.animation_data.action
-	scene.objects.active = ob
-
-	## connect away
-	## for each object, you need to do a driver per 
-	## point, per axis from bone -> guide curve cv
-	base_particles_path = 'particle_systems["{}"].particles[{}]'.format(system.name, index) + '.hair_keys[{}].co'
-	base_bone_path      = 'pose.bones["{}"].matrix.translation[{}]'
-
-	armature = chain[0].id_data
-
-	for index in range( target_hair_length ):
-		bone = chain[index]
-
-		for array_index, transform_type in zip( range(3), ('LOC_X', 'LOC_Y', 'LOC_Z') ):
-			data_path = base_particles_path.format(index, array_index)
-
-			## clear first
-			try:
-				ob.driver_remove( data_path, array_index )
-			except TypeError:
-				pass
-
-			fcurve = ob.driver_add( data_path, array_index )
-			# fcurve.driver.type = 'SCRIPTED'
-			## 'SUM' shouldn't use Python, so it should be faster since
-			## we're only looking at single variable direct connections
-			fcurve.driver.type = 'SUM'
-
-			for mod in fcurve.modifiers:
-				fcurve.modifiers.remove( mod )
-	
-			var = fcurve.driver.variables.new()
-			var.name = 'p'
-			# var.type = 'SINGLE_PROP'
-			var.type = 'TRANSFORMS'
-			var.targets[0].id = armature
-			var.targets[0].bone_target = bone.name
-			var.targets[0].transform_space = 'WORLD_SPACE'
-			var.targets[0].transform_type = transform_type
-
-			target_path = base_bone_path.format( bone.name, array_index )
-			var.targets[0].data_path = target_path
-
-			fcurve.driver.show_debug_info = True
-			fcurve.driver.expression = 'p'
-
-			## have to have keys properly spaced out
-			kp = fcurve.keyframe_points
-			for key_index in range(2):
-				kp.add()
-				kp[key_index].co = [1*key_index] * 2
-				kp[key_index].interpolation = 'LINEAR'
-
-			fcurve.update()
-
-			## without this, the driving will be limited
-			## to ( 0 ~ 1 )
-			fcurve.extrapolation = 'LINEAR'
-			fcurve.update()
+	attach_drivers_chains( system, [chain], [index], record=record )
 
 
 def build_chain_single(
@@ -393,26 +683,57 @@ def build_chain_single(
 	:throws: ValueError
 	"""
 
+	return build_chains_bulk( ps, armature, [index] )[0]
+
+
+def build_chains_bulk(
+		ps:bpy.types.ParticleSystem,
+		armature:bpy.types.Armature,
+		indices:Optional[List[int]]=None,
+		key_indices:Optional[List[List[int]]]=None,
+		) -> List[List[bpy.types.PoseBone]]:
+	"""
+	Converts the indexed guide hairs from the specified particle system
+	into chains of bones in the specified Armature, all within a single
+	edit mode session.
+
+	:param ps:       The Blender ParticleSystem to convert.
+	:param Armature: The Armature in which to create the new bones.
+	:param indices:  The indices of the guide hair particles to use. Defaults to all of them.
+	:param key_indices: Per guide, the hair keys to place bone heads on.
+				Defaults to every hair key (see resample_guide_keys).
+	:returns: A list of PoseBone chains, one per index.
+	:throws: ValueError
+	"""
+
+	scene = bpy.context.scene
 	p = ps.particles
 	particle_count = len( p )
 
 	if particle_count == 0:
-		raise ValueError( 'convert_guide_single: Zero guide hairs on particle system "{}"'.format(ps.name) )
+		raise ValueError( 'build_chains_bulk: Zero guide hairs on particle system "{}"'.format(ps.name) )
 
-	if not sorted([0, index, particle_count-1])[1] == index:
-		raise ValueError( 'convert_guide_single: Index {} is out of bounds ({} total guide hairs)'.format(index, particle_count) )
+	if indices is None:
+		indices = range( particle_count )
+	indices = list( indices )
 
-	hair_key_count = len( p[0].hair_keys )
-	base_name = ps.name.split('.')[1]
+	for index in indices:
+		if not sorted([0, index, particle_count-1])[1] == index:
+			raise ValueError( 'build_chains_bulk: Index {} is out of bounds ({} total guide hairs)'.format(index, particle_count) )
+
+	if not indices:
+		return []
+
+	## hair keys have to be read before leaving object mode
+	positions = hair_key_cache.read_hair_keys( ps, indices )
 
-	base_bone_name  = 'guide.{}_{:03d}'.format(ps.name, index) + '.{:03d}'
-	all_points = [ x.co.copy() for x in p[index].hair_keys ]
+	if key_indices is None:
+		key_indices = [ range(positions.shape[1]) ] * len( indices )
+	key_indices = [ list(x) for x in key_indices ]
 
-	## for that last bone
-	all_points.append( (all_points[-1] - all_points[-2]) + all_points[-1] )
+	## joints per chain, with a tip for that last bone continuing the last kept segment
+	all_points = core.chain_points( positions, key_indices )
 
-	edit_bones = []
-	bone_names = []
 	armature.hide = armature.hide_select = False
 	scene.objects.active = armature
 
@@ -420,33 +741,41 @@ def build_chain_single(
 	scene.update()
 	bpy.ops.object.mode_set( mode='EDIT' )
 
-	root_bone = armature.data.edit_bones[ 'root' ]
+	edit_bones = armature.data.edit_bones
+	root_bone = edit_bones[ 'root' ]
 
-	for index in range(hair_key_count):
-		bone = armature.data.edit_bones.new( base_bone_name.format(index) )
-		if len(edit_bones):
-			bone.parent = edit_bones[-1]
-		else:
-			bone.parent = root_bone
+	## bound up front so the del below holds even if a guide keeps no keys
+	parent = bone = None
+
+	chain_names = []
+	for index, points, keys in zip( indices, all_points, key_indices ):
+		parent = root_bone
+		bone_names = []
 
-		bone.head = all_points[index]
-		bone.tail = all_points[index+1]
+		for point_index, key_index in enumerate( keys ):
+			bone = edit_bones.new( chain_bone_name(ps.name, index, key_index) )
+			bone.parent = parent
+			bone.head = points[point_index]
+			bone.tail = points[point_index+1]
 
-		edit_bones.append( bone )
-		bone_names.append( bone.name )
+			parent = bone
+			bone_names.append( bone.name )
+
+		chain_names.append( bone_names )
 
 	armature.update_from_editmode()
-	
+
 	bpy.ops.object.mode_set( mode='POSE' )
 	## avoid a crash
-	del edit_bones
+	del edit_bones, root_bone, parent, bone
+
+	pose_bones = { x.name: x for x in armature.pose.bones }
+	return [ [ pose_bones[x] for x in bone_names ] for bone_names in chain_names ]
 
-	result = [ armature.pose.bones[x] for x in bone_names ]
-	return result
 
-def make_bone( armature:bpy.types.Armature, name:str, head:Optional(Vector)=None, 
-				tail:Optional(Vector)=None, up:Optional(Vector)=None,
-				parent:Optional(bpy.types.EditBone) ) -> bpy.types.EditBone:
+def make_bone( armature:bpy.types.Armature, name:str, head:Optional[Vector]=None, 
+				tail:Optional[Vector]=None, up:Optional[Vector]=None,
+				parent:Optional[bpy.types.EditBone]=None ) -> bpy.types.EditBone:
 	"""
 	Creates a new bone in the specified armature and returns the EditBone representing it.
 
@@ -492,19 +821,27 @@ def make_bone( armature:bpy.types.Armature, name:str, head:Optional(Vector)=None
 	return bone
 
 
-def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types.ParticleSystem] ) -> bpy.types.Armature: 
+def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types.ParticleSystem],
+		use_drivers:bool=True, target_count:Optional[int]=None,
+		tolerance:Optional[float]=None ) -> List[List[bpy.types.PoseBone]]:
 	"""
 	Converts the specified particle system combed hair guides
 	into a series of bone chains for animated guide driving.
 
 	:param base_ob: The object on which to look for the particle system
 	:param system: The Blender ParticleSystem to convert.
-	:returns: A new armature with a bone chain per guide curve hair, each chain
-			containing a bone per guide hair CV
+	:param use_drivers: If False, the chains are registered with the chain
+				evaluator (see register_chains) instead of driving every
+				hair key through TRANSFORMS drivers.
+	:param target_count: If given, the guides are clustered down to this many
+				representatives and only those get chains (see reduce_guides).
+	:param tolerance: If given, chains only get bones for the hair keys needed
+				to keep the rest within this distance (see resample_guide_keys).
+	:returns: The PoseBone chains, one per converted guide hair, each
+			containing a bone per rigged guide hair CV. They live on the
+			'rig.<base_ob>.000' armature object.
 	"""
 
-	result = []
-
 	ps = find_particle_system( system )
 	if ps is None:
 		raise ValueError( 'Particle system "{}" not found.'.format(system) )
@@ -513,9 +850,13 @@ def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types
 	ps.settings.effector_weights.all   = 0.0
 	ps.settings.effector_weights.group = None
 
-	curve_count = len( ps.particles )
+	record = particle_record( ps )
+	with profiling.stage( 'guide_reduction' ):
+		indices = reduce_guides( ps, target_count, record=record )
+		key_indices = resample_guide_keys( ps, tolerance, indices, record=record )
 
 	## make the armature
+	scene = bpy.context.scene
 	base_name = ps.name.split('.')[1]
 
 	rig_name = 'rig.{}.000'.format( base_ob.name )
@@ -526,7 +867,7 @@ def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types
 		ob  = bpy.data.objects.new( rig_name, arm )
 		scene.objects.link( ob )
 	else:
-		ob  = bpy.context.scene.objects[ rig_name ]
+		ob  = scene.objects[ rig_name ]
 		ob.hide = False
 		arm = ob.data
 
@@ -541,12 +882,17 @@ def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types
 		root_bone.tail = Vector( [0,2,0] )
 		ob.update_from_editmode()
 
-	for index in range( curve_count ):
-		chain = build_chain_single( ps, index, ob )
-		attach_driver_chain( ps, chain, index )
+	with profiling.stage( 'chain_creation' ):
+		result = build_chains_bulk( ps, ob, indices, key_indices )
+	profiling.count( 'bones_created', sum(len(x) for x in result) )
+
+	if use_drivers:
+		with profiling.stage( 'driver_creation' ):
+			report = attach_drivers_chains( ps, result, indices, record=record, key_indices=key_indices )
+		profiling.log( report )
+	else:
+		register_chains( ps, result, indices, record=record, key_indices=key_indices )
 
-		result.append( chain )
-	
 	## bugfix: make sure the armature object itself is scaled up to match
 	# scale = base_ob.world_matrix.to_scale()
 	# ob.scale = scale
@@ -556,3 +902,475 @@ def do_armature_conversion( base_ob:bpy.types.Object, system:Union[str,bpy.types
 
 	return result
 
+
+## ======================================================================
+"""
+Chain Evaluation
+
+Instead of a TRANSFORMS driver per bone per axis, registered chains are
+evaluated by a frame change handler: the pose bone heads of each rig are
+read in one call, taken to world space in one NumPy pass and written
+straight into the hair keys.
+
+The same handler fills in the hair keys dropped by key resampling and
+moves the guides left out of the rig by guide clustering along with
+their representatives.
+"""
+## ======================================================================
+
+## rows and keys give, per bone, its chain's position in indices and the hair key it drives
+ChainBinding = namedtuple( 'ChainBinding', ['armature_name', 'indices', 'bone_names', 'rows', 'keys'] )
+
+CHAIN_PROPERTY_PREFIX = 'hair_chains__'
+
+_chain_bindings = {}
+
+## ( object name, system name ) -> ( pose bone count, bone index array )
+_chain_bone_lookup = {}
+
+FOLLOWER_PROPERTY_PREFIX = 'hair_followers__'
+
+## ( object name, system name ) -> GuideClusters
+_guide_followers = {}
+
+RESAMPLE_PROPERTY_PREFIX = 'hair_resampling__'
+
+## ( object name, system name ) -> ResampledGuides
+_guide_resampling = {}
+
+
+def chain_bone_name( system_name:str, index:int, key_index:int ) -> str:
+	"""
+	The name given to the bone driving a hair key by build_chains_bulk.
+	"""
+
+	return 'guide.{}_{:03d}.{:03d}'.format( system_name, index, key_index )
+
+
+def register_chains( system:bpy.types.ParticleSystem, chains:List[List[bpy.types.PoseBone]],
+		indices:Optional[List[int]]=None, record:Optional[ParticleRecord]=None,
+		key_indices:Optional[List[List[int]]]=None ):
+	"""
+	Drives the guide hairs from their bone chains through the chain
+	evaluator instead of drivers. The armature, guide indices and driven
+	keys are stored on the particle object so the binding survives a file
+	reload.
+
+	:param system:  The Blender ParticleSystem to drive.
+	:param chains:  The PoseBone chains, one per guide, all in the same armature.
+	:param indices: The guide hair index driven by each chain. Defaults to 0..len(chains)-1.
+	:param record:  The system's ParticleRecord. Looked up in the registry if None.
+	:param key_indices: Per chain, the hair key driven by each bone. Defaults to
+				every hair key.
+	:raises: ValueError
+	"""
+
+	if indices is None:
+		indices = range( len(chains) )
+	indices = list( indices )
+
+	if not len( chains ):
+		raise ValueError( 'register_chains: No chains given for "{}".'.format(system.name) )
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		raise ValueError( 'register_chains: Particle system "{}" not found.'.format(system.name) )
+
+	armature = chains[0][0].id_data
+	key_count = len( system.particles[indices[0]].hair_keys )
+
+	if key_indices is None:
+		key_indices = [ range(key_count) ] * len( indices )
+
+	bone_names, rows, keys = [], [], []
+	for row, (chain, index, chain_keys) in enumerate( zip(chains, indices, key_indices) ):
+		if not len(chain) == len(chain_keys):
+			raise ValueError( 'chain length ({}) does not match guide hair length ({}).'.format(len(chain), len(chain_keys)) )
+
+		if not all( x.id_data == armature for x in chain ):
+			raise ValueError( 'register_chains: chain for guide {} is not in armature "{}".'.format(index, armature.name) )
+
+		bone_names.extend( x.name for x in chain )
+		rows.extend( [row] * len(chain) )
+		keys.extend( chain_keys )
+
+	ob = record.object
+	key = ( ob.name, system.name )
+
+	_chain_bindings[key] = ChainBinding( armature.name, indices, bone_names,
+								np.array(rows, dtype=np.int64), np.array(keys, dtype=np.int64) )
+	_chain_bone_lookup.pop( key, None )
+
+	ob[CHAIN_PROPERTY_PREFIX + system.name] = {
+		'armature': armature.name,
+		'indices': indices,
+		'rows': rows,
+		'keys': keys,
+	}
+
+
+def unregister_chains( system:bpy.types.ParticleSystem, record:Optional[ParticleRecord]=None ):
+	"""
+	Stops evaluating the system's bone chains.
+	"""
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		return
+
+	key = ( record.object.name, system.name )
+	_chain_bindings.pop( key, None )
+	_chain_bone_lookup.pop( key, None )
+
+	prop_name = CHAIN_PROPERTY_PREFIX + system.name
+	if prop_name in record.object:
+		del record.object[prop_name]
+
+
+def register_followers( system:bpy.types.ParticleSystem, clusters:guide_reduction.GuideClusters,
+		record:Optional[ParticleRecord]=None ):
+	"""
+	Makes the guides that were not rigged follow their cluster's
+	representative on every frame (see guide_reduction.cluster_guides).
+	The clusters are stored on the particle object so they survive a
+	file reload.
+
+	:param system:   The Blender ParticleSystem whose representatives are rigged.
+	:param clusters: The GuideClusters for the system.
+	:param record:   The system's ParticleRecord. Looked up in the registry if None.
+	:raises: ValueError
+	"""
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		raise ValueError( 'register_followers: Particle system "{}" not found.'.format(system.name) )
+
+	ob = record.object
+	_guide_followers[(ob.name, system.name)] = clusters
+
+	ob[FOLLOWER_PROPERTY_PREFIX + system.name] = {
+		'representatives': clusters.representatives.tolist(),
+		'labels': clusters.labels.tolist(),
+		'rest': clusters.rest.ravel().tolist(),
+	}
+
+
+def unregister_followers( system:bpy.types.ParticleSystem, record:Optional[ParticleRecord]=None ):
+	"""
+	Stops moving the system's unrigged guides.
+	"""
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		return
+
+	_guide_followers.pop( (record.object.name, system.name), None )
+
+	prop_name = FOLLOWER_PROPERTY_PREFIX + system.name
+	if prop_name in record.object:
+		del record.object[prop_name]
+
+
+def register_resampling( system:bpy.types.ParticleSystem, resampled:guide_reduction.ResampledGuides,
+		record:Optional[ParticleRecord]=None ):
+	"""
+	Fills in the hair keys dropped by resampling from the rigged keys on
+	every frame (see guide_reduction.resample_guides). The resampling is
+	stored on the particle object so it survives a file reload.
+
+	:param system:    The Blender ParticleSystem whose kept keys are rigged.
+	:param resampled: The ResampledGuides for every particle of the system.
+	:param record:    The system's ParticleRecord. Looked up in the registry if None.
+	:raises: ValueError
+	"""
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		raise ValueError( 'register_resampling: Particle system "{}" not found.'.format(system.name) )
+
+	ob = record.object
+	_guide_resampling[(ob.name, system.name)] = resampled
+
+	ob[RESAMPLE_PROPERTY_PREFIX + system.name] = {
+		'keep': resampled.keep.ravel().astype(np.int32).tolist(),
+		'lower': resampled.lower.ravel().tolist(),
+		'upper': resampled.upper.ravel().tolist(),
+		'weights': resampled.weights.ravel().tolist(),
+	}
+
+
+def unregister_resampling( system:bpy.types.ParticleSystem, record:Optional[ParticleRecord]=None ):
+	"""
+	Stops filling in the system's dropped hair keys.
+	"""
+
+	if record is None:
+		record = particle_record( system )
+
+	if record is None:
+		return
+
+	_guide_resampling.pop( (record.object.name, system.name), None )
+
+	prop_name = RESAMPLE_PROPERTY_PREFIX + system.name
+	if prop_name in record.object:
+		del record.object[prop_name]
+
+
+def reduce_guides( system:bpy.types.ParticleSystem, target_count:Optional[int],
+		record:Optional[ParticleRecord]=None, shape_weight:float=1.0 ) -> Optional[List[int]]:
+	"""
+	Clusters the system's guides down to target_count representatives
+	and registers the rest to follow them.
+
+	:param system:       The Blender ParticleSystem about to be rigged.
+	:param target_count: The number of guides to rig. None, or a count no
+						smaller than the guide count, disables the reduction.
+	:param record:       The system's ParticleRecord. Looked up in the registry if None.
+	:param shape_weight: See guide_reduction.guide_features.
+	:returns: The particle indices to rig, or None to rig every guide.
+	"""
+
+	unregister_followers( system, record )
+
+	if target_count is None or target_count >= len( system.particles ):
+		return None
+
+	clusters = guide_reduction.cluster_guides( hair_key_cache.read_hair_keys(system),
+				target_count, shape_weight=shape_weight )
+	register_followers( system, clusters, record )
+
+	profiling.log( 'Reduced "{}" from {} to {} guides.'.format(system.name, len(clusters.labels), len(clusters.representatives)) )
+	return clusters.representatives.tolist()
+
+
+def resample_guide_keys( system:bpy.types.ParticleSystem, tolerance:Optional[float],
+		indices:Optional[List[int]]=None, record:Optional[ParticleRecord]=None,
+		angle_tolerance:Optional[float]=None ) -> Optional[List[List[int]]]:
+	"""
+	Resamples every guide of the system to the fewest hair keys that keep
+	the rest within tolerance, and registers the dropped keys to be
+	interpolated back from the rigged ones.
+
+	:param system:    The Blender ParticleSystem about to be rigged.
+	:param tolerance: The largest allowed distance between a dropped key and its
+					interpolated position. None disables the resampling.
+	:param indices:   The guides that will be rigged. Defaults to all of them.
+	:param record:    The system's ParticleRecord. Looked up in the registry if None.
+	:param angle_tolerance: See guide_reduction.resample_guides.
+	:returns: Per rigged guide, the hair keys to rig, or None to rig every key.
+	"""
+
+	unregister_resampling( system, record )
+
+	if tolerance is None:
+		return None
+
+	resampled = guide_reduction.resample_guides( hair_key_cache.read_hair_keys(system),
+					tolerance, angle_tolerance=angle_tolerance )
+	register_resampling( system, resampled, record )
+
+	if indices is None:
+		indices = range( len(resampled.keep) )
+
+	result = [ guide_reduction.kept_keys(resampled, x) for x in indices ]
+
+	profiling.log( 'Resampled "{}" from {} to {} keys.'.format(system.name,
+		len(result) * resampled.keep.shape[1], sum(len(x) for x in result)) )
+	return result
+
+
+def _chain_bone_indices( key, binding:ChainBinding, armature:bpy.types.Object ) -> np.ndarray:
+	"""
+	Maps the binding's bone names to indices into armature.pose.bones,
+	rebuilt only when the armature's bone count changes.
+	"""
+
+	bones = armature.pose.bones
+	cached = _chain_bone_lookup.get( key )
+	if cached and cached[0] == len( bones ):
+		return cached[1]
+
+	lookup = { x.name: i for i, x in enumerate(bones) }
+	bone_indices = np.array( [ lookup[x] for x in binding.bone_names ], dtype=np.int64 )
+
+	_chain_bone_lookup[key] = ( len(bones), bone_indices )
+	return bone_indices
+
+
+def evaluate_chains( armature:bpy.types.Object, bone_indices:np.ndarray ) -> np.ndarray:
+	"""
+	Computes the world-space head of every chain bone in one pass.
+
+	:param armature:     The armature Object holding the chains.
+	:param bone_indices: Array of pose bone indices.
+	:returns: float32 array shaped ( len(bone_indices), 3 ).
+	"""
+
+	bones = armature.pose.bones
+	heads = np.empty( len(bones) * 3, dtype=np.float32 )
+	profiling.foreach_get( bones, 'head', heads )
+
+	matrix = np.array( armature.matrix_world, dtype=np.float32 )
+	heads = heads.reshape( -1, 3 )[bone_indices]
+
+	return heads @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _guide_frame_change( scene ):
+	if not _chain_bindings and not _guide_followers and not _guide_resampling:
+		return
+
+	for key in set( _chain_bindings ) | set( _guide_followers ) | set( _guide_resampling ):
+		object_name, system_name = key
+		ob = bpy.data.objects.get( object_name )
+		if ob is None or not system_name in ob.particle_systems:
+			continue
+
+		system = ob.particle_systems[system_name]
+		binding = _chain_bindings.get( key )
+		clusters = _guide_followers.get( key )
+		resampled = _guide_resampling.get( key )
+
+		if binding:
+			armature = bpy.data.objects.get( binding.armature_name )
+			if armature is None:
+				continue
+
+			try:
+				bone_indices = _chain_bone_indices( key, binding, armature )
+			except KeyError as e:
+				profiling.log( 'Chain bone {} missing from "{}"; dropping "{}".'.format(e, armature.name, system_name) )
+				_chain_bindings.pop( key )
+				continue
+
+			rigged = binding.indices
+			key_count = len( system.particles[rigged[0]].hair_keys )
+
+			positions = np.zeros( (len(rigged), key_count, 3), dtype=np.float32 )
+			positions[binding.rows, binding.keys] = evaluate_chains( armature, bone_indices )
+		else:
+			## the rigged keys are already driven
+			rigged = clusters.representatives if clusters is not None else range( len(system.particles) )
+			positions = hair_key_cache.read_hair_keys( system, rigged ) if clusters or resampled else None
+
+		if resampled is not None:
+			positions = guide_reduction.interpolate_keys( positions, resampled, rigged )
+
+		if binding or resampled is not None:
+			hair_key_cache.write_hair_keys( system, positions, rigged )
+
+		if clusters is not None:
+			followers = guide_reduction.follower_indices( clusters )
+			hair_key_cache.write_hair_keys( system,
+				guide_reduction.follow_representatives(positions, clusters, followers), followers )
+
+		ob.update_tag( refresh={'DATA'} )
+
+
+def _reload_chains( *args ):
+	"""
+	Rebuilds the chain bindings, guide followers and key resampling
+	stored on objects of a freshly loaded file.
+	"""
+
+	_chain_bindings.clear()
+	_chain_bone_lookup.clear()
+	_guide_followers.clear()
+	_guide_resampling.clear()
+
+	def stored( ob, prefix ):
+		for prop_name in [ x for x in ob.keys() if x.startswith(prefix) ]:
+			system_name = prop_name[len(prefix):]
+			if system_name in ob.particle_systems:
+				yield ob.particle_systems[system_name], ob[prop_name]
+
+	for ob in bpy.data.objects:
+		for system, data in stored( ob, CHAIN_PROPERTY_PREFIX ):
+			indices = list( data['indices'] )
+			rows = np.array( data['rows'], dtype=np.int64 )
+			keys = np.array( data['keys'], dtype=np.int64 )
+
+			bone_names = [ chain_bone_name(system.name, indices[row], key_index)
+							for row, key_index in zip(rows, keys) ]
+
+			_chain_bindings[(ob.name, system.name)] = ChainBinding( data['armature'], indices, bone_names, rows, keys )
+
+		for system, data in stored( ob, FOLLOWER_PROPERTY_PREFIX ):
+			labels = np.array( data['labels'], dtype=np.int64 )
+			rest = np.array( data['rest'], dtype=np.float32 ).reshape( len(labels), -1, 3 )
+
+			_guide_followers[(ob.name, system.name)] = guide_reduction.GuideClusters(
+				np.array( data['representatives'], dtype=np.int64 ), labels, rest )
+
+		for system, data in stored( ob, RESAMPLE_PROPERTY_PREFIX ):
+			shape = ( len(system.particles), -1 )
+
+			_guide_resampling[(ob.name, system.name)] = guide_reduction.ResampledGuides(
+				np.array( data['keep'], dtype=bool ).reshape( shape ),
+				np.array( data['lower'], dtype=np.int64 ).reshape( shape ),
+				np.array( data['upper'], dtype=np.int64 ).reshape( shape ),
+				np.array( data['weights'], dtype=np.float32 ).reshape( shape ) )
+
+
+hair_key_cache.install_handler( bpy.app.handlers.frame_change_post, _guide_frame_change )
+hair_key_cache.install_handler( bpy.app.handlers.load_post, _reload_chains )
+
+
+## ======================================================================
+"""
+Baked Conversion
+
+Drives the guides through a rig for a frame range, bakes the hair keys
+to a HairKeyCache and then drops the drivers, so that playback no longer
+evaluates tens of thousands of drivers per frame.
+"""
+## ======================================================================
+
+def do_bake_conversion( system:Union[str,bpy.types.ParticleSystem],
+		start_frame:Optional[int]=None, end_frame:Optional[int]=None,
+		filepath:Optional[str]=None ) -> hair_key_cache.HairKeyCache:
+	"""
+	Bakes a rigged particle system (see do_curve_conversion and
+	do_armature_conversion) to a hair key cache, removes its drivers and
+	plays the cache back instead.
+
+	:param system:      The Blender ParticleSystem, or its name, to bake.
+	:param start_frame: The first frame to bake, inclusive. Defaults to the scene start.
+	:param end_frame:   The last frame to bake, inclusive. Defaults to the scene end.
+	:param filepath:    If given, the cache is also written to this .npz file and
+						reloaded with the .blend file.
+	:returns: The HairKeyCache.
+	:raises: ValueError
+	"""
+
+	ps = find_particle_system( system )
+	if ps is None:
+		raise ValueError( 'Particle system "{}" not found.'.format(system) )
+
+	ob = find_particle_object( ps )
+	current_frame = bpy.context.scene.frame_current
+
+	with profiling.stage( 'hair_bake' ):
+		cache = hair_key_cache.bake_hair_cache( ob, ps, start_frame, end_frame )
+
+	removed = hair_key_cache.remove_hair_drivers( ob, ps )
+	unregister_chains( ps )
+	unregister_followers( ps )
+	unregister_resampling( ps )
+	hair_key_cache.register_hair_cache( cache, filepath )
+
+	profiling.log( 'Removed {} drivers from "{}".'.format(removed, ps.name) )
+
+	bpy.context.scene.frame_set( current_frame )
+	return cache
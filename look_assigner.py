@@ -1,8 +1,11 @@
-import os, re, sys
+import os, sys
 
 import bpy
+import numpy as np
 from bpy.types import Object, Mesh, Armature
 
+from . import core, profiling
+
 
 ## ======================================================================
 def clear_material_objects():
@@ -23,40 +26,35 @@ def do_assign( file_name:str ):
 		raise ValueError( 'do_assign: File "{}" does not exist.'.format(file_name) )
 
 	base_name = os.path.basename(file_name).partition(".")[0]
-	print( "\n\n\n" + base_name + "\n\n" )
+	profiling.log( "\n\n\n" + base_name + "\n\n" )
 
 	if not base_name in bpy.data.groups:
 		bpy.data.groups.new( base_name )
 	ref_grp = bpy.data.groups[base_name]
 
-	with bpy.data.libraries.load(file_name) as (data_from, data_to):
-		data_to.objects = [ x for x in data_from.objects
-							if x.startswith('geo') ]
+	with profiling.stage( 'library_load' ):
+		with bpy.data.libraries.load(file_name) as (data_from, data_to):
+			data_to.objects = [ x for x in data_from.objects
+								if x.startswith('geo') ]
 
 	clear_material_objects()
 
-	for ob in data_to.objects:
-		item = bpy.data.objects.new( 'MTL__' + ob.name, ob.data )
-		scene.objects.link( item )
-		ref_grp.objects.link( item )
+	with profiling.stage( 'library_link' ):
+		for ob in data_to.objects:
+			item = bpy.data.objects.new( 'MTL__' + ob.name, ob.data )
+			scene.objects.link( item )
+			ref_grp.objects.link( item )
+	profiling.count( 'library_objects', len(data_to.objects) )
 
-	## reattach
-	name_match = re.compile( r"""(MTL__)?geo(\.|_)([A-Za-z0-9_]+)(\.[0-9]{3})?""" )
-
-	def get_token( ob ):
-		match = name_match.match( ob.name )
-		if match:
-			return match.group( 3 )
-		return None
+	## reattach: index the material objects by token once, in scene order
+	targets = core.index_tokens( x.name for x in scene.objects if x.name in ref_grp.objects )
 
 	def find_match( ob ):
-		token = get_token( ob )
-		print('Searching for matching token "{}"'.format(token))
-		for target in [ x for x in scene.objects if x.name in ref_grp.objects ]:
-			match_token = get_token( target )
-			print( '\tTesting "{}" ("{}")...'.format(target.name, match_token) )
-			if match_token == token:
-				return target
+		token = core.look_token( ob.name )
+		profiling.log('Searching for matching token "{}"'.format(token))
+		profiling.count( 'token_tests' )
+		if token in targets:
+			return scene.objects[ targets[token] ]
 		return None
 
 	sel = [ x for x in scene.objects if x.select and not x.name == ref_grp.objects ]
@@ -64,15 +62,26 @@ def do_assign( file_name:str ):
 		materials = item.data.materials
 		materials.clear()
 
-		match = find_match( item )
+		with profiling.stage( 'token_match' ):
+			match = find_match( item )
+
 		if match:
-			print( 'Found match for "{}": "{}".'.format(item.name, match.name) )
-			for material in match.data.materials:
-				materials.append( material )
-			for index, target_face in enumerate( match.data.polygons ):
-				item.data.polygons[index].material_index = target_face.material_index
+			profiling.log( 'Found match for "{}": "{}".'.format(item.name, match.name) )
+			with profiling.stage( 'material_copy' ):
+				for material in match.data.materials:
+					materials.append( material )
+
+				## one bulk read and write rather than an RNA access per face
+				target_indices = np.empty( len(match.data.polygons), dtype=np.int32 )
+				profiling.foreach_get( match.data.polygons, 'material_index', target_indices )
+
+				material_indices = np.empty( len(item.data.polygons), dtype=np.int32 )
+				profiling.foreach_get( item.data.polygons, 'material_index', material_indices )
+				material_indices[:len(target_indices)] = target_indices
+				profiling.foreach_set( item.data.polygons, 'material_index', material_indices )
 		else:
-			print( 'No match found for "{}".'.format(item.name) )
+			profiling.log( 'No match found for "{}".'.format(item.name) )
+	profiling.count( 'objects_touched', len(sel) )
 
 	clear_material_objects()
 	bpy.data.groups.remove( ref_grp )
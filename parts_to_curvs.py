@@ -2,6 +2,12 @@ import bpy
 import pprint
 from itertools import islice
 
+try:
+	from . import profiling
+except ImportError:
+	## run from the text editor
+	from crowd_tools import profiling
+
 scene = bpy.context.scene
 
 
@@ -52,10 +58,11 @@ for ps, settings in restore.items(): #take(5, restore.items()):
 	modifier = find_modifier(obj, ps.name)
 
 	if not modifier.show_viewport:
-		print('skipping %s' % ps.name)
+		profiling.log('skipping %s' % ps.name)
 		continue
 
-	print( '+ Processing "{}"...'.format(ps.name) )
+	profiling.log( '+ Processing "{}"...'.format(ps.name) )
+	profiling.count( 'particle_systems' )
 
 	cur_settings = { ps:(0.0, 'NONE') }
 	set( cur_settings )
@@ -70,14 +77,16 @@ for ps, settings in restore.items(): #take(5, restore.items()):
 	use_hair_bspline = ps.settings.use_hair_bspline
 	ps.settings.use_hair_bspline = False
 	if use_hair_bspline:
-		print( "+ Disabling bspline..." )
+		profiling.log( "+ Disabling bspline..." )
 
 	bpy.context.scene.objects.active = obj
-	scene.update()
+	with profiling.stage( 'scene_update' ):
+		scene.update()
 	
 
 	# create the curve
-	bpy.ops.object.modifier_convert(modifier=modifier.name)
+	with profiling.stage( 'modifier_convert' ):
+		bpy.ops.object.modifier_convert(modifier=modifier.name)
 	new_obj = bpy.context.active_object
 	new_obj.name = crv_name
 	new_obj.data.name = crv_name
@@ -92,12 +101,17 @@ for ps, settings in restore.items(): #take(5, restore.items()):
 	new_obj.select = True
 	bpy.context.scene.objects.active = new_obj
 
-	bpy.ops.object.mode_set(mode='EDIT')
-	bpy.ops.mesh.separate(type="LOOSE")
-	bpy.ops.object.mode_set(mode='OBJECT')
-	bpy.ops.object.convert(target='CURVE')
+	with profiling.stage( 'separate' ):
+		bpy.ops.object.mode_set(mode='EDIT')
+		bpy.ops.mesh.separate(type="LOOSE")
+		bpy.ops.object.mode_set(mode='OBJECT')
+
+	with profiling.stage( 'curve_convert' ):
+		bpy.ops.object.convert(target='CURVE')
 
-	apply_force(bpy.context.selected_objects)
+	with profiling.stage( 'apply_force' ):
+		apply_force(bpy.context.selected_objects)
+	profiling.count( 'objects_touched', len(bpy.context.selected_objects) )
 	empty_obj.select = True
 	bpy.context.scene.objects.active = empty_obj
 	bpy.ops.group.create(name=grp_name)
@@ -110,4 +124,5 @@ for ps, settings in restore.items(): #take(5, restore.items()):
 
 	modifier.particle_system.settings.effector_weights.group = bpy.data.groups[grp_name]
 
-	scene.update()
+	with profiling.stage( 'scene_update' ):
+		scene.update()
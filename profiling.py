@@ -0,0 +1,243 @@
+import os, sys, json, time, socket, atexit
+from contextlib import contextmanager
+from typing import Optional
+
+
+## ======================================================================
+"""
+Stage Profiling
+
+Per-stage timers and counters shared by every crowd_tools module. Off by
+default, where a stage costs one dict lookup and a no-op context.
+
+Turn it on with the CROWD_TOOLS_PROFILE environment variable, set to a
+.jsonl path to append the report to (or to 1 for crowd_profile.jsonl in
+the working directory), or by calling enable(). Each run appends one
+JSON line holding every stage's calls and seconds plus the counters,
+so reports from many farm jobs can simply be concatenated and aggregated.
+
+The 'rna_calls' counter is kept by the foreach_get, foreach_set,
+driver_add and keyframe_insert wrappers below: the bulk adapters go
+through them, so it counts the calls that were actually made.
+
+log() replaces bare prints for progress messages; CROWD_TOOLS_QUIET=1
+or set_quiet(True) silences it, which matters when printing a line per
+vertex group or per frame is itself a measurable cost.
+"""
+## ======================================================================
+
+PROFILE_VARIABLE = 'CROWD_TOOLS_PROFILE'
+QUIET_VARIABLE   = 'CROWD_TOOLS_QUIET'
+
+DEFAULT_REPORT = 'crowd_profile.jsonl'
+
+_state = {
+	'enabled': False,
+	'quiet': bool( os.environ.get(QUIET_VARIABLE) ),
+	'report_path': None,
+	'started': time.time(),
+	'registered': False,
+}
+
+## stage name -> [ calls, seconds, max seconds ]
+_stages = {}
+_counters = {}
+
+
+## ======================================================================
+def enable( report_path:Optional[str]=None ):
+	"""
+	Turns profiling on and writes the report when the process exits.
+
+	:param report_path: The .jsonl file to append the report to.
+				Defaults to crowd_profile.jsonl in the working directory.
+	"""
+
+	_state['enabled'] = True
+	_state['report_path'] = report_path or _state['report_path'] or DEFAULT_REPORT
+
+	if not _state['registered']:
+		atexit.register( _write_at_exit )
+		_state['registered'] = True
+
+
+def disable():
+	_state['enabled'] = False
+
+
+def is_enabled() -> bool:
+	return _state['enabled']
+
+
+def set_quiet( quiet:bool=True ):
+	_state['quiet'] = quiet
+
+
+def reset():
+	"""
+	Drops every timing and counter gathered so far.
+	"""
+
+	_stages.clear()
+	_counters.clear()
+	_state['started'] = time.time()
+
+
+## ======================================================================
+class _NullStage:
+	__slots__ = ()
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def _timed_stage( name:str ):
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		seconds = time.perf_counter() - start
+		entry = _stages.get( name )
+		if entry is None:
+			_stages[name] = [ 1, seconds, seconds ]
+		else:
+			entry[0] += 1
+			entry[1] += seconds
+			entry[2] = max( entry[2], seconds )
+
+
+def stage( name:str ):
+	"""
+	Times a block under a stage name:
+
+		with profiling.stage( 'frame_set' ):
+			scene.frame_set( frame )
+
+	Nested stages are timed independently, so outer stages include
+	their inner ones.
+	"""
+
+	if not _state['enabled']:
+		return _NULL_STAGE
+
+	return _timed_stage( name )
+
+
+def count( name:str, amount:int=1 ):
+	"""
+	Adds to a counter, such as 'rna_calls' or 'objects_touched'.
+	"""
+
+	if _state['enabled']:
+		_counters[name] = _counters.get( name, 0 ) + amount
+
+
+## ======================================================================
+"""
+RNA Calls
+"""
+## ======================================================================
+
+def foreach_get( collection, attribute:str, values ):
+	"""
+	collection.foreach_get, counted as one of the 'rna_calls'.
+	"""
+
+	count( 'rna_calls' )
+	collection.foreach_get( attribute, values )
+
+
+def foreach_set( collection, attribute:str, values ):
+	"""
+	collection.foreach_set, counted as one of the 'rna_calls'.
+	"""
+
+	count( 'rna_calls' )
+	collection.foreach_set( attribute, values )
+
+
+def driver_add( owner, data_path:str, index:int=-1 ):
+	"""
+	owner.driver_add, counted as one of the 'rna_calls'.
+
+	:returns: The driver FCurve.
+	"""
+
+	count( 'rna_calls' )
+	return owner.driver_add( data_path, index )
+
+
+def keyframe_insert( owner, data_path:str, **kwargs ) -> bool:
+	"""
+	owner.keyframe_insert, counted as one of the 'rna_calls'.
+	"""
+
+	count( 'rna_calls' )
+	return owner.keyframe_insert( data_path, **kwargs )
+
+
+## ======================================================================
+def log( message:str ):
+	"""
+	Prints a progress message unless profiling output is quiet.
+	"""
+
+	if not _state['quiet']:
+		print( message )
+
+
+## ======================================================================
+def report( **extra ) -> dict:
+	"""
+	:returns: The report for this run so far: stages, counters and
+			where and when it ran. Keyword arguments are added as is.
+	"""
+
+	result = {
+		'host': socket.gethostname(),
+		'pid': os.getpid(),
+		'argv': sys.argv,
+		'started': _state['started'],
+		'elapsed': time.time() - _state['started'],
+		'stages': { name: {'calls': x[0], 'seconds': x[1], 'max': x[2]} for name, x in _stages.items() },
+		'counters': dict( _counters ),
+	}
+	result.update( extra )
+
+	return result
+
+
+def write_report( report_path:Optional[str]=None, **extra ):
+	"""
+	Appends this run's report as a single JSON line.
+	"""
+
+	report_path = report_path or _state['report_path'] or DEFAULT_REPORT
+
+	## one write call per line, so concurrent jobs appending to a shared file don't interleave
+	with open( report_path, 'a' ) as fp:
+		fp.write( json.dumps(report(**extra)) + '\n' )
+
+
+def _write_at_exit():
+	if _state['enabled'] and ( _stages or _counters ):
+		write_report()
+
+
+## ======================================================================
+def _enable_from_environment():
+	value = os.environ.get( PROFILE_VARIABLE, '' )
+	if not value or value == '0':
+		return
+
+	enable( None if value == '1' else value )
+
+
+_enable_from_environment()
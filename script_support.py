@@ -0,0 +1,55 @@
+import os, sys, importlib
+from typing import Optional, List
+
+
+## ======================================================================
+"""
+Script Support
+
+crowd_batch, crowd_worker and crowd_bench run as scripts, by file path,
+under a plain interpreter or `blender --python`, where the crowd_tools
+modules are not importable as a package yet. These helpers, kept free
+of bpy, get them imported and the script's own arguments out of argv:
+
+	if __package__:
+		from .script_support import import_tools, script_argv
+	else:
+		sys.path.insert( 0, os.path.dirname(os.path.abspath(__file__)) )
+		from script_support import import_tools, script_argv
+"""
+## ======================================================================
+
+PACKAGE_DIR = os.path.dirname( os.path.abspath(__file__) )
+
+
+def import_tools( name:str, reload:bool=False ):
+	"""
+	Imports a crowd_tools module as part of its package.
+
+	:param name: The module name, such as 'cache_sculpt'.
+	:param reload: Reload the module if it was imported before, for
+				scripts that do their work at import time.
+	:returns: The module.
+	"""
+
+	parent = os.path.dirname( PACKAGE_DIR )
+	if not parent in sys.path:
+		sys.path.insert( 0, parent )
+
+	module_name = '{}.{}'.format( os.path.basename(PACKAGE_DIR), name )
+	if reload and module_name in sys.modules:
+		return importlib.reload( sys.modules[module_name] )
+
+	return importlib.import_module( module_name )
+
+
+def script_argv( argv:Optional[List[str]]=None ) -> List[str]:
+	"""
+	The script's own arguments: everything after '--' when run through
+	Blender, otherwise everything after the script name.
+	"""
+
+	if argv is None:
+		argv = sys.argv
+
+	return argv[ argv.index('--')+1: ] if '--' in argv else argv[1:]
@@ -0,0 +1,213 @@
+import os, sys
+
+import numpy as np
+import pytest
+
+sys.path.insert( 0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))) )
+
+import core, guide_reduction
+
+
+## ======================================================================
+"""
+OBJ Export
+"""
+## ======================================================================
+
+def _obj_lines( filepath, prefix ):
+	with open( filepath ) as fp:
+		return [ x.split()[1:] for x in fp if x.startswith(prefix) ]
+
+
+def test_write_obj_uniform_faces( tmp_path ):
+	filepath = str( tmp_path / 'quads.obj' )
+	positions = np.arange( 18, dtype=np.float32 ).reshape( 6, 3 )
+	core.write_obj( filepath, positions, [4, 4], [0, 1, 2, 3, 2, 3, 4, 5] )
+
+	vertices = np.array( _obj_lines(filepath, 'v '), dtype=np.float32 )
+	np.testing.assert_allclose( vertices, positions )
+	assert _obj_lines( filepath, 'f ' ) == [ ['1', '2', '3', '4'], ['3', '4', '5', '6'] ]
+
+
+def test_write_obj_mixed_faces( tmp_path ):
+	filepath = str( tmp_path / 'mixed.obj' )
+	positions = np.zeros( (5, 3), dtype=np.float32 )
+	core.write_obj( filepath, positions, [3, 4], [0, 1, 2, 1, 2, 3, 4] )
+
+	assert _obj_lines( filepath, 'f ' ) == [ ['1', '2', '3'], ['2', '3', '4', '5'] ]
+
+
+def test_write_obj_without_faces( tmp_path ):
+	filepath = str( tmp_path / 'points.obj' )
+	core.write_obj( filepath, np.ones((3, 3), dtype=np.float32), [], [] )
+
+	with open( filepath ) as fp:
+		lines = fp.read().splitlines()
+
+	assert len( _obj_lines(filepath, 'v ') ) == 3
+	assert not any( x.startswith('f') for x in lines )
+
+
+def test_rotate_y_up():
+	result = core.rotate_y_up( np.array([[1.0, 2.0, 3.0]]) )
+	np.testing.assert_allclose( result, [[1.0, 3.0, -2.0]] )
+
+
+## ======================================================================
+"""
+PC2 Point Caches
+"""
+## ======================================================================
+
+def test_pc2_round_trip( tmp_path ):
+	filepath = str( tmp_path / 'cycle.pc2' )
+	positions = np.random.RandomState( 0 ).rand( 4, 7, 3 ).astype( np.float32 )
+	core.write_pc2( filepath, positions, start_frame=10.0, sample_rate=0.5 )
+
+	header = core.read_pc2_header( filepath )
+	assert header == { 'vertex_count': 7, 'start_frame': 10.0, 'sample_rate': 0.5, 'frame_count': 4 }
+	np.testing.assert_array_equal( core.read_pc2(filepath), positions )
+
+
+def test_read_pc2_header_rejects_other_files( tmp_path ):
+	filepath = tmp_path / 'not_a_cache.pc2'
+	filepath.write_bytes( b'\0' * 64 )
+
+	with pytest.raises( ValueError ):
+		core.read_pc2_header( str(filepath) )
+
+	filepath.write_bytes( b'POINT' )
+	with pytest.raises( ValueError ):
+		core.read_pc2_header( str(filepath) )
+
+
+## ======================================================================
+"""
+Look Tokens
+"""
+## ======================================================================
+
+def test_look_token():
+	assert core.look_token( 'geo_vincent' ) == 'vincent'
+	assert core.look_token( 'geo.vincent_body' ) == 'vincent_body'
+	assert core.look_token( 'MTL__geo_vincent.001' ) == 'vincent'
+	assert core.look_token( 'rig.vincent' ) is None
+
+
+def test_index_tokens_keeps_first_name():
+	names = [ 'geo_a', 'rig.b', 'geo.a', 'MTL__geo_c.002' ]
+	assert core.index_tokens( names ) == { 'a': 'geo_a', 'c': 'MTL__geo_c.002' }
+
+
+## ======================================================================
+"""
+Guide Chains
+"""
+## ======================================================================
+
+def test_chain_points():
+	positions = np.zeros( (2, 4, 3), dtype=np.float32 )
+	positions[..., 2] = np.arange( 4 )
+	positions[1, :, 0] = 5.0
+
+	points = core.chain_points( positions, [[0, 1, 2, 3], [0, 2]] )
+
+	assert [ x.shape for x in points ] == [ (5, 3), (3, 3) ]
+	np.testing.assert_allclose( points[0][:, 2], [0, 1, 2, 3, 4] )
+	np.testing.assert_allclose( points[1][:, 2], [0, 2, 4] )
+	np.testing.assert_allclose( points[1][:, 0], 5.0 )
+
+
+## ======================================================================
+"""
+Frame Sampling
+"""
+## ======================================================================
+
+def test_sample_frames():
+	positions = np.arange( 3, dtype=np.float32 ).reshape( 3, 1 ) * 10.0
+
+	assert core.sample_frames( positions, 5, 5 )[0] == 0.0
+	assert core.sample_frames( positions, 5, 6.5 )[0] == pytest.approx( 15.0 )
+	assert core.sample_frames( positions, 5, 1 )[0] == 0.0
+	assert core.sample_frames( positions, 5, 100 )[0] == 20.0
+
+
+def test_cycle_frame():
+	assert core.cycle_frame( 10, 10, 1.0, 8, True ) == 0.0
+	assert core.cycle_frame( 21, 10, 1.0, 8, True ) == 3.0
+	assert core.cycle_frame( 14, 10, 0.5, 8, True ) == 2.0
+	assert core.cycle_frame( 30, 10, 1.0, 8, False ) == 7.0
+	assert core.cycle_frame( 5, 10, 1.0, 8, False ) == 0.0
+
+
+def test_cycle_frame_blends_across_the_wrap():
+	## past the last sample a loop heads for the copy of the first one
+	assert core.cycle_frame( 17.5, 10, 1.0, 8, True ) == 7.5
+	assert core.cycle_frame( 18, 10, 1.0, 8, True ) == 0.0
+	assert core.cycle_frame( 17.5, 10, 1.0, 8, False ) == 7.0
+
+
+## ======================================================================
+"""
+Guide Reduction
+"""
+## ======================================================================
+
+def _bent_guides():
+	## a straight guide and one bent at a right angle halfway
+	positions = np.zeros( (2, 9, 3) )
+	positions[:, :, 2] = np.arange( 9 )
+	positions[1, 5:, 2] = 4.0
+	positions[1, 5:, 0] = np.arange( 1, 5 )
+	return positions
+
+
+def test_resample_guides_keeps_corners():
+	positions = _bent_guides()
+	resampled = guide_reduction.resample_guides( positions, tolerance=1e-3 )
+
+	assert guide_reduction.kept_keys( resampled, 0 ) == [ 0, 8 ]
+	assert guide_reduction.kept_keys( resampled, 1 ) == [ 0, 4, 8 ]
+
+	## the dropped keys come back from the kept ones
+	interpolated = guide_reduction.interpolate_keys( positions, resampled )
+	np.testing.assert_allclose( interpolated, positions, atol=1e-5 )
+
+
+def test_resample_guides_angle_tolerance():
+	positions = _bent_guides()
+	resampled = guide_reduction.resample_guides( positions, tolerance=100.0, angle_tolerance=0.5 )
+
+	assert guide_reduction.kept_keys( resampled, 0 ) == [ 0, 8 ]
+	assert guide_reduction.kept_keys( resampled, 1 ) == [ 0, 4, 8 ]
+
+
+def test_cluster_guides():
+	## two tight groups of five guides, far apart
+	roots = np.concatenate( [np.zeros((5, 3)), np.full((5, 3), 100.0)] )
+	roots[:, 0] += np.tile( np.linspace(0.0, 0.1, 5), 2 )
+	positions = roots[:, np.newaxis] + np.linspace( 0.0, 1.0, 4 )[:, np.newaxis] * [0.0, 0.0, 1.0]
+
+	clusters = guide_reduction.cluster_guides( positions, 2 )
+
+	assert len( clusters.representatives ) == 2
+	assert list( clusters.representatives ) == sorted( clusters.representatives )
+	assert len( set(clusters.labels[:5]) ) == 1
+	assert len( set(clusters.labels[5:]) ) == 1
+	assert not clusters.labels[0] == clusters.labels[5]
+
+	## each representative belongs to its own cluster
+	for position, representative in enumerate( clusters.representatives ):
+		assert clusters.labels[representative] == position
+
+
+def test_cluster_guides_keeps_everything_under_target():
+	positions = np.random.RandomState( 0 ).rand( 3, 4, 3 )
+	clusters = guide_reduction.cluster_guides( positions, 5 )
+
+	assert list( clusters.representatives ) == [ 0, 1, 2 ]
+	assert list( clusters.labels ) == [ 0, 1, 2 ]
+
+	with pytest.raises( ValueError ):
+		guide_reduction.cluster_guides( positions, 0 )
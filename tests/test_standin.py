@@ -0,0 +1,132 @@
+import os, sys, types, importlib
+
+import numpy as np
+import pytest
+
+## the tool modules import each other relatively, so they load as a package
+ROOT = os.path.dirname( os.path.dirname(os.path.abspath(__file__)) )
+PACKAGE = os.path.basename( ROOT )
+sys.path.insert( 0, os.path.dirname(ROOT) )
+
+bpy_standin = importlib.import_module( PACKAGE + '.bpy_standin' )
+bpy = bpy_standin.install()
+
+hair_key_cache = importlib.import_module( PACKAGE + '.hair_key_cache' )
+cache_sculpt = importlib.import_module( PACKAGE + '.cache_sculpt' )
+
+
+def _positions( particles=4, keys=5 ):
+	return np.arange( particles * keys * 3, dtype=np.float32 ).reshape( particles, keys, 3 )
+
+
+## ======================================================================
+"""
+Hair Keys
+"""
+## ======================================================================
+
+def test_read_hair_keys():
+	positions = _positions()
+	system = bpy_standin.particle_system( 'prt.test', positions )
+
+	np.testing.assert_array_equal( hair_key_cache.read_hair_keys(system), positions )
+	np.testing.assert_array_equal( hair_key_cache.read_hair_keys(system, [3, 1]), positions[[3, 1]] )
+	assert hair_key_cache.read_hair_keys( system, [] ).shape == ( 0, 0, 3 )
+
+
+def test_write_hair_keys():
+	system = bpy_standin.particle_system( 'prt.test', _positions() )
+	values = -_positions( 2 )
+
+	hair_key_cache.write_hair_keys( system, values, [2, 0] )
+
+	np.testing.assert_array_equal( system.positions[[2, 0]], values )
+	np.testing.assert_array_equal( system.positions[[1, 3]], _positions()[[1, 3]] )
+
+	hair_key_cache.write_hair_keys( system, _positions() * 2.0 )
+	np.testing.assert_array_equal( hair_key_cache.read_hair_keys(system), _positions() * 2.0 )
+
+
+## ======================================================================
+"""
+Hair Key Cache
+"""
+## ======================================================================
+
+@pytest.fixture
+def driven_system( monkeypatch ):
+	"""
+	A hair system whose keys move up one unit in z per frame, as if
+	driven, with the frame change doing the moving.
+	"""
+
+	rest = _positions()
+	system = bpy_standin.particle_system( 'prt.test', rest.copy() )
+	scene = bpy.context.scene
+
+	def frame_set( frame, subframe=0.0 ):
+		scene.frame_current = frame
+		system.positions[:] = rest + [0.0, 0.0, float(frame)]
+
+	monkeypatch.setattr( scene, 'frame_set', frame_set )
+	return system
+
+
+def test_bake_hair_cache( driven_system ):
+	ob = types.SimpleNamespace( name='ob.test' )
+	cache = hair_key_cache.bake_hair_cache( ob, driven_system, 3, 6 )
+
+	assert cache.object_name == 'ob.test'
+	assert cache.system_name == 'prt.test'
+	assert cache.start_frame == 3
+	assert cache.positions.shape == ( 4, 4, 5, 3 )
+	np.testing.assert_array_equal( cache.positions[..., 2] - _positions()[..., 2],
+		np.broadcast_to( np.arange(3.0, 7.0)[:, np.newaxis, np.newaxis], (4, 4, 5) ) )
+
+	with pytest.raises( ValueError ):
+		hair_key_cache.bake_hair_cache( ob, driven_system, 6, 3 )
+
+
+def test_sample_hair_cache( driven_system ):
+	ob = types.SimpleNamespace( name='ob.test' )
+	cache = hair_key_cache.bake_hair_cache( ob, driven_system, 1, 4 )
+	rest_z = _positions()[..., 2]
+
+	np.testing.assert_allclose( hair_key_cache.sample_hair_cache(cache, 2)[..., 2], rest_z + 2.0 )
+	np.testing.assert_allclose( hair_key_cache.sample_hair_cache(cache, 2.25)[..., 2], rest_z + 2.25 )
+
+	## clamped to the cached range
+	np.testing.assert_allclose( hair_key_cache.sample_hair_cache(cache, -10)[..., 2], rest_z + 1.0 )
+	np.testing.assert_allclose( hair_key_cache.sample_hair_cache(cache, 99)[..., 2], rest_z + 4.0 )
+
+
+def test_hair_cache_round_trip( driven_system, tmp_path ):
+	ob = types.SimpleNamespace( name='ob.test' )
+	cache = hair_key_cache.bake_hair_cache( ob, driven_system, 1, 2 )
+
+	filepath = str( tmp_path / 'hair.npz' )
+	hair_key_cache.save_hair_cache( cache, filepath )
+	loaded = hair_key_cache.load_hair_cache( filepath )
+
+	assert loaded[:3] == cache[:3]
+	np.testing.assert_array_equal( loaded.positions, cache.positions )
+
+
+## ======================================================================
+"""
+Meshes
+"""
+## ======================================================================
+
+def test_mesh_arrays():
+	positions = np.arange( 15, dtype=np.float32 ).reshape( 5, 3 )
+	mesh = bpy_standin.mesh( positions, [3, 4], [0, 1, 2, 1, 2, 3, 4] )
+
+	result, loop_totals, vertex_indices = cache_sculpt.mesh_arrays( mesh )
+	np.testing.assert_array_equal( result, positions )
+	assert loop_totals.tolist() == [ 3, 4 ]
+	assert vertex_indices.tolist() == [ 0, 1, 2, 1, 2, 3, 4 ]
+
+	result, loop_totals, vertex_indices = cache_sculpt.mesh_arrays( mesh, faces=False )
+	np.testing.assert_array_equal( result, positions )
+	assert loop_totals is None and vertex_indices is None